@@ -8,6 +8,11 @@ from .middleware import (
     SlotPolicy,
 )
 from .dupefilter import SplashAwareDupeFilter, splash_request_fingerprint
-from .cache import SplashAwareFSCacheStorage
+from .cache import (
+    SplashAwareFSCacheStorage,
+    SplashAwareRFC2616Policy,
+    SplashDedupFSCacheStorage,
+    SplashRenderCacheMiddleware,
+)
 from .response import SplashResponse, SplashTextResponse, SplashJsonResponse
 from .request import SplashRequest, SplashFormRequest, SplashRequestFingerprinter
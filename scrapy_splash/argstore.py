@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Storage for Splash argument caching (``save_args`` / ``load_args``).
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from collections import OrderedDict
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from scrapy.utils.job import job_dir
+from scrapy.utils.misc import load_object
+
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteKeyStore(object):
+    """
+    Durable ``(Splash URL, local fingerprint) => Splash key`` mapping.
+
+    Keys are stored in an append-only JSON lines file, so they can be reused
+    by later crawls: the first request which uses a known argument value
+    can send ``load_args`` instead of the value itself. Each line is
+    ``{"splash_url": ..., "fp": ..., "key": ...}``; ``"key": null`` marks
+    a key which was reported as expired by Splash. The file is compacted
+    when it is opened.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._keys = {}
+        self._file = None
+
+    def open(self):
+        """ Load keys from the file and open it for appending """
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for lines, line in enumerate(f, 1):
+                    self._load_line(line)
+        if lines != len(self._keys):
+            self._compact()
+        self._file = open(self.path, 'a', buffering=1)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get(self, splash_url, fp):
+        """ Return Splash key for the fingerprint, or None if it is unknown """
+        return self._keys.get((splash_url, fp))
+
+    def set(self, splash_url, fp, key):
+        if self._keys.get((splash_url, fp)) == key:
+            return
+        self._keys[(splash_url, fp)] = key
+        self._write(splash_url, fp, key)
+
+    def discard(self, splash_url, fp):
+        if self._keys.pop((splash_url, fp), None) is not None:
+            self._write(splash_url, fp, None)
+
+    def clear(self, splash_url):
+        """ Discard all keys of a Splash instance """
+        for instance_url, fp in list(self._keys):
+            if instance_url == splash_url:
+                self.discard(instance_url, fp)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _load_line(self, line):
+        try:
+            entry = json.loads(line)
+            index = entry['splash_url'], entry['fp']
+            key = entry['key']
+        except (ValueError, KeyError, TypeError):
+            # e.g. a line truncated when the previous crawl was killed
+            logger.warning("Invalid line in %s is ignored: %r",
+                           self.path, line)
+            return
+        if key is None:
+            self._keys.pop(index, None)
+        else:
+            self._keys[index] = key
+
+    def _compact(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            for (splash_url, fp), key in self._keys.items():
+                f.write(self._format(splash_url, fp, key))
+        os.replace(tmp_path, self.path)
+
+    def _write(self, splash_url, fp, key):
+        if self._file is not None:
+            self._file.write(self._format(splash_url, fp, key))
+
+    @staticmethod
+    def _format(splash_url, fp, key):
+        entry = {'splash_url': splash_url, 'fp': fp, 'key': key}
+        return json.dumps(entry, sort_keys=True) + '\n'
+
+
+class ArgumentStore(MutableMapping):
+    """
+    Storage of argument values replaced by SplashDeduplicateArgsMiddleware,
+    keyed by their local fingerprints.
+
+    Values are reference-counted: ``add`` is called for each request which
+    refers to a value, ``release`` when the request no longer needs it.
+    Values which are not referenced by any request are kept in a bounded
+    LRU region (``max_unreferenced`` values), so that retried requests and
+    new requests with the same values can still use them; older
+    unreferenced values are dropped.
+    """
+    def __init__(self, max_unreferenced=100):
+        self.max_unreferenced = max_unreferenced
+
+    def add(self, fp, value):
+        """ Store the value if needed and increment its reference count """
+        raise NotImplementedError
+
+    def release(self, fp):
+        """ Decrement reference count of the value """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryArgumentStore(ArgumentStore):
+    """ ArgumentStore which keeps values in memory """
+    def __init__(self, max_unreferenced=100):
+        super(MemoryArgumentStore, self).__init__(max_unreferenced)
+        self._values = {}
+        self._refs = {}
+        self._unreferenced = OrderedDict()
+
+    def add(self, fp, value):
+        if fp not in self._values:
+            self._values[fp] = value
+        self._unreferenced.pop(fp, None)
+        self._refs[fp] = self._refs.get(fp, 0) + 1
+
+    def release(self, fp):
+        refs = self._refs.get(fp)
+        if refs is None:
+            return
+        if refs > 1:
+            self._refs[fp] = refs - 1
+            return
+        del self._refs[fp]
+        self._unreferenced[fp] = None
+        self._evict()
+
+    def refcount(self, fp):
+        return self._refs.get(fp, 0)
+
+    def _evict(self):
+        while len(self._unreferenced) > self.max_unreferenced:
+            fp, _ = self._unreferenced.popitem(last=False)
+            del self._values[fp]
+
+    def __getitem__(self, fp):
+        value = self._values[fp]
+        if fp in self._unreferenced:
+            self._unreferenced.move_to_end(fp)
+        return value
+
+    def __setitem__(self, fp, value):
+        self._values[fp] = value
+        if fp not in self._refs:
+            self._unreferenced[fp] = None
+            self._unreferenced.move_to_end(fp)
+            self._evict()
+
+    def __delitem__(self, fp):
+        del self._values[fp]
+        self._refs.pop(fp, None)
+        self._unreferenced.pop(fp, None)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class SqliteArgumentStore(ArgumentStore):
+    """
+    ArgumentStore which keeps JSON-encoded values in an SQLite database.
+    Only the database path is pickled (e.g. to JOBDIR spider state);
+    an empty path means a temporary database which is removed when
+    it is closed.
+    """
+    def __init__(self, path='', max_unreferenced=100):
+        super(SqliteArgumentStore, self).__init__(max_unreferenced)
+        self.path = path
+        self._connect()
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS arguments ("
+            "fp TEXT PRIMARY KEY, value TEXT, refs INTEGER, used INTEGER)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS unreferenced "
+            "ON arguments (used) WHERE refs = 0"
+        )
+        row = self._db.execute("SELECT MAX(used) FROM arguments").fetchone()
+        self._clock = row[0] or 0
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def add(self, fp, value):
+        cur = self._db.execute(
+            "UPDATE arguments SET refs = refs + 1, used = ? WHERE fp = ?",
+            (self._tick(), fp))
+        if not cur.rowcount:
+            self._db.execute(
+                "INSERT INTO arguments VALUES (?, ?, 1, ?)",
+                (fp, json.dumps(value), self._clock))
+
+    def release(self, fp):
+        cur = self._db.execute(
+            "UPDATE arguments SET refs = refs - 1, used = ? "
+            "WHERE fp = ? AND refs > 0", (self._tick(), fp))
+        if cur.rowcount:
+            self._evict()
+
+    def refcount(self, fp):
+        row = self._db.execute("SELECT refs FROM arguments WHERE fp = ?",
+                               (fp,)).fetchone()
+        return row[0] if row else 0
+
+    def _evict(self):
+        self._db.execute(
+            "DELETE FROM arguments WHERE fp IN ("
+            "SELECT fp FROM arguments WHERE refs = 0 "
+            "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_unreferenced,))
+
+    def __getitem__(self, fp):
+        row = self._db.execute("SELECT value FROM arguments WHERE fp = ?",
+                               (fp,)).fetchone()
+        if row is None:
+            raise KeyError(fp)
+        self._db.execute("UPDATE arguments SET used = ? WHERE fp = ?",
+                         (self._tick(), fp))
+        return json.loads(row[0])
+
+    def __setitem__(self, fp, value):
+        self._db.execute(
+            "INSERT INTO arguments VALUES (?, ?, 0, ?) "
+            "ON CONFLICT (fp) DO UPDATE SET value = excluded.value",
+            (fp, json.dumps(value), self._tick()))
+        self._evict()
+
+    def __delitem__(self, fp):
+        cur = self._db.execute("DELETE FROM arguments WHERE fp = ?", (fp,))
+        if not cur.rowcount:
+            raise KeyError(fp)
+
+    def __iter__(self):
+        rows = self._db.execute("SELECT fp FROM arguments").fetchall()
+        return (row[0] for row in rows)
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM arguments").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __getstate__(self):
+        return {'path': self.path, 'max_unreferenced': self.max_unreferenced}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+
+_argument_stores = {
+    'memory': MemoryArgumentStore,
+    'sqlite': SqliteArgumentStore,
+}
+
+
+def get_argument_store(settings):
+    """
+    Return ArgumentStore configured by SPLASH_ARGS_STORE
+    ('memory', 'sqlite' or an import path of an ArgumentStore subclass),
+    SPLASH_ARGS_STORE_PATH and SPLASH_ARGS_STORE_MAX_UNREFERENCED options.
+    """
+    name = settings.get('SPLASH_ARGS_STORE', 'memory')
+    store_cls = _argument_stores.get(name) or load_object(name)
+    max_unreferenced = settings.getint('SPLASH_ARGS_STORE_MAX_UNREFERENCED',
+                                       100)
+    if store_cls is MemoryArgumentStore:
+        return store_cls(max_unreferenced=max_unreferenced)
+    path = settings.get('SPLASH_ARGS_STORE_PATH')
+    if not path and job_dir(settings):
+        path = os.path.join(job_dir(settings), 'splash_args.sqlite')
+    return store_cls(path or '', max_unreferenced=max_unreferenced)
+
+
+def ensure_argument_store(spider, key, default_factory=MemoryArgumentStore):
+    """
+    Return ArgumentStore kept in ``spider.state[key]``, creating it if needed.
+    A dict left in the state by an older scrapy-splash version is converted,
+    its values are kept until requests from the queue use them.
+    """
+    if not hasattr(spider, 'state'):
+        spider.state = {}
+    store = spider.state.get(key)
+    if isinstance(store, ArgumentStore):
+        return store
+    new_store = default_factory()
+    for fp, value in (store or {}).items():
+        new_store.add(fp, value)
+    spider.state[key] = new_store
+    return new_store
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Batching of Splash /execute requests: several requests which use the same
+Lua script are sent to Splash as a single request, and the results are
+split back into individual responses.
+"""
+from __future__ import absolute_import
+
+from twisted.internet import defer, reactor
+from scrapy import Request
+from scrapy.http import TextResponse
+from scrapy.utils.python import to_bytes
+
+
+BATCH_LUA_SOURCE = """
+local user_main = (function()
+%s
+return main
+end)()
+
+function main(splash, args)
+  local results = {}
+  for i, item_args in ipairs(args.batch) do
+    local ok, result = pcall(user_main, splash, item_args)
+    if ok then
+      results[i] = {ok=true, result=result}
+    else
+      results[i] = {ok=false, error=tostring(result)}
+    end
+  end
+  return {results=results}
+end
+"""
+
+
+def batch_lua_source(lua_source):
+    """
+    Return a Lua script which calls ``main(splash, args)`` function of
+    ``lua_source`` script for each element of ``args.batch`` list,
+    one after another, and returns all results.
+    """
+    return BATCH_LUA_SOURCE % lua_source
+
+
+class SplashBatcher(object):
+    """
+    Collects batchable Splash requests and sends them in batches.
+
+    Requests are grouped by Splash URL, Lua script, Splash timeout,
+    download slot, headers sent to Splash, cookie session and cookies
+    (all pages of a batch are rendered with the same cookie jar);
+    other arguments may differ. A batch is sent when it has ``max_size``
+    requests or ``window`` seconds after its first request was added.
+    Pages are rendered one after another, so the timeout of a batch
+    is the sum of timeouts of its requests; a batch has no more requests
+    than fit into ``max_timeout`` (``--max-timeout`` option of Splash).
+    """
+    def __init__(self, download, json_codec, max_size=10, window=0.2,
+                 stats=None, clock=reactor, max_timeout=90):
+        self.download = download
+        self.json_codec = json_codec
+        self.max_size = max_size
+        self.max_timeout = max_timeout
+        self.window = window
+        self.stats = stats
+        self.clock = clock
+        self._pending = {}  # batch key => [(request, deferred)]
+        self._timers = {}
+
+    @staticmethod
+    def is_batchable(request):
+        splash_options = request.meta.get('splash', {})
+        args = splash_options.get('args', {})
+        return (
+            splash_options.get('batch', False)
+            and splash_options.get('endpoint', '').strip('/') == 'execute'
+            and 'lua_source' in args
+            # save_args and load_args are not supported in batches
+            and not splash_options.get('_local_arg_fingerprints')
+        )
+
+    def add(self, request):
+        """
+        Add a Splash request to a batch. Return a Deferred which is fired
+        with a response for this request when the batch is downloaded.
+        """
+        d = defer.Deferred()
+        key = self._batch_key(request)
+        self._pending.setdefault(key, []).append((request, d))
+        if len(self._pending[key]) >= self._max_items(request):
+            self.flush(key)
+        elif key not in self._timers:
+            self._timers[key] = self.clock.callLater(self.window,
+                                                     self.flush, key)
+        return d
+
+    def flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        items = self._pending.pop(key, [])
+        if not items:
+            return
+        if self.stats is not None:
+            self.stats.inc_value('splash/batch/request_count')
+            self.stats.inc_value('splash/batch/batched_request_count',
+                                 len(items))
+        d = self.download(self._batch_request(items))
+        d.addCallbacks(self._fan_out, self._fail,
+                       callbackArgs=(items,), errbackArgs=(items,))
+
+    def _max_items(self, request):
+        timeout = request.meta['splash']['args'].get('timeout')
+        if not timeout or not self.max_timeout:
+            return self.max_size
+        fits = int(self.max_timeout // float(timeout))
+        return max(1, min(self.max_size, fits))
+
+    def _batch_key(self, request):
+        splash_options = request.meta['splash']
+        args = splash_options['args']
+        headers = tuple(sorted(
+            (name, tuple(values)) for name, values in request.headers.items()
+        ))
+        cookies = args.get('cookies')
+        if cookies is not None:
+            cookies = self.json_codec.dumps(cookies)
+        return (request.url, args['lua_source'], args.get('timeout'),
+                request.meta.get('download_slot'), headers,
+                splash_options.get('session_id'), cookies)
+
+    def _batch_request(self, items):
+        first = items[0][0]
+        batch_args = []
+        for request, _ in items:
+            args = dict(request.meta['splash']['args'])
+            args.pop('lua_source')
+            args.pop('timeout', None)
+            batch_args.append(args)
+
+        args = {
+            'lua_source': batch_lua_source(
+                first.meta['splash']['args']['lua_source']),
+            'batch': batch_args,
+        }
+        meta = {
+            'dont_cache': True,
+            'dont_obey_robotstxt': True,
+            # requests of the batch are retried individually
+            'dont_retry': True,
+            'handle_httpstatus_all': True,
+        }
+        # pages are rendered one after another
+        if 'timeout' in first.meta['splash']['args']:
+            args['timeout'] = (float(first.meta['splash']['args']['timeout'])
+                               * len(items))
+        download_timeout = sum(request.meta.get('download_timeout', 0)
+                               for request, _ in items)
+        if download_timeout:
+            meta['download_timeout'] = download_timeout
+        if 'download_slot' in first.meta:
+            meta['download_slot'] = first.meta['download_slot']
+        return Request(
+            first.url,
+            method='POST',
+            body=self.json_codec.dumps(args),
+            headers=first.headers,
+            priority=max(request.priority for request, _ in items),
+            meta=meta,
+            dont_filter=True,
+        )
+
+    def _fan_out(self, response, items):
+        if response.status != 200:
+            # e.g. Splash is overloaded or the whole batch timed out
+            for request, d in items:
+                d.callback(response.replace(url=request.url,
+                                            request=request))
+            return
+        try:
+            results = self.json_codec.loads(response.body)['results']
+            if len(results) != len(items):
+                raise ValueError("Unexpected number of batch results: "
+                                 "%d != %d" % (len(results), len(items)))
+        except Exception as e:
+            for request, d in items:
+                d.errback(e)
+            return
+        for (request, d), result in zip(items, results):
+            d.callback(self._item_response(request, result))
+
+    def _fail(self, failure, items):
+        for request, d in items:
+            d.errback(failure)
+
+    def _item_response(self, request, item):
+        """ Return a response Splash would return for a single request """
+        if not item.get('ok'):
+            error = {
+                'error': 400,
+                'type': 'ScriptError',
+                'description': 'Error happened while executing Lua script',
+                'info': {'type': 'LUA_ERROR', 'message': item.get('error')},
+            }
+            return self._response(request, 400, 'application/json',
+                                  self.json_codec.dumps(error))
+        result = item.get('result')
+        if result is None:
+            return self._response(request, 200, 'text/html; charset=utf-8',
+                                  b'')
+        if isinstance(result, str):
+            return self._response(request, 200, 'text/html; charset=utf-8',
+                                  result)
+        return self._response(request, 200, 'application/json',
+                              self.json_codec.dumps(result))
+
+    @staticmethod
+    def _response(request, status, content_type, body):
+        return TextResponse(request.url, status=status,
+                            headers={'Content-Type': content_type},
+                            body=to_bytes(body), request=request)
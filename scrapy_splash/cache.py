@@ -6,12 +6,34 @@ Scrapy needs a custom caching backed.
 See https://github.com/scrapy/scrapy/issues/900 for more info.
 """
 from __future__ import absolute_import
+import hashlib
+import json
+import logging
 import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
 from warnings import warn
+from weakref import WeakKeyDictionary
 
-from scrapy.extensions.httpcache import FilesystemCacheStorage
+from six.moves.urllib.parse import urlparse
+from w3lib.http import headers_dict_to_raw
+from scrapy import Request, signals
+from scrapy.extensions.httpcache import FilesystemCacheStorage, RFC2616Policy
+from scrapy.http import Response
+from scrapy.http.headers import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
 
 from .dupefilter import splash_request_fingerprint
+from .jsoncodec import LazyJsonObject, default_codec, get_json_codec
+from .utils import headers_to_scrapy, to_bytes, to_unicode
+
+
+logger = logging.getLogger(__name__)
 
 
 class SplashAwareFSCacheStorage(FilesystemCacheStorage):
@@ -30,3 +52,448 @@ class SplashAwareFSCacheStorage(FilesystemCacheStorage):
     def _get_request_path(self, spider, request):
         key = splash_request_fingerprint(request)
         return os.path.join(self.cachedir, spider.name, key[0:2], key)
+
+
+class SplashDedupFSCacheStorage(FilesystemCacheStorage):
+    """
+    FilesystemCacheStorage which stores each distinct response body
+    and request body only once.
+
+    Bodies are stored in files named by SHA1 hashes of their contents;
+    cache entries are hard links to these files, so the number of links
+    of a file is the number of entries which use it. Expired entries
+    (see HTTPCACHE_EXPIRATION_SECS) and bodies no longer used by any entry
+    are removed when the spider is closed, unless SPLASH_CACHE_GC_ON_CLOSE
+    is False. If the filesystem doesn't support hard links, entries
+    get their own copies of bodies.
+    """
+    blobs_dirname = '_blobs'
+
+    def __init__(self, settings):
+        super(SplashDedupFSCacheStorage, self).__init__(settings)
+        self.gc_on_close = settings.getbool('SPLASH_CACHE_GC_ON_CLOSE', True)
+
+    def close_spider(self, spider):
+        super(SplashDedupFSCacheStorage, self).close_spider(spider)
+        if self.gc_on_close:
+            self.collect_garbage(spider)
+
+    def store_response(self, spider, request, response):
+        # Files are written in the same format as FilesystemCacheStorage
+        # writes them, but bodies are written only to shared files.
+        rpath = self._get_request_path(spider, request)
+        if not os.path.exists(rpath):
+            os.makedirs(rpath)
+        metadata = {
+            'url': request.url,
+            'method': request.method,
+            'status': response.status,
+            'response_url': response.url,
+            'timestamp': time.time(),
+        }
+        with self._open(os.path.join(rpath, 'meta'), 'wb') as f:
+            f.write(to_bytes(repr(metadata)))
+        with self._open(os.path.join(rpath, 'pickled_meta'), 'wb') as f:
+            pickle.dump(metadata, f, protocol=4)
+        with self._open(os.path.join(rpath, 'response_headers'), 'wb') as f:
+            f.write(headers_dict_to_raw(response.headers))
+        with self._open(os.path.join(rpath, 'request_headers'), 'wb') as f:
+            f.write(headers_dict_to_raw(request.headers))
+        # Body files may be links to shared files; they are replaced,
+        # not overwritten, to keep contents of other entries intact.
+        self._link_blob(spider, os.path.join(rpath, 'response_body'),
+                        response.body)
+        self._link_blob(spider, os.path.join(rpath, 'request_body'),
+                        request.body)
+
+    def collect_garbage(self, spider):
+        """ Remove expired cache entries and bodies which are not used """
+        spider_dir = os.path.join(self.cachedir, spider.name)
+        if not os.path.isdir(spider_dir):
+            return
+        expired = 0
+        if self.expiration_secs > 0:
+            deadline = time.time() - self.expiration_secs
+            for dirname in os.listdir(spider_dir):
+                if dirname == self.blobs_dirname:
+                    continue
+                for rpath in _listdir(os.path.join(spider_dir, dirname)):
+                    metapath = os.path.join(rpath, 'pickled_meta')
+                    if (os.path.exists(metapath)
+                            and os.stat(metapath).st_mtime < deadline):
+                        shutil.rmtree(rpath, ignore_errors=True)
+                        expired += 1
+
+        removed = 0
+        blobs_dir = os.path.join(spider_dir, self.blobs_dirname)
+        for dirname in _listdir(blobs_dir):
+            for path in _listdir(dirname):
+                if os.stat(path).st_nlink == 1:
+                    _remove_file(path)
+                    removed += 1
+        logger.info("Removed %(expired)d expired HTTP cache entries and "
+                    "%(removed)d unused bodies",
+                    {'expired': expired, 'removed': removed},
+                    extra={'spider': spider})
+
+    def _blob_path(self, spider, data):
+        digest = hashlib.sha1(data).hexdigest()
+        return os.path.join(self.cachedir, spider.name, self.blobs_dirname,
+                            digest[:2], digest)
+
+    def _link_blob(self, spider, path, data):
+        blob = self._blob_path(spider, data)
+        if not os.path.exists(blob):
+            dirname = os.path.dirname(blob)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname)
+            os.close(fd)
+            with self._open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, blob)
+        tmp_path = path + '.tmp'
+        _remove_file(tmp_path)
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            _remove_file(path)
+            with self._open(path, 'wb') as f:
+                f.write(data)
+        else:
+            os.replace(tmp_path, path)
+
+
+def _listdir(path):
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in os.listdir(path)]
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SplashAwareRFC2616Policy(RFC2616Policy):
+    """
+    RFC2616 HTTP cache policy which uses headers and status of rendered
+    pages for Splash requests.
+
+    Splash responses don't have freshness headers of the remote website;
+    when a Splash response is a JSON object with 'headers' and/or
+    'http_status' keys, as returned by scripts which use magic
+    responses, these headers and status are used
+    to decide if the response can be cached and for how long.
+    Stale responses are revalidated by adding If-None-Match and
+    If-Modified-Since headers to 'headers' Splash argument; scripts
+    should pass them to the website (``splash:go{url,
+    headers=splash.args.headers}``) and return 'http_status' of the page,
+    so that 304 Not Modified replies are recognized.
+
+    Bodies are decoded and encoded with SPLASH_JSON_CODEC; only 'headers'
+    and 'http_status' keys of responses are decoded.
+    """
+    def __init__(self, settings):
+        super(SplashAwareRFC2616Policy, self).__init__(settings)
+        self.json_codec = get_json_codec(settings.get('SPLASH_JSON_CODEC',
+                                                      'json'))
+        self._rendered = WeakKeyDictionary()
+
+    def should_cache_response(self, response, request):
+        return super(SplashAwareRFC2616Policy, self).should_cache_response(
+            self._rendered_response(response, request), request)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        return super(SplashAwareRFC2616Policy, self).is_cached_response_fresh(
+            self._rendered_response(cachedresponse, request), request)
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        return super(SplashAwareRFC2616Policy, self).is_cached_response_valid(
+            self._rendered_response(cachedresponse, request),
+            self._rendered_response(response, request),
+            request)
+
+    def _set_conditional_validators(self, request, cachedresponse):
+        if not _is_splash_request(request):
+            return super(SplashAwareRFC2616Policy,
+                         self)._set_conditional_validators(
+                request, cachedresponse)
+        validators = []
+        if b'Last-Modified' in cachedresponse.headers:
+            validators.append(('If-Modified-Since',
+                               cachedresponse.headers[b'Last-Modified']))
+        if b'ETag' in cachedresponse.headers:
+            validators.append(('If-None-Match',
+                               cachedresponse.headers[b'ETag']))
+        if validators:
+            _set_splash_headers(request, validators, self.json_codec)
+
+    def _rendered_response(self, response, request):
+        """
+        Return a response with headers and status of the rendered page
+        if they are available, or the response itself otherwise.
+        """
+        if not _is_splash_request(request) or response.status != 200:
+            return response
+        if response in self._rendered:
+            return self._rendered[response]
+        rendered = response
+        try:
+            # e.g. base64-encoded 'png' or 'har' values are not decoded
+            data = LazyJsonObject(response.body, self.json_codec)
+        except ValueError:
+            data = None
+        if data is not None and ('headers' in data or 'http_status' in data):
+            headers = headers_to_scrapy(data.get('headers'))
+            if b'Date' not in headers and b'Date' in response.headers:
+                headers[b'Date'] = response.headers[b'Date']
+            rendered = Response(
+                response.url,
+                status=int(data.get('http_status', response.status)),
+                headers=headers,
+            )
+        self._rendered[response] = rendered
+        return rendered
+
+
+def _is_splash_request(request):
+    return request.meta.get('_splash_processed', False)
+
+
+def _set_splash_headers(request, new_headers, json_codec=default_codec):
+    """
+    Add ``(name, value)`` headers to 'headers' argument in the body of
+    a Splash request.
+
+    HttpCacheMiddleware sends the request object it passes to the cache
+    policy, so the body is changed in place. Request meta is not changed,
+    and the original body is kept in ``'_splash_fingerprint_body'`` meta key
+    for SplashRequestFingerprinter, so the request fingerprint (and so
+    the HTTP cache key) stays the same.
+    """
+    try:
+        args = json_codec.loads(request.body)
+    except ValueError:
+        return
+    if 'headers' in (args.get('load_args') or {}):
+        # headers value is not available here
+        return
+    headers = args.get('headers') or {}
+    names = {name.lower() for name, _ in new_headers}
+    values = [(to_unicode(name), to_unicode(value))
+              for name, value in new_headers]
+    if isinstance(headers, dict):
+        headers = {name: value for name, value in headers.items()
+                   if name.lower() not in names}
+        headers.update(values)
+    else:
+        headers = [header for header in headers
+                   if _header_name(header).lower() not in names]
+        headers.extend(list(header) for header in values)
+    args['headers'] = headers
+    request.meta.setdefault('_splash_fingerprint_body', request.body)
+    request._set_body(json_codec.dumps(args))
+
+
+def _header_name(header):
+    if isinstance(header, dict):
+        return header['name']
+    return header[0]
+
+
+class SqliteRenderCacheStorage(object):
+    """
+    Single-file storage of Splash responses for SplashRenderCacheMiddleware.
+    Response bodies are compressed with zlib. When ``max_size`` is set,
+    least recently used responses are removed to keep the total size
+    of compressed bodies below it.
+    """
+    def __init__(self, path, max_size=0):
+        self.path = path
+        self.max_size = max_size
+        self._db = None
+        self._size = 0
+
+    def open(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, stored REAL, accessed REAL, status INTEGER, "
+            "url TEXT, headers TEXT, body BLOB, size INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS lru "
+                         "ON responses (accessed)")
+        row = self._db.execute("SELECT SUM(size) FROM responses").fetchone()
+        self._size = row[0] or 0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def retrieve(self, key, ttl=0):
+        """
+        Return ``(status, url, headers, body)`` stored for the key,
+        or None if there is no response or it is older than ``ttl`` seconds.
+        """
+        row = self._db.execute(
+            "SELECT stored, status, url, headers, body FROM responses "
+            "WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        stored, status, url, headers, body = row
+        now = time.time()
+        if ttl and stored + ttl < now:
+            return None
+        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?",
+                         (now, key))
+        return status, url, json.loads(headers), zlib.decompress(body)
+
+    def store(self, key, status, url, headers, body):
+        body = zlib.compress(body)
+        now = time.time()
+        old = self._db.execute("SELECT size FROM responses WHERE key = ?",
+                               (key,)).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, now, now, status, url, json.dumps(headers), body, len(body)))
+        self._size += len(body) - (old[0] if old else 0)
+        if self.max_size and self._size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        rows = self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        removed = []
+        for key, size in rows:
+            if self._size <= self.max_size:
+                break
+            removed.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", removed)
+
+
+class SplashRenderCacheMiddleware(object):
+    """
+    Downloader middleware which caches Splash responses locally, so that
+    pages which were rendered recently are not sent to Splash again.
+
+    Responses are cached by request fingerprints computed by
+    SplashRequestFingerprinter; ``save_args`` / ``load_args`` arguments
+    are not taken into account. Only responses with HTTP 200 status
+    are cached. X-Splash-Saved-Arguments header is not cached: the keys
+    are valid only for the Splash instance which rendered the page, and
+    a cached response may be returned for a request to another instance.
+    It must be placed after SplashMiddleware, e.g.::
+
+        DOWNLOADER_MIDDLEWARES = {
+            # ...
+            'scrapy_splash.SplashRenderCacheMiddleware': 730,
+        }
+    """
+    def __init__(self, crawler, storage, ttl=0, ttl_per_endpoint=None,
+                 ttl_per_domain=None):
+        from scrapy_splash.request import SplashRequestFingerprinter
+        self.crawler = crawler
+        self.storage = storage
+        self.ttl = ttl
+        self.ttl_per_endpoint = ttl_per_endpoint or {}
+        self.ttl_per_domain = ttl_per_domain or {}
+        self.fingerprinter = SplashRequestFingerprinter(crawler)
+        crawler.signals.connect(self.spider_opened, signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+        path = s.get('SPLASH_RENDER_CACHE_PATH') or data_path(
+            'splash_render_cache.sqlite', createdir=True)
+        storage = SqliteRenderCacheStorage(
+            path, max_size=s.getint('SPLASH_RENDER_CACHE_MAX_SIZE', 0))
+        return cls(crawler, storage,
+                   ttl=s.getint('SPLASH_RENDER_CACHE_TTL', 0),
+                   ttl_per_endpoint=s.getdict('SPLASH_RENDER_CACHE_TTL_PER_ENDPOINT'),
+                   ttl_per_domain=s.getdict('SPLASH_RENDER_CACHE_TTL_PER_DOMAIN'))
+
+    def spider_opened(self, spider):
+        self.storage.open()
+
+    def spider_closed(self, spider):
+        self.storage.close()
+
+    def process_request(self, request, spider):
+        if not self._is_cacheable(request):
+            return
+        key = self._cache_key(request)
+        cached = self.storage.retrieve(key, self._get_ttl(request))
+        if cached is None:
+            self.crawler.stats.inc_value('splash/render_cache/miss')
+            request.meta['_splash_render_cache_key'] = key
+            return
+        self.crawler.stats.inc_value('splash/render_cache/hit')
+        status, url, headers, body = cached
+        headers = Headers(self._cached_headers(headers))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, status=status, headers=headers, body=body,
+                       flags=['cached'], request=request)
+
+    def process_response(self, request, response, spider):
+        if 'cached' in response.flags:
+            return response
+        key = request.meta.pop('_splash_render_cache_key', None)
+        if key is not None and response.status == 200:
+            headers = self._cached_headers(
+                (to_unicode(name), [to_unicode(v) for v in values])
+                for name, values in response.headers.items())
+            self.storage.store(key, response.status, response.url,
+                               headers, response.body)
+            self.crawler.stats.inc_value('splash/render_cache/store')
+        return response
+
+    def _cached_headers(self, headers):
+        return [(name, values) for name, values in headers
+                if name.lower() != 'x-splash-saved-arguments']
+
+    def _is_cacheable(self, request):
+        return (request.meta.get('_splash_processed')
+                and 'splash' in request.meta
+                and not request.meta.get('dont_cache'))
+
+    def _cache_key(self, request):
+        """
+        Return fingerprint of the request, which doesn't depend on
+        whether argument values are sent to Splash or loaded using
+        ``load_args``, and on which Splash server renders the page.
+        """
+        splash_options = request.meta['splash']
+        args = dict(splash_options.get('args', {}))
+        args.pop('load_args', None)
+        args.pop('save_args', None)
+        local_arg_fingerprints = splash_options.get('_local_arg_fingerprints', {})
+        args.update(local_arg_fingerprints)
+        options = {key: value for key, value in splash_options.items()
+                   if not key.startswith('_') and key != 'splash_url'}
+        options['args'] = args
+        key_request = Request(args.get('url') or 'about:blank',
+                              meta={'splash': options})
+        return to_unicode(self.fingerprinter.fingerprint(key_request))
+
+    def _get_ttl(self, request):
+        splash_options = request.meta['splash']
+        url = splash_options.get('args', {}).get('url') or ''
+        host = urlparse(url).hostname or ''
+        parts = host.split('.')
+        for i in range(len(parts)):
+            domain = '.'.join(parts[i:])
+            if domain in self.ttl_per_domain:
+                return self.ttl_per_domain[domain]
+        endpoint = splash_options.get('endpoint', '').strip('/')
+        return self.ttl_per_endpoint.get(endpoint, self.ttl)
@@ -5,13 +5,146 @@ Cookie-related utilities.
 from __future__ import absolute_import
 import time
 import calendar
+from functools import lru_cache
 
 from six.moves.http_cookiejar import CookieJar, Cookie
 
 
-def jar_to_har(cookiejar):
-    """ Convert CookieJar to HAR cookies format """
-    return [cookie_to_har(c) for c in cookiejar]
+class SplashCookieJar(CookieJar):
+    """
+    CookieJar which caches HAR representation of its cookies.
+
+    ``version`` is incremented each time cookies are actually changed
+    (setting a cookie equal to the existing one doesn't change anything);
+    HAR list of all cookies is rebuilt only when the version changes,
+    HAR dicts of individual cookies are rebuilt only when these cookies
+    change. If ``track_changes`` is True, keys of changed cookies
+    are collected until ``pop_changes`` is called.
+    """
+    def __init__(self, policy=None, track_changes=False):
+        super(SplashCookieJar, self).__init__(policy)
+        self.version = 0
+        self._har_cookies = {}  # (domain, path, name) => HAR cookie
+        self._har = (None, [])  # (version, HAR list of all cookies)
+        self._changed_keys = set() if track_changes else None
+
+    def set_cookie(self, cookie):
+        key = _cookie_key(cookie)
+        old = self.get_cookie(key)
+        if old is not None and vars(old) == vars(cookie):
+            return
+        super(SplashCookieJar, self).set_cookie(cookie)
+        self._changed([key])
+
+    def clear(self, domain=None, path=None, name=None):
+        # keys are taken from the {domain: {path: {name: cookie}}} dict
+        # directly; clear_expired_cookies calls clear for every cookie
+        if name is not None:
+            keys = [(domain, path, name)]
+        elif path is not None:
+            keys = [(domain, path, n)
+                    for n in self._cookies.get(domain, {}).get(path, {})]
+        elif domain is not None:
+            keys = [(domain, p, n)
+                    for p, names in self._cookies.get(domain, {}).items()
+                    for n in names]
+        else:
+            keys = [_cookie_key(cookie) for cookie in self]
+        super(SplashCookieJar, self).clear(domain, path, name)
+        self._changed(keys)
+
+    def get_cookie(self, key):
+        """ Return a cookie by ``(domain, path, name)`` key, or None """
+        domain, path, name = key
+        return self._cookies.get(domain, {}).get(path, {}).get(name)
+
+    def pop_changes(self):
+        """ Return keys of cookies changed since the previous call """
+        if self._changed_keys is None:
+            return set()
+        keys, self._changed_keys = self._changed_keys, set()
+        return keys
+
+    def _changed(self, keys):
+        for key in keys:
+            self._har_cookies.pop(key, None)
+        if self._changed_keys is not None:
+            self._changed_keys.update(keys)
+        self.version += 1
+
+    def has_har_cookie(self, har_cookie):
+        """ Return True if the jar has a cookie equal to ``har_cookie`` """
+        return self._har_cookies.get(_har_cookie_key(har_cookie)) == har_cookie
+
+    def to_har(self, hosts=None):
+        """ Return cookies in HAR format; see :func:`jar_to_har` """
+        if hosts is not None:
+            return [self._cookie_to_har(c)
+                    for c in jar_cookies_for_hosts(self, hosts)]
+        version, har = self._har
+        if version != self.version:
+            har = [self._cookie_to_har(c) for c in self]
+            self._har = (self.version, har)
+        return list(har)
+
+    def _cookie_to_har(self, cookie):
+        key = _cookie_key(cookie)
+        if key not in self._har_cookies:
+            self._har_cookies[key] = cookie_to_har(cookie)
+        return self._har_cookies[key]
+
+
+def jar_to_har(cookiejar, hosts=None):
+    """
+    Convert CookieJar to HAR cookies format.
+    If ``hosts`` are given, only cookies which can be sent to these hosts,
+    their parent domains or subdomains are converted.
+    """
+    if isinstance(cookiejar, SplashCookieJar):
+        return cookiejar.to_har(hosts)
+    if hosts is None:
+        return [cookie_to_har(c) for c in cookiejar]
+    return [cookie_to_har(c) for c in jar_cookies_for_hosts(cookiejar, hosts)]
+
+
+def jar_cookies_for_hosts(cookiejar, hosts):
+    """
+    Return cookies from CookieJar which can be used by pages on ``hosts``
+    (including parent domains and subdomains, so that cookies are available
+    after redirects, e.g. from example.com to www.example.com).
+    Cookies without a domain are always returned.
+    """
+    hosts = [host.lower() for host in hosts]
+    cookies = []
+    # CookieJar keeps cookies in {domain: {path: {name: cookie}}} dict;
+    # domains which don't match are skipped without visiting their cookies.
+    for domain, paths in cookiejar._cookies.items():
+        if not any(domain_matches(domain, host) for host in hosts):
+            continue
+        for names in paths.values():
+            cookies.extend(names.values())
+    return cookies
+
+
+def domain_matches(domain, host):
+    """
+    Return True if a cookie set for ``domain`` can be used by ``host``,
+    its parent domains or subdomains.
+
+    >>> domain_matches('.example.com', 'www.example.com')
+    True
+    >>> domain_matches('www.example.com', 'example.com')
+    True
+    >>> domain_matches('example.com', 'example.org')
+    False
+    >>> domain_matches('', 'example.org')
+    True
+    """
+    domain = domain.lstrip('.').lower()
+    if not domain:
+        return True
+    return (host == domain or host.endswith('.' + domain)
+            or domain.endswith('.' + host))
 
 
 def har_to_jar(cookiejar, har_cookies, request_cookies=None):
@@ -19,17 +152,19 @@ def har_to_jar(cookiejar, har_cookies, request_cookies=None):
     If request_cookies is given, remove cookies absent from har_cookies
     but present in request_cookies (they were removed). """
     har_cookie_keys = set()
+    cached = isinstance(cookiejar, SplashCookieJar)
     for c in har_cookies:
-        cookie = har_to_cookie(c)
-        cookiejar.set_cookie(cookie)
-        har_cookie_keys.add(_cookie_key(cookie))
+        har_cookie_keys.add(_har_cookie_key(c))
+        if cached and cookiejar.has_har_cookie(c):
+            continue  # the cookie is not changed
+        cookiejar.set_cookie(har_to_cookie(c))
     if request_cookies:
         for c in request_cookies:
-            cookie = har_to_cookie(c)
-            if _cookie_key(cookie) not in har_cookie_keys:
+            key = _har_cookie_key(c)
+            if key not in har_cookie_keys:
                 # We sent it but it did not come back: remove it
                 try:
-                    cookiejar.clear(cookie.domain, cookie.path, cookie.name)
+                    cookiejar.clear(*key)
                 except KeyError:
                     pass  # It could have been already removed
 
@@ -38,6 +173,12 @@ def _cookie_key(cookie):
     return (cookie.domain, cookie.path, cookie.name)
 
 
+def _har_cookie_key(har_cookie):
+    """ Return _cookie_key of har_to_cookie(har_cookie) result """
+    return (har_cookie.get('domain', ''), har_cookie.get('path', '/'),
+            har_cookie['name'])
+
+
 def har_to_cookie(har_cookie):
     """
     Convert a cookie dict in HAR format to a Cookie instance.
@@ -74,8 +215,7 @@ def har_to_cookie(har_cookie):
 
     expires_timestamp = None
     if har_cookie.get('expires'):
-        expires = time.strptime(har_cookie['expires'], "%Y-%m-%dT%H:%M:%SZ")
-        expires_timestamp = calendar.timegm(expires)
+        expires_timestamp = _parse_expires(har_cookie['expires'])
 
     kwargs = dict(
         version=har_cookie.get('version') or 0,
@@ -115,8 +255,7 @@ def cookie_to_har(cookie):
         c['domain'] = cookie.domain
 
     if cookie.expires:
-        tm = time.gmtime(cookie.expires)
-        c['expires'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", tm)
+        c['expires'] = _format_expires(cookie.expires)
 
     http_only = cookie.get_nonstandard_attr('HttpOnly')
     if http_only is not None:
@@ -126,3 +265,14 @@ def cookie_to_har(cookie):
         c['comment'] = cookie.comment
 
     return c
+
+
+# Many cookies share the same expiration time, and time.strptime is slow.
+@lru_cache(maxsize=1024)
+def _parse_expires(value):
+    return calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+@lru_cache(maxsize=1024)
+def _format_expires(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of cookie jars of Splash sessions (``session_id``) used by
+SplashCookiesMiddleware.
+"""
+from __future__ import absolute_import
+import dbm
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from scrapy.utils.job import job_dir
+from scrapy.utils.misc import load_object
+
+from .cookies import SplashCookieJar, cookie_to_har, har_to_jar
+
+
+class JarStore(Mapping):
+    """
+    ``session_id => SplashCookieJar`` mapping. Like ``defaultdict``,
+    it creates an empty jar when a missing session is accessed.
+
+    At most ``max_jars`` jars are kept in memory (0 means no limit);
+    least recently used jars are dropped first. Jars which were not used
+    for ``idle_ttl`` seconds (0 means forever) are dropped by ``sweep``,
+    which also removes expired cookies from the remaining jars.
+
+    Subclasses may keep jars in a durable storage: they load jars which
+    are not in memory, and save cookies changed since the previous ``save``
+    call; jars dropped from memory because of ``max_jars`` can be loaded
+    again later.
+    """
+    def __init__(self, max_jars=0, idle_ttl=0, clock=time.time):
+        self.max_jars = max_jars
+        self.idle_ttl = idle_ttl
+        self.clock = clock
+        self.evicted_count = 0
+        self._jars = OrderedDict()  # session_id => (jar, last used time)
+
+    def __getitem__(self, session_id):
+        entry = self._jars.get(session_id)
+        if entry is not None and not self._is_stale(session_id, entry[0]):
+            jar = entry[0]
+        else:
+            jar = self._load(session_id)
+            if jar is None:
+                jar = self._new_jar()
+        self._jars[session_id] = (jar, self.clock())
+        # the most recently used jar is the last one
+        self._jars.move_to_end(session_id)
+        if self.max_jars and len(self._jars) > self.max_jars:
+            self._jars.popitem(last=False)
+            self.evicted_count += 1
+        return jar
+
+    def __delitem__(self, session_id):
+        self._jars.pop(session_id, None)
+        self._delete(session_id)
+
+    def __contains__(self, session_id):
+        return session_id in self._jars
+
+    def __iter__(self):
+        return iter(list(self._jars))
+
+    def __len__(self):
+        return len(self._jars)
+
+    def save(self, session_id):
+        """ Save changes of a session jar """
+        pass
+
+    def sweep(self):
+        """
+        Drop idle jars and remove expired cookies from other jars.
+        Return the number of cookies in the remaining jars.
+        """
+        if self.idle_ttl:
+            deadline = self.clock() - self.idle_ttl
+            while self._jars:
+                session_id, (jar, used) = next(iter(self._jars.items()))
+                if used >= deadline:
+                    break
+                del self[session_id]
+                self.evicted_count += 1
+            self._delete_idle(deadline)
+        cookie_count = 0
+        for session_id, (jar, used) in list(self._jars.items()):
+            jar.clear_expired_cookies()
+            self.save(session_id)
+            cookie_count += len(jar)
+        return cookie_count
+
+    def close(self):
+        pass
+
+    def _new_jar(self):
+        return SplashCookieJar()
+
+    def _load(self, session_id):
+        """ Return a jar loaded from the storage, or None """
+        return None
+
+    def _is_stale(self, session_id, jar):
+        """ Return True if the jar was changed by another process """
+        return False
+
+    def _delete(self, session_id):
+        pass
+
+    def _delete_idle(self, deadline):
+        """ Delete sessions not used since ``deadline`` from the storage """
+        pass
+
+
+class MemoryJarStore(JarStore):
+    """ JarStore which keeps jars in memory only """
+
+
+class SqliteJarStore(JarStore):
+    """
+    JarStore which keeps cookies in an SQLite database, one row per cookie,
+    so that only changed cookies are written. Several processes can use
+    the same database: a jar is reloaded when another process changes it.
+    An empty path means a temporary database.
+    """
+    def __init__(self, path='', max_jars=0, idle_ttl=0, clock=time.time):
+        super(SqliteJarStore, self).__init__(max_jars, idle_ttl, clock)
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, version INTEGER, used REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cookies ("
+            "session_id TEXT, domain TEXT, path TEXT, name TEXT, har TEXT, "
+            "PRIMARY KEY (session_id, domain, path, name))"
+        )
+
+    def save(self, session_id):
+        entry = self._jars.get(session_id)
+        if entry is None:
+            return
+        jar = entry[0]
+        keys = jar.pop_changes()
+        if not keys:
+            return
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            version = self._get_version(session_id)
+            for key in keys:
+                cookie = jar.get_cookie(key)
+                if cookie is None:
+                    self._db.execute(
+                        "DELETE FROM cookies WHERE session_id = ? "
+                        "AND domain = ? AND path = ? AND name = ?",
+                        (session_id,) + key)
+                else:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO cookies VALUES (?, ?, ?, ?, ?)",
+                        (session_id,) + key
+                        + (json.dumps(cookie_to_har(cookie)),))
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                (session_id, (version or 0) + 1, self.clock()))
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        if version == jar.stored_version:
+            jar.stored_version = (version or 0) + 1
+        else:
+            # another process changed the jar; reload it on next access
+            jar.stored_version = -1
+
+    def sweep(self):
+        # jars which are used, but not changed, are not idle
+        self._db.executemany(
+            "UPDATE sessions SET used = ? WHERE session_id = ?",
+            [(used, session_id)
+             for session_id, (jar, used) in self._jars.items()])
+        return super(SqliteJarStore, self).sweep()
+
+    def close(self):
+        self._db.close()
+
+    def _new_jar(self):
+        return SplashCookieJar(track_changes=True)
+
+    def _get_version(self, session_id):
+        row = self._db.execute(
+            "SELECT version FROM sessions WHERE session_id = ?",
+            (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def _is_stale(self, session_id, jar):
+        return self._get_version(session_id) != jar.stored_version
+
+    def _load(self, session_id):
+        # a jar is returned even if there are no cookies in the database,
+        # to keep its version
+        jar = self._new_jar()
+        jar.stored_version = self._get_version(session_id)
+        rows = self._db.execute(
+            "SELECT har FROM cookies WHERE session_id = ?", (session_id,))
+        har_to_jar(jar, [json.loads(row[0]) for row in rows])
+        jar.pop_changes()
+        return jar
+
+    def _delete(self, session_id):
+        self._db.execute("DELETE FROM cookies WHERE session_id = ?",
+                         (session_id,))
+        self._db.execute("DELETE FROM sessions WHERE session_id = ?",
+                         (session_id,))
+
+    def _delete_idle(self, deadline):
+        self._db.execute(
+            "DELETE FROM cookies WHERE session_id IN ("
+            "SELECT session_id FROM sessions WHERE used < ?)", (deadline,))
+        self._db.execute("DELETE FROM sessions WHERE used < ?", (deadline,))
+
+
+class DbmJarStore(JarStore):
+    """
+    JarStore which keeps cookies in a ``dbm`` database, one key per
+    session; a session is written only when its cookies change.
+    The database can't be shared by several processes, and sessions
+    which are not loaded in memory are not expired by ``idle_ttl``.
+    Session ids are converted to strings to be used as keys, so e.g.
+    ``123`` and ``'123'`` refer to the same session.
+    """
+    def __init__(self, path, max_jars=0, idle_ttl=0, clock=time.time):
+        super(DbmJarStore, self).__init__(max_jars, idle_ttl, clock)
+        if not path:
+            raise ValueError("DbmJarStore requires SPLASH_COOKIES_STORE_PATH "
+                             "or JOBDIR to be set")
+        self.path = path
+        self._db = dbm.open(path, 'c')
+
+    def save(self, session_id):
+        entry = self._jars.get(session_id)
+        if entry is not None and entry[0].pop_changes():
+            self._db[str(session_id)] = json.dumps(entry[0].to_har())
+
+    def close(self):
+        self._db.close()
+
+    def _new_jar(self):
+        return SplashCookieJar(track_changes=True)
+
+    def _load(self, session_id):
+        try:
+            har_cookies = json.loads(self._db[str(session_id)])
+        except KeyError:
+            return None
+        jar = self._new_jar()
+        har_to_jar(jar, har_cookies)
+        jar.pop_changes()
+        return jar
+
+    def _delete(self, session_id):
+        try:
+            del self._db[str(session_id)]
+        except KeyError:
+            pass
+
+
+_jar_stores = {
+    'memory': MemoryJarStore,
+    'sqlite': SqliteJarStore,
+    'dbm': DbmJarStore,
+}
+
+_jar_store_filenames = {
+    SqliteJarStore: 'splash_cookies.sqlite',
+    DbmJarStore: 'splash_cookies.db',
+}
+
+
+def get_jar_store(settings):
+    """
+    Return JarStore configured by SPLASH_COOKIES_STORE ('memory', 'sqlite',
+    'dbm' or an import path of a JarStore subclass), SPLASH_COOKIES_STORE_PATH,
+    SPLASH_COOKIES_MAX_SESSIONS and SPLASH_COOKIES_SESSION_TTL options.
+    """
+    name = settings.get('SPLASH_COOKIES_STORE', 'memory')
+    store_cls = _jar_stores.get(name) or load_object(name)
+    kwargs = dict(
+        max_jars=settings.getint('SPLASH_COOKIES_MAX_SESSIONS', 0),
+        idle_ttl=settings.getfloat('SPLASH_COOKIES_SESSION_TTL', 0),
+    )
+    if store_cls is MemoryJarStore:
+        return store_cls(**kwargs)
+    path = settings.get('SPLASH_COOKIES_STORE_PATH')
+    if not path and job_dir(settings):
+        filename = _jar_store_filenames.get(store_cls, 'splash_cookies')
+        path = os.path.join(job_dir(settings), filename)
+    return store_cls(path or '', **kwargs)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoders/decoders used for Splash request bodies and responses.
+
+All codecs sort object keys, so equal arguments are always serialized
+to equal request bodies and request fingerprints stay deterministic.
+"""
+from __future__ import absolute_import
+import json
+import re
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from scrapy.utils.misc import load_object
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec(object):
+    """
+    Standard library codec which pretty-prints request bodies.
+    It is the default, to keep request bodies (and so fingerprints used
+    by HTTP cache) the same as in previous scrapy-splash versions.
+    """
+    def dumps(self, obj):
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True, indent=4)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class CompactJsonCodec(JsonCodec):
+    """ Standard library codec which doesn't add any whitespace """
+    def dumps(self, obj):
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True,
+                          separators=(',', ':'))
+
+
+class OrjsonCodec(object):
+    """ Codec based on orjson library """
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is required for OrjsonCodec")
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def _fast_codec():
+    if orjson is not None:
+        return OrjsonCodec()
+    return CompactJsonCodec()
+
+
+_codecs = {
+    'json': JsonCodec,
+    'compact': CompactJsonCodec,
+    'orjson': OrjsonCodec,
+    'fast': _fast_codec,
+}
+
+
+def get_json_codec(name):
+    """
+    Return a codec instance for SPLASH_JSON_CODEC option value:
+    'json', 'compact', 'orjson', 'fast' (orjson when it is installed,
+    'compact' otherwise), or an import path of a codec class.
+    """
+    if name in _codecs:
+        return _codecs[name]()
+    return load_object(name)()
+
+
+default_codec = JsonCodec()
+
+
+_whitespace_re = re.compile(br'[ \t\r\n]*')
+_scalar_end_re = re.compile(br'[ \t\r\n]*[,}\]]')
+# a quote which is not escaped (preceded by an even number of backslashes)
+_string_end_re = re.compile(br'(?<!\\)(?:\\\\)*"')
+# a string without escape sequences, a bracket, or any other string
+_token_re = re.compile(br'"[^"\\]*"|[\[\]{}"]')
+_closing = {ord('{'): ord('}'), ord('['): ord(']')}
+_QUOTE = ord('"')
+_BACKSLASH = 0x5c
+
+
+def index_json_object(data):
+    r"""
+    Index a top-level JSON object in ``data`` bytes.
+
+    Return ``(spans, decoded)`` tuple: ``spans`` is a ``{key: (start, end)}``
+    dict with positions of all values, ``decoded`` is a ``{key: value}``
+    dict with values which had to be decoded to find where they end.
+    Strings without escaped quotes (e.g. base64-encoded data) and numbers
+    are skipped without decoding; the end of strings with escaped quotes
+    and of nested objects/arrays is found by scanning bytes of the value
+    only. Strings with escaped quotes are decoded and returned in
+    ``decoded``, nested objects/arrays are not decoded at all.
+    ValueError is raised if ``data`` is not a JSON object.
+
+    >>> data = b'{"html": "<p>\\"hi\\"</p>", "png": "iVBO", "n": [1, {"a": "]"}]}'
+    >>> spans, decoded = index_json_object(data)
+    >>> sorted(spans)
+    ['html', 'n', 'png']
+    >>> start, end = spans['n']
+    >>> data[start:end]
+    b'[1, {"a": "]"}]'
+    >>> decoded
+    {'html': '<p>"hi"</p>'}
+    """
+    pos = _whitespace_re.match(data).end()
+    if data[pos:pos + 1] != b'{':
+        raise ValueError("JSON object expected")
+    pos = _whitespace_re.match(data, pos + 1).end()
+    spans = {}
+    decoded = {}
+    if data[pos:pos + 1] == b'}':
+        return spans, decoded
+    while True:
+        if data[pos:pos + 1] != b'"':
+            raise ValueError("Invalid JSON object key at %d" % pos)
+        key, end = _scan_string(data, pos)
+        if key is None:
+            key = json.loads(data[pos:end].decode('utf8'))
+        pos = _whitespace_re.match(data, end).end()
+        if data[pos:pos + 1] != b':':
+            raise ValueError("':' expected at %d" % pos)
+        start = _whitespace_re.match(data, pos + 1).end()
+        first = data[start:start + 1]
+        if first == b'"':
+            value, end = _scan_string(data, start)
+            if value is not None:
+                decoded[key] = value
+            else:
+                decoded.pop(key, None)
+        elif first in (b'{', b'['):
+            end = _container_end(data, start)
+            decoded.pop(key, None)
+        else:
+            m = _scalar_end_re.search(data, start)
+            if m is None or m.start() == start:
+                raise ValueError("Invalid value at %d" % start)
+            end = m.start()
+            decoded.pop(key, None)
+        spans[key] = (start, end)
+        pos = _whitespace_re.match(data, end).end()
+        delimiter = data[pos:pos + 1]
+        if delimiter == b'}':
+            return spans, decoded
+        if delimiter != b',':
+            raise ValueError("',' or '}' expected at %d" % pos)
+        pos = _whitespace_re.match(data, pos + 1).end()
+
+
+def _scan_string(data, pos):
+    """
+    Return ``(value, end)`` for a JSON string which starts at ``pos``.
+    ``value`` is None if the string was skipped without decoding.
+    """
+    end = data.find(b'"', pos + 1)
+    if end == -1:
+        raise ValueError("Unterminated string at %d" % pos)
+    if data[end - 1] != _BACKSLASH:
+        return None, end + 1
+    end = _string_end(data, pos)
+    return json.loads(data[pos:end]), end
+
+
+def _string_end(data, pos):
+    """ Return the end of JSON string which starts at ``pos`` """
+    m = _string_end_re.search(data, pos + 1)
+    if m is None:
+        raise ValueError("Unterminated string at %d" % pos)
+    return m.end()
+
+
+def _container_end(data, pos):
+    """
+    Return the end of JSON object or array which starts at ``pos``.
+    Only brackets outside of strings are checked, values between them
+    are not validated.
+    """
+    expected = []
+    m = _token_re.search(data, pos)
+    while m is not None:
+        char = data[m.start()]
+        end = m.end()
+        if char == _QUOTE:
+            if end - m.start() == 1:
+                end = _string_end(data, m.start())
+        elif char in _closing:
+            expected.append(_closing[char])
+        elif not expected or expected.pop() != char:
+            raise ValueError("Unexpected %r at %d" % (chr(char), m.start()))
+        elif not expected:
+            return end
+        m = _token_re.search(data, end)
+    raise ValueError("Unterminated value at %d" % pos)
+
+
+class LazyJsonObject(Mapping):
+    """
+    Read-only mapping with data of a top-level JSON object.
+    Most values are decoded only when they are accessed for the first time,
+    so large values which are never used (e.g. base64-encoded 'png' field
+    of Splash results) are never parsed, and large values which had to
+    be parsed to find their end (e.g. 'har') are not kept in memory.
+    """
+    def __init__(self, data, codec=default_codec):
+        self._data = data
+        self._spans, self._values = index_json_object(data)
+        self._codec = codec
+
+    def raw(self, key):
+        """ Return undecoded JSON of a value as a memoryview """
+        start, end = self._spans[key]
+        return memoryview(self._data)[start:end]
+
+    def raw_string(self, key):
+        """
+        Return contents of a string value as a memoryview, without decoding
+        it. None is returned if the value is not a string or if it contains
+        escape sequences.
+        """
+        start, end = self._spans[key]
+        if self._data[start:start + 1] != b'"':
+            return None
+        if self._data.find(b'\\', start, end) != -1:
+            return None
+        return memoryview(self._data)[start + 1:end - 1]
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            start, end = self._spans[key]
+            self._values[key] = self._codec.loads(self._data[start:end])
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._spans
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __repr__(self):
+        return "<LazyJsonObject keys=%r>" % list(self._spans)
@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-import copy
-import json
 import logging
+import os
 import warnings
-from collections import defaultdict
+from weakref import WeakKeyDictionary
 
-from six.moves.urllib.parse import urljoin
-from six.moves.http_cookiejar import CookieJar
+from six.moves.urllib.parse import urljoin, urlparse
 
+from twisted.internet import defer, reactor, task
 from w3lib.http import basic_auth_header
 import scrapy
 from scrapy.exceptions import NotConfigured, IgnoreRequest
@@ -17,15 +16,27 @@ from scrapy.http.headers import Headers
 from scrapy.http.response.text import TextResponse
 from scrapy import signals
 from scrapy.downloadermiddlewares.robotstxt import RobotsTxtMiddleware
+from scrapy.utils.job import job_dir
 
 from scrapy_splash.responsetypes import responsetypes
 from scrapy_splash.cookies import jar_to_har, har_to_jar
+from scrapy_splash.jarstore import MemoryJarStore, get_jar_store
 from scrapy_splash.utils import (
     scrapy_headers_to_unicode_dict,
-    json_based_hash,
     parse_x_splash_saved_arguments_header,
+    JsonHashCache,
+    get_hash_cache,
 )
 from scrapy_splash.response import get_splash_status, get_splash_headers
+from scrapy_splash.pool import SplashInstancePool, AIMDController
+from scrapy_splash.batch import SplashBatcher
+from scrapy_splash.jsoncodec import get_json_codec, default_codec
+from scrapy_splash.argstore import (
+    RemoteKeyStore,
+    MemoryArgumentStore,
+    get_argument_store,
+    ensure_argument_store,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -35,8 +46,9 @@ class SlotPolicy(object):
     PER_DOMAIN = 'per_domain'
     SINGLE_SLOT = 'single_slot'
     SCRAPY_DEFAULT = 'scrapy_default'
+    PER_SPLASH_INSTANCE = 'per_splash_instance'
 
-    _known = {PER_DOMAIN, SINGLE_SLOT, SCRAPY_DEFAULT}
+    _known = {PER_DOMAIN, SINGLE_SLOT, SCRAPY_DEFAULT, PER_SPLASH_INSTANCE}
 
 
 class SplashCookiesMiddleware(object):
@@ -50,13 +62,63 @@ class SplashCookiesMiddleware(object):
     It should process requests before SplashMiddleware, and process responses
     after SplashMiddleware.
     """
-    def __init__(self, debug=False):
-        self.jars = defaultdict(CookieJar)
+    def __init__(self, debug=False, url_scoped=False, related_domains=None,
+                 jars=None, sweep_interval=0, stats=None, cache_args=False,
+                 store_factory=MemoryArgumentStore, hash_cache=None):
+        self.jars = jars if jars is not None else MemoryJarStore()
         self.debug = debug
+        self.url_scoped = url_scoped
+        self.related_domains = related_domains or {}
+        self.sweep_interval = sweep_interval
+        self.stats = stats
+        self.cache_args = cache_args
+        self.store_factory = store_factory
+        self.hash_cache = (hash_cache if hash_cache is not None
+                           else JsonHashCache())
+        self._sweep_task = None
+        self._cookie_fingerprints = WeakKeyDictionary()
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(debug=crawler.settings.getbool('SPLASH_COOKIES_DEBUG'))
+        mw = cls(
+            debug=crawler.settings.getbool('SPLASH_COOKIES_DEBUG'),
+            url_scoped=crawler.settings.getbool('SPLASH_COOKIES_URL_SCOPED'),
+            related_domains=crawler.settings.getdict(
+                'SPLASH_COOKIES_RELATED_DOMAINS'),
+            jars=get_jar_store(crawler.settings),
+            sweep_interval=crawler.settings.getfloat(
+                'SPLASH_COOKIES_SWEEP_INTERVAL', 60),
+            stats=crawler.stats,
+            cache_args=crawler.settings.getbool('SPLASH_COOKIES_CACHE_ARGS'),
+            store_factory=lambda: get_argument_store(crawler.settings),
+            hash_cache=get_hash_cache(crawler),
+        )
+        crawler.signals.connect(mw.spider_opened, signals.spider_opened)
+        crawler.signals.connect(mw.spider_closed, signals.spider_closed)
+        return mw
+
+    def spider_opened(self, spider):
+        if self.sweep_interval:
+            self._sweep_task = task.LoopingCall(self.sweep)
+            self._sweep_task.start(self.sweep_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self._sweep_task is not None and self._sweep_task.running:
+            self._sweep_task.stop()
+        self._sweep_task = None
+        self.jars.close()
+
+    def sweep(self):
+        """
+        Drop idle session jars, remove expired cookies
+        and update cookie stats.
+        """
+        cookie_count = self.jars.sweep()
+        if self.stats is not None:
+            self.stats.set_value('splash/cookies/jar_count', len(self.jars))
+            self.stats.set_value('splash/cookies/cookie_count', cookie_count)
+            self.stats.set_value('splash/cookies/evicted_jar_count',
+                                 self.jars.evicted_count)
 
     def process_request(self, request, spider):
         """
@@ -80,13 +142,22 @@ class SplashCookiesMiddleware(object):
         if 'session_id' not in splash_options:
             return
 
-        jar = self.jars[splash_options['session_id']]
+        session_id = splash_options['session_id']
+        jar = self.jars[session_id]
 
         cookies = self._get_request_cookies(request)
-        har_to_jar(jar, cookies)
-
-        splash_args['cookies'] = jar_to_har(jar)
-        self._debug_cookie(request, spider)
+        if cookies:
+            har_to_jar(jar, cookies)
+            self.jars.save(session_id)
+
+        cookies = jar_to_har(jar, self._cookie_hosts(request))
+        if cookies and (self.cache_args or
+                        'cookies' in splash_options.get('cache_args', [])):
+            splash_args['cookies'] = self._replace_cookies(
+                request, spider, jar, cookies)
+        else:
+            splash_args['cookies'] = cookies
+        self._debug_cookie(request, cookies, spider)
 
     def process_response(self, request, response, spider):
         """
@@ -114,12 +185,60 @@ class SplashCookiesMiddleware(object):
             return response
 
         jar = self.jars[session_id]
-        request_cookies = splash_options['args'].get('cookies', [])
-        har_to_jar(jar, response.data['cookies'], request_cookies)
+        # cookies sent using save_args / load_args are not in args
+        sent_cookies = request.meta.get('_splash_sent_cookies')
+        if sent_cookies is None:
+            sent_cookies = splash_options['args'].get('cookies', [])
+        har_to_jar(jar, response.data['cookies'], sent_cookies)
+        self.jars.save(session_id)
         self._debug_set_cookie(response, spider)
         response.cookiejar = jar
         return response
 
+    def _replace_cookies(self, request, spider, jar, cookies):
+        """
+        Store cookies in the argument store and return their fingerprint,
+        so that SplashMiddleware can send them to Splash using
+        ``save_args`` / ``load_args``, like ``cache_args`` values.
+        """
+        key = (jar.version, self._cookie_hosts(request))
+        cached = self._cookie_fingerprints.get(jar)
+        if cached is not None and cached[0] == key:
+            fp = cached[1]
+        else:
+            fp = 'LOCAL+' + self.hash_cache.get_hash(cookies)
+            self._cookie_fingerprints[jar] = (key, fp)
+        # The reference is released by SplashMiddleware.
+        self._get_store(spider).add(fp, cookies)
+        splash_options = request.meta['splash']
+        splash_options.setdefault('_replaced_args', []).append('cookies')
+        # Sent cookies are needed to find cookies removed by the page;
+        # they are kept in meta, so that retried copies of the request
+        # (e.g. by RetryMiddleware) have them as well.
+        request.meta['_splash_sent_cookies'] = cookies
+        return fp
+
+    def _get_store(self, spider):
+        return ensure_argument_store(
+            spider, SplashDeduplicateArgsMiddleware.local_values_key,
+            self.store_factory)
+
+    def _cookie_hosts(self, request):
+        """
+        Return hosts cookies should be sent for, or None to send all cookies.
+        """
+        if not self.url_scoped:
+            return None
+        url = request.meta['splash']['args'].get('url')
+        host = urlparse(url).hostname if url else None
+        if not host:
+            return None
+        hosts = [host]
+        for domain, related in self.related_domains.items():
+            if host == domain or host.endswith('.' + domain):
+                hosts.extend(related)
+        return hosts
+
     def _get_request_cookies(self, request):
         if isinstance(request.cookies, dict):
             return [
@@ -127,9 +246,8 @@ class SplashCookiesMiddleware(object):
             ]
         return request.cookies or []
 
-    def _debug_cookie(self, request, spider):
+    def _debug_cookie(self, request, cl, spider):
         if self.debug:
-            cl = request.meta['splash']['args']['cookies']
             if cl:
                 cookies = '\n'.join(
                     'Cookie: {}'.format(self._har_repr(c)) for c in cl)
@@ -158,6 +276,16 @@ class SplashDeduplicateArgsMiddleware(object):
     """
     local_values_key = '_splash_local_values'
 
+    def __init__(self, store_factory=MemoryArgumentStore, hash_cache=None):
+        self.store_factory = store_factory
+        self.hash_cache = (hash_cache if hash_cache is not None
+                           else JsonHashCache())
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(lambda: get_argument_store(crawler.settings),
+                   get_hash_cache(crawler))
+
     def process_spider_output(self, response, result, spider):
         for el in result:
             if isinstance(el, scrapy.Request):
@@ -166,9 +294,7 @@ class SplashDeduplicateArgsMiddleware(object):
                 yield el
 
     def process_start_requests(self, start_requests, spider):
-        if not hasattr(spider, 'state'):
-            spider.state = {}
-        spider.state.setdefault(self.local_values_key, {})  # fingerprint => value dict
+        self._get_store(spider)  # fingerprint => value mapping
 
         for req in start_requests:
             yield self._process_request(req, spider)
@@ -198,13 +324,33 @@ class SplashDeduplicateArgsMiddleware(object):
             if name not in args:
                 continue
             value = args[name]
-            fp = 'LOCAL+' + json_based_hash(value)
-            spider.state[self.local_values_key][fp] = value
+            fp = 'LOCAL+' + self.hash_cache.get_hash(value)
+            # the reference is released by SplashMiddleware
+            self._get_store(spider).add(fp, value)
             args[name] = fp
             request.meta['splash']['_replaced_args'].append(name)
 
         return request
 
+    def _get_store(self, spider):
+        return ensure_argument_store(spider, self.local_values_key,
+                                     self.store_factory)
+
+
+def _replace_response(response, cls, **kwargs):
+    """
+    Same as ``response.replace(cls=cls, **kwargs)``, but attributes given
+    in kwargs are not read from the response (Response.replace reads all
+    of them, and TextResponse.encoding may decode the whole body).
+    """
+    attributes = getattr(response, 'attributes', None)
+    if attributes is None:  # Scrapy < 2.6
+        return response.replace(cls=cls, **kwargs)
+    for name in attributes:
+        if name not in kwargs:
+            kwargs[name] = getattr(response, name)
+    return cls(**kwargs)
+
 
 class SplashMiddleware(object):
     """
@@ -223,14 +369,52 @@ class SplashMiddleware(object):
     rescheduling_priority_adjust = +100
     retry_498_priority_adjust = +50
     remote_keys_key = '_splash_remote_keys'
-
-    def __init__(self, crawler, splash_base_url, slot_policy, log_400, auth):
+    remote_keys_filename = 'splash_remote_keys.jl'
+    prewarm_lua_source = 'function main(splash) return {} end'
+
+    def __init__(self, crawler, splash_base_url, slot_policy, log_400, auth,
+                 splash_urls=None, concurrency_controller=None,
+                 json_codec=None, lazy_json=False, spill_threshold=0,
+                 remote_key_store=None, prewarm_args=None,
+                 prewarm_spider_attributes=None, save_args_wait_timeout=0,
+                 batch_size=10, batch_window=0.2, coalesce_renders=False,
+                 max_timeout=90, coalesce_timeout=180):
         self.crawler = crawler
         self.splash_base_url = splash_base_url
         self.slot_policy = slot_policy
         self.log_400 = log_400
         self.crawler.signals.connect(self.spider_opened, signals.spider_opened)
+        self.crawler.signals.connect(self.request_dropped,
+                                     signals.request_dropped)
+        self.crawler.signals.connect(self.response_received,
+                                     signals.response_received)
         self.auth = auth
+        self.pool = SplashInstancePool(splash_urls or [splash_base_url])
+        self.concurrency_controller = concurrency_controller
+        self.json_codec = json_codec or default_codec
+        self.hash_cache = get_hash_cache(crawler)
+        self.lazy_json = lazy_json
+        self.spill_threshold = spill_threshold
+        self.remote_key_store = remote_key_store
+        self.prewarm_args = prewarm_args or []
+        self.prewarm_spider_attributes = prewarm_spider_attributes or []
+        self.save_args_wait_timeout = save_args_wait_timeout
+        self.clock = reactor
+        # (Splash URL, local fingerprint) => Deferreds of waiting requests
+        self._uploads = {}
+        self.coalesce_renders = coalesce_renders
+        self.coalesce_timeout = coalesce_timeout
+        # request fingerprint => Deferreds of requests waiting for the render
+        self._renders = {}
+        self.batcher = None
+        if batch_size > 1:
+            self.batcher = SplashBatcher(
+                lambda request: self.crawler.engine.download(request),
+                self.json_codec, batch_size, batch_window, crawler.stats,
+                max_timeout=max_timeout)
+        if remote_key_store is not None:
+            self.crawler.signals.connect(self.spider_closed,
+                                         signals.spider_closed)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -246,7 +430,45 @@ class SplashMiddleware(object):
         auth = None
         if splash_user or splash_pass:
             auth = basic_auth_header(splash_user, splash_pass)
-        return cls(crawler, splash_base_url, slot_policy, log_400, auth)
+        splash_urls = s.getlist('SPLASH_URLS')
+
+        concurrency_controller = None
+        if s.getbool('SPLASH_ADAPTIVE_CONCURRENCY'):
+            concurrency_controller = AIMDController(
+                min_concurrency=s.getint('SPLASH_ADAPTIVE_CONCURRENCY_MIN', 1),
+                max_concurrency=s.getint('SPLASH_ADAPTIVE_CONCURRENCY_MAX',
+                                         s.getint('CONCURRENT_REQUESTS')),
+                start_concurrency=s.getint('CONCURRENT_REQUESTS_PER_DOMAIN'),
+            )
+        json_codec = get_json_codec(s.get('SPLASH_JSON_CODEC', 'json'))
+        lazy_json = s.getbool('SPLASH_LAZY_JSON')
+        spill_threshold = s.getint('SPLASH_SPILL_THRESHOLD', 0)
+
+        remote_key_store = None
+        remote_keys_path = s.get('SPLASH_REMOTE_KEYS_PATH')
+        if not remote_keys_path and job_dir(s):
+            remote_keys_path = os.path.join(job_dir(s),
+                                            cls.remote_keys_filename)
+        if remote_keys_path:
+            remote_key_store = RemoteKeyStore(remote_keys_path)
+
+        prewarm_args = s.get('SPLASH_PREWARM_ARGS') or []
+        if not isinstance(prewarm_args, (list, tuple)):
+            prewarm_args = [prewarm_args]
+        prewarm_spider_attributes = s.getlist('SPLASH_PREWARM_SPIDER_ATTRIBUTES')
+        save_args_wait_timeout = s.getfloat('SPLASH_SAVE_ARGS_WAIT_TIMEOUT', 0)
+        batch_size = s.getint('SPLASH_BATCH_SIZE', 10)
+        batch_window = s.getfloat('SPLASH_BATCH_WINDOW', 0.2)
+        coalesce_renders = s.getbool('SPLASH_COALESCE_RENDERS')
+        max_timeout = s.getfloat('SPLASH_MAX_TIMEOUT', 90)
+        coalesce_timeout = s.getfloat('SPLASH_COALESCE_RENDERS_TIMEOUT',
+                                      s.getfloat('DOWNLOAD_TIMEOUT', 180))
+        return cls(crawler, splash_base_url, slot_policy, log_400, auth,
+                   splash_urls, concurrency_controller, json_codec, lazy_json,
+                   spill_threshold, remote_key_store, prewarm_args,
+                   prewarm_spider_attributes, save_args_wait_timeout,
+                   batch_size, batch_window, coalesce_renders, max_timeout,
+                   coalesce_timeout)
 
     def spider_opened(self, spider):
         if _http_auth_enabled(spider):
@@ -255,13 +477,111 @@ class SplashMiddleware(object):
         if not hasattr(spider, 'state'):
             spider.state = {}
 
-        # local fingerprint => key returned by splash
-        spider.state.setdefault(self.remote_keys_key, {})
+        # Splash URL => {local fingerprint => key returned by splash}
+        remote_keys = spider.state.setdefault(self.remote_keys_key, {})
+        legacy_keys = {fp: key for fp, key in remote_keys.items()
+                       if not isinstance(key, dict)}
+        if legacy_keys:
+            # state from an older version: keys are saved on SPLASH_URL
+            for fp in legacy_keys:
+                del remote_keys[fp]
+            remote_keys.setdefault(self.splash_base_url, {}).update(legacy_keys)
+
+        if self.remote_key_store is not None:
+            self.remote_key_store.open()
+            self.crawler.stats.set_value('splash/remote_keys/loaded',
+                                         len(self.remote_key_store))
+
+        return self._prewarm(spider)
+
+    def _prewarm(self, spider):
+        """
+        Save static argument values (SPLASH_PREWARM_ARGS and
+        SPLASH_PREWARM_SPIDER_ATTRIBUTES) on all Splash instances before
+        the crawl starts, so that requests can use ``load_args`` right away.
+        """
+        values = list(self.prewarm_args)
+        for attr in self.prewarm_spider_attributes:
+            if getattr(spider, attr, None) is not None:
+                values.append(getattr(spider, attr))
+        if not values:
+            return
+
+        fingerprints = {}
+        for value in values:
+            fp = 'LOCAL+' + self.hash_cache.get_hash(value)
+            # static values are referenced until the spider is closed
+            self._argument_values.add(fp, value)
+            fingerprints[fp] = value
+
+        requests = []
+        for splash_url in self.pool.urls:
+            args = {}
+            for fp in fingerprints:
+                if self._get_remote_key(splash_url, fp) is None:
+                    args['prewarm_%d' % len(args)] = fp
+            if not args:
+                continue
+            args['lua_source'] = self.prewarm_lua_source
+            # the request holds its own references, like requests
+            # processed by SplashDeduplicateArgsMiddleware
+            for name in args:
+                if name != 'lua_source':
+                    self._argument_values.add(args[name],
+                                              fingerprints[args[name]])
+            requests.append(scrapy.Request('about:blank', dont_filter=True, meta={
+                'splash': {
+                    'endpoint': 'execute',
+                    'splash_url': splash_url,
+                    'args': args,
+                    '_replaced_args': sorted(set(args) - {'lua_source'}),
+                    'dont_process_response': True,
+                },
+                'dont_cache': True,
+            }))
+
+        downloads = []
+        for request in requests:
+            d = self.crawler.engine.download(request)
+            d.addCallbacks(self._prewarm_done, self._prewarm_failed,
+                           callbackArgs=(request, spider),
+                           errbackArgs=(request, spider))
+            downloads.append(d)
+        return defer.DeferredList(downloads)
+
+    def _prewarm_done(self, response, request, spider):
+        self.crawler.stats.inc_value('splash/prewarm/response_count/%s' %
+                                     response.status)
+
+    def _prewarm_failed(self, failure, request, spider):
+        logger.warning("Error saving arguments on Splash %(splash_url)s: "
+                       "%(error)s", {
+                           'splash_url': request.meta['splash']['splash_url'],
+                           'error': failure.getErrorMessage(),
+                       }, extra={'spider': spider})
+        self.crawler.stats.inc_value('splash/prewarm/error_count')
+
+    def spider_closed(self, spider):
+        self.remote_key_store.close()
+
+    def request_dropped(self, request, spider):
+        self._unqueue(request)
+        self._finish_tracking(request)
+        self._finish_render(request)
+        self._finish_uploads(request)
+        self._release_argument_values(request)
+
+    def response_received(self, response, request, spider):
+        # The response is not retried by downloader middlewares anymore.
+        self._release_argument_values(request)
 
     @property
     def _argument_values(self):
-        key = SplashDeduplicateArgsMiddleware.local_values_key
-        return self.crawler.spider.state[key]
+        return ensure_argument_store(
+            self.crawler.spider,
+            SplashDeduplicateArgsMiddleware.local_values_key,
+            lambda: get_argument_store(self.crawler.settings)
+        )
 
     @property
     def _remote_keys(self):
@@ -284,14 +604,43 @@ class SplashMiddleware(object):
             raise IgnoreRequest("SplashRequest doesn't support "
                                 "HTTP {} method".format(request.method))
 
+        self._acquire_argument_values(request, spider)
+
         if request.meta.get("_splash_processed"):
             # don't process the same request more than once
+            self._unqueue(request)
+            if self._has_expired_load_args(request):
+                # Saved arguments expired while the request was waiting
+                # in the queue; don't wait for HTTP 498.
+                new_request = self._save_args_request(request)
+                if new_request is not None:
+                    self.crawler.stats.inc_value(
+                        'splash/load_args/expired_count')
+                    return new_request
+            if self.coalesce_renders:
+                d = self._wait_for_render(request, spider)
+                if d is not None:
+                    return d
+            self._start_tracking(request)
+            self._apply_concurrency_limit(request)
+            # Batched requests don't occupy the download slot of the
+            # instance, so its adaptive concurrency limit wouldn't apply.
+            if (self.batcher is not None
+                    and self.batcher.is_batchable(request)
+                    and not self._uses_instance_slot(request)):
+                return self.batcher.add(request)
             return
 
+        instance = self._get_instance(request)
+        if self.save_args_wait_timeout and '_replaced_args' in splash_options:
+            d = self._wait_for_upload(request, instance, spider)
+            if d is not None:
+                return d
+
         request.meta['_splash_processed'] = True
 
         slot_policy = splash_options.get('slot_policy', self.slot_policy)
-        self._set_download_slot(request, request.meta, slot_policy)
+        self._set_download_slot(request, request.meta, slot_policy, instance)
 
         args = splash_options.setdefault('args', {})
 
@@ -306,17 +655,24 @@ class SplashMiddleware(object):
                 # for a value is known then don't send the value to Splash;
                 # if it is unknown then try to save the value on server using
                 # ``save_args``.
-                if fp in self._remote_keys:
-                    load_args[name] = self._remote_keys[fp]
+                key = self._get_remote_key(instance.url, fp)
+                if key is not None:
+                    load_args[name] = key
                     del args[name]
+                    self.crawler.stats.inc_value(
+                        'splash/instance/%s/remote_keys/hit' % instance.url)
                 else:
                     save_args.append(name)
+                    self.crawler.stats.inc_value(
+                        'splash/instance/%s/remote_keys/miss' % instance.url)
                     args[name] = self._argument_values[fp]
+                    self._start_upload(request, instance, fp)
 
                 local_arg_fingerprints[name] = fp
 
             if load_args:
                 args['load_args'] = load_args
+                request.meta['_splash_epoch'] = instance.epoch
             if save_args:
                 args['save_args'] = save_args
             splash_options['_local_arg_fingerprints'] = local_arg_fingerprints
@@ -338,8 +694,7 @@ class SplashMiddleware(object):
                     headers.pop('Authorization', None)
                 args.setdefault('headers', headers)
 
-        body = json.dumps(args, ensure_ascii=False, sort_keys=True, indent=4)
-        # print(body)
+        body = self.json_codec.dumps(args)
 
         if 'timeout' in args:
             # User requested a Splash timeout explicitly.
@@ -366,8 +721,7 @@ class SplashMiddleware(object):
                 request.meta['download_timeout'] = timeout_expected
 
         endpoint = splash_options.setdefault('endpoint', self.default_endpoint)
-        splash_base_url = splash_options.get('splash_url', self.splash_base_url)
-        splash_url = urljoin(splash_base_url, endpoint)
+        splash_url = urljoin(instance.url, endpoint)
 
         headers = Headers({'Content-Type': 'application/json'})
         if self.auth is not None:
@@ -381,6 +735,8 @@ class SplashMiddleware(object):
             priority=request.priority + self.rescheduling_priority_adjust
         )
         new_request.meta['dont_obey_robotstxt'] = True
+        new_request.meta['_splash_url'] = instance.url
+        instance.queued.add(new_request)
         self.crawler.stats.inc_value('splash/%s/request_count' % endpoint)
         return new_request
 
@@ -388,6 +744,12 @@ class SplashMiddleware(object):
         if not request.meta.get("_splash_processed"):
             return response
 
+        # requests which got a response of another request (see
+        # SPLASH_COALESCE_RENDERS) were not sent to Splash
+        if self._finish_tracking(request, response):
+            self._update_concurrency_limit(request, response)
+        self._finish_render(request, response)
+
         splash_options = request.meta['splash']
         if not splash_options:
             return response
@@ -400,11 +762,15 @@ class SplashMiddleware(object):
 
         # handle save_args/load_args
         self._process_x_splash_saved_arguments(request, response)
+        self._finish_uploads(request)
         if get_splash_status(response) == 498:
             logger.debug("Got HTTP 498 response for {}; "
                          "sending arguments again.".format(request),
                          extra={'spider': spider})
-            return self._498_retry_request(request, response)
+            self._expire_saved_arguments(request)
+            retry_request = self._498_retry_request(request, response)
+            if retry_request is not None:
+                return retry_request
 
         if splash_options.get('dont_process_response', False):
             return response
@@ -416,8 +782,288 @@ class SplashMiddleware(object):
 
         return response
 
+    def process_exception(self, request, exception, spider):
+        if request.meta.get("_splash_processed"):
+            if self._finish_tracking(request):
+                self._update_concurrency_limit(request)
+            self._finish_render(request)
+            self._finish_uploads(request)
+        # e.g. IgnoreRequest raised by RobotsTxtMiddleware; if the request
+        # is retried, references are taken again by process_request
+        self._release_argument_values(request)
+
+    def _argument_fingerprints(self, request):
+        splash_options = request.meta.get('splash')
+        if not splash_options:
+            return []
+        if '_replaced_args' in splash_options:
+            args = splash_options.get('args', {})
+            return [args[name] for name in splash_options['_replaced_args']
+                    if name in args]
+        return list(splash_options.get('_local_arg_fingerprints', {}).values())
+
+    def _release_argument_values(self, request):
+        """
+        Release references to argument values held by the request, taken
+        by SplashDeduplicateArgsMiddleware.
+        """
+        if request.meta.get('_splash_args_released'):
+            return
+        fingerprints = self._argument_fingerprints(request)
+        if not fingerprints:
+            return
+        request.meta['_splash_args_released'] = True
+        for fp in fingerprints:
+            self._argument_values.release(fp)
+
+    def _acquire_argument_values(self, request, spider):
+        """
+        Take references to argument values again for a request which is
+        retried after they were released (e.g. by RetryMiddleware after
+        a download error).
+        """
+        if not request.meta.get('_splash_args_released'):
+            return
+        fingerprints = self._argument_fingerprints(request)
+        store = self._argument_values
+        if not all(fp in store for fp in fingerprints):
+            # Unreferenced values were dropped from the argument store
+            # while the request was waiting for a retry.
+            self.crawler.stats.inc_value('splash/args/missing_value_count')
+            if request.meta.get('_splash_processed'):
+                # load_args may still work; see _save_args_request
+                return
+            logger.error("Splash argument values of %(request)s are not "
+                         "available anymore; the request is dropped",
+                         {'request': request}, extra={'spider': spider})
+            raise IgnoreRequest("Splash argument values are not available")
+        del request.meta['_splash_args_released']
+        for fp in fingerprints:
+            store.add(fp, store[fp])
+
+    def _get_remote_key(self, splash_url, fp):
+        """
+        Return Splash key of an argument value with local fingerprint ``fp``,
+        or None if the value is not known to be saved on the Splash server.
+        """
+        remote_keys = self._remote_keys.get(splash_url, {})
+        if fp in remote_keys:
+            return remote_keys[fp]
+        if self.remote_key_store is not None:
+            key = self.remote_key_store.get(splash_url, fp)
+            if key is not None:
+                self._remote_keys.setdefault(splash_url, {})[fp] = key
+                self.crawler.stats.inc_value('splash/remote_keys/reused')
+            return key
+
+    def _get_instance(self, request):
+        """
+        Return SplashInstance to send the request to: either the one
+        requested explicitly, the one picked before the request had to wait,
+        or the least loaded instance from the pool.
+        """
+        splash_options = request.meta['splash']
+        if 'splash_url' in splash_options:
+            return self.pool.get(splash_options['splash_url'])
+        if '_splash_url' in request.meta:
+            return self.pool.get(request.meta['_splash_url'])
+        return self.pool.pick()
+
+    def _wait_for_upload(self, request, instance, spider):
+        """
+        If another request is saving one of the request arguments on the
+        Splash instance, return a Deferred which processes the request again
+        when that request finishes or SPLASH_SAVE_ARGS_WAIT_TIMEOUT expires,
+        so that it can use ``load_args`` instead of uploading the value again.
+        """
+        if request.meta.get('_splash_upload_wait_expired'):
+            return
+        args = request.meta['splash'].get('args', {})
+        for name in request.meta['splash']['_replaced_args']:
+            fp = args[name]
+            waiters = self._uploads.get((instance.url, fp))
+            if waiters is None or self._get_remote_key(instance.url, fp):
+                continue
+            request.meta['_splash_url'] = instance.url
+            d = defer.Deferred()
+            waiters.append(d)
+
+            def on_timeout(result, timeout):
+                # the request uploads the value itself
+                request.meta['_splash_upload_wait_expired'] = True
+                self.crawler.stats.inc_value(
+                    'splash/save_args/wait_timeout_count')
+
+            d.addTimeout(self.save_args_wait_timeout, self.clock,
+                         onTimeoutCancel=on_timeout)
+            d.addCallback(lambda _: self.process_request(request, spider))
+            self.crawler.stats.inc_value('splash/save_args/wait_count')
+            return d
+
+    def _wait_for_render(self, request, spider):
+        """
+        If an identical render is in progress, return a Deferred which
+        is fired with a copy of its response. Otherwise register
+        the request as the one other identical requests should wait for.
+        When waiting takes longer than SPLASH_COALESCE_RENDERS_TIMEOUT
+        (e.g. the request which was registered is dropped), waiting requests
+        are processed again, and one of them takes its place.
+        """
+        key = self.crawler.request_fingerprinter.fingerprint(request)
+        if request.meta.get('_splash_render_key') == key:
+            # e.g. another middleware sent the request back to the scheduler
+            return
+        if key not in self._renders:
+            self._renders[key] = []
+            request.meta['_splash_render_key'] = key
+            return
+        waiters = self._renders[key]
+        d = defer.Deferred()
+        waiters.append(d)
+
+        def on_timeout(result, timeout):
+            self.crawler.stats.inc_value(
+                'splash/coalesced/wait_timeout_count')
+            if self._renders.get(key) is waiters:
+                del self._renders[key]
+                for other in waiters:
+                    if not other.called:
+                        other.callback(None)
+
+        if self.coalesce_timeout:
+            d.addTimeout(self.coalesce_timeout, self.clock,
+                         onTimeoutCancel=on_timeout)
+        # When there is no response to share, process the request again:
+        # it may need to be changed (e.g. to save_args), and it may become
+        # the request other requests wait for.
+        d.addCallback(lambda response: response if response is not None
+                      else self.process_request(request, spider))
+        self.crawler.stats.inc_value('splash/coalesced/request_count')
+        return d
+
+    def _finish_render(self, request, response=None):
+        """ Pass the response to requests waiting for the same render """
+        key = request.meta.pop('_splash_render_key', None)
+        if key is None:
+            return
+        if response is not None and get_splash_status(response) == 498:
+            # arguments are sent again by the retry request
+            response = None
+        for d in self._renders.pop(key, []):
+            if not d.called:
+                d.callback(self._shared_response(response)
+                           if response is not None else None)
+
+    def _shared_response(self, response):
+        """
+        Return a copy of the response for a request which waited for it.
+        Arguments saved by Splash are not reported: the request may be
+        routed to another Splash instance than the one which saved them.
+        """
+        headers = response.headers.copy()
+        headers.pop(b'X-Splash-Saved-Arguments', None)
+        kwargs = {'headers': headers}
+        if hasattr(response, 'splash_response_headers'):
+            kwargs['splash_response_headers'] = splash_headers = \
+                response.splash_response_headers.copy()
+            splash_headers.pop(b'X-Splash-Saved-Arguments', None)
+        return response.replace(**kwargs)
+
+    def _start_upload(self, request, instance, fp):
+        """ Make requests which need the same value wait for this one """
+        if not self.save_args_wait_timeout:
+            return
+        if (instance.url, fp) in self._uploads:
+            # waiting for the other request timed out
+            return
+        self._uploads[(instance.url, fp)] = []
+        request.meta.setdefault('_splash_uploads', []).append(fp)
+
+    def _finish_uploads(self, request):
+        """ Resume requests which wait for values saved by the request """
+        for fp in request.meta.pop('_splash_uploads', []):
+            waiters = self._uploads.pop((request.meta['_splash_url'], fp), [])
+            for d in waiters:
+                if not d.called:
+                    d.callback(None)
+
+    def _unqueue(self, request):
+        """ The request is not waiting in the scheduler anymore """
+        url = request.meta.get('_splash_url')
+        if url is not None:
+            self.pool.get(url).queued.discard(request)
+
+    def _start_tracking(self, request):
+        """ Count the request as sent to its Splash instance """
+        url = request.meta.get('_splash_url')
+        if url is None or request.meta.get('_splash_outstanding'):
+            return
+        request.meta['_splash_outstanding'] = True
+        instance = self.pool.get(url)
+        instance.inflight += 1
+        self.crawler.stats.inc_value('splash/instance/%s/request_count' % url)
+        self._update_instance_stats(instance)
+
+    def _finish_tracking(self, request, response=None):
+        """
+        Count the request as finished for its Splash instance.
+        Return False if the request was not counted as sent.
+        """
+        if not request.meta.pop('_splash_outstanding', False):
+            return False
+        instance = self.pool.get(request.meta['_splash_url'])
+        instance.inflight -= 1
+        latency = request.meta.get('download_latency')
+        if (response is not None and latency is not None
+                and get_splash_status(response) < 500):
+            instance.observe_latency(latency)
+        self._update_instance_stats(instance)
+        return True
+
+    def _update_concurrency_limit(self, request, response=None):
+        """ Feed the result of a request to the concurrency controller """
+        if not self._uses_instance_slot(request):
+            return
+        instance = self.pool.get(request.meta['_splash_url'])
+        if response is None:
+            self.concurrency_controller.on_failure(instance)
+        else:
+            status = get_splash_status(response)
+            self.concurrency_controller.on_response(instance, status)
+        self.crawler.stats.set_value(
+            'splash/instance/%s/concurrency' % instance.url,
+            self.concurrency_controller.limit(instance)
+        )
+        self._apply_concurrency_limit(request)
+
+    def _apply_concurrency_limit(self, request):
+        """ Set concurrency of the download slot of a Splash instance """
+        if not self._uses_instance_slot(request):
+            return
+        instance = self.pool.get(request.meta['_splash_url'])
+        slot = self.crawler.engine.downloader.slots.get(
+            request.meta['download_slot'])
+        if slot is not None:
+            slot.concurrency = self.concurrency_controller.limit(instance)
+
+    def _uses_instance_slot(self, request):
+        if self.concurrency_controller is None:
+            return False
+        url = request.meta.get('_splash_url')
+        return (url is not None and
+                request.meta.get('download_slot') == self._instance_slot_key(url))
+
+    def _update_instance_stats(self, instance):
+        stats = self.crawler.stats
+        prefix = 'splash/instance/%s' % instance.url
+        stats.set_value(prefix + '/inflight', instance.inflight)
+        stats.max_value(prefix + '/max_inflight', instance.inflight)
+        if instance.latency is not None:
+            stats.set_value(prefix + '/latency', round(instance.latency, 3))
+
     def _change_response_class(self, request, response):
-        from scrapy_splash import SplashResponse, SplashTextResponse
+        from scrapy_splash import (
+            SplashResponse, SplashTextResponse, SplashJsonResponse)
         if not isinstance(response, (SplashResponse, SplashTextResponse)):
             # create a custom Response subclass based on response Content-Type
             # XXX: usually request is assigned to response only when all
@@ -430,7 +1076,18 @@ class SplashMiddleware(object):
                 # because it was decoded successfully), so we should not
                 # convert it to SplashResponse.
                 respcls = SplashTextResponse
-            response = response.replace(cls=respcls, request=request)
+            # The original response is discarded, so its headers can be kept
+            # as splash_response_headers without copying them.
+            kwargs = dict(request=request,
+                          json_codec=self.json_codec,
+                          lazy_json=self.lazy_json,
+                          spill_threshold=self.spill_threshold,
+                          splash_response_headers=response.headers)
+            if issubclass(respcls, SplashJsonResponse):
+                # SplashJsonResponse is always utf-8; don't let TextResponse
+                # detect encoding of the whole body just to throw it away.
+                kwargs['encoding'] = None
+            response = _replace_response(response, respcls, **kwargs)
         return response
 
     def _log_400(self, request, response, spider):
@@ -449,38 +1106,93 @@ class SplashMiddleware(object):
             return
         saved_args = parse_x_splash_saved_arguments_header(saved_args)
         arg_fingerprints = request.meta['splash']['_local_arg_fingerprints']
+        splash_url = request.meta['_splash_url']
+        remote_keys = self._remote_keys.setdefault(splash_url, {})
         for name, key in saved_args.items():
             fp = arg_fingerprints[name]
-            self._remote_keys[fp] = key
+            remote_keys[fp] = key
+            if self.remote_key_store is not None:
+                self.remote_key_store.set(splash_url, fp, key)
+
+    def _expire_saved_arguments(self, request):
+        """
+        Forget all arguments saved on the Splash instance which returned
+        HTTP 498 for the request: Splash was likely restarted, so the other
+        saved arguments are lost as well. Arguments are forgotten only once
+        per restart, for the first HTTP 498 response to a request sent
+        after the previous one.
+        """
+        instance = self.pool.get(request.meta['_splash_url'])
+        if request.meta.get('_splash_epoch', instance.epoch) < instance.epoch:
+            return
+        instance.epoch += 1
+        self._remote_keys.pop(instance.url, None)
+        if self.remote_key_store is not None:
+            self.remote_key_store.clear(instance.url)
+        self.crawler.stats.inc_value(
+            'splash/instance/%s/args_expired_count' % instance.url)
+
+    def _has_expired_load_args(self, request):
+        epoch = request.meta.get('_splash_epoch')
+        if epoch is None or '_splash_url' not in request.meta:
+            return False
+        if 'load_args' not in request.meta['splash'].get('args', {}):
+            return False
+        return epoch < self.pool.get(request.meta['_splash_url']).epoch
 
     def _498_retry_request(self, request, response):
         """
         Return a retry request for HTTP 498 responses. HTTP 498 means
         load_args are not present on server; client should retry the request
-        with full argument values instead of their hashes.
+        with full argument values instead of their hashes. None is returned
+        when the values are not available anymore.
+        """
+        return self._save_args_request(request, self.retry_498_priority_adjust)
+
+    def _save_args_request(self, request, priority_adjust=0):
         """
-        meta = copy.deepcopy(request.meta)
+        Return a copy of the request which sends full argument values
+        with ``save_args`` instead of ``load_args``, or None if some of
+        the values are not available anymore.
+        """
+        # Copy only the parts which are changed; argument values can be
+        # large, there is no need to deep-copy them.
+        meta = dict(request.meta)
+        meta['splash'] = dict(meta['splash'])
+        meta['splash']['args'] = args = dict(meta['splash']['args'])
+        meta.pop('_splash_epoch', None)
         local_arg_fingerprints = meta['splash']['_local_arg_fingerprints']
-        args = meta['splash']['args']
         args.pop('load_args', None)
+        # values of save_args are already in args
+        sent = set(args.pop('save_args', []))
         args['save_args'] = list(local_arg_fingerprints.keys())
 
         for name, fp in local_arg_fingerprints.items():
+            if name in sent:
+                continue
+            if fp not in self._argument_values:
+                logger.warning("Value of %(name)r Splash argument of "
+                               "%(request)s is not available anymore; "
+                               "it can't be sent again",
+                               {'name': name, 'request': request},
+                               extra={'spider': self.crawler.spider})
+                self.crawler.stats.inc_value('splash/args/missing_value_count')
+                return None
             args[name] = self._argument_values[fp]
-            # print('remote_keys before:', self._remote_keys)
-            self._remote_keys.pop(fp, None)
-            # print('remote_keys after:', self._remote_keys)
 
-        body = json.dumps(args, ensure_ascii=False, sort_keys=True, indent=4)
-        # print(body)
+        body = self.json_codec.dumps(args)
+        # The request is rescheduled; it may have the same fingerprint
+        # as the original one (see SPLASH_FINGERPRINT_EXCLUDE).
         request = request.replace(
             meta=meta,
             body=body,
-            priority=request.priority+self.retry_498_priority_adjust
+            priority=request.priority + priority_adjust,
+            dont_filter=True,
         )
+        self.pool.get(meta['_splash_url']).queued.add(request)
         return request
 
-    def _set_download_slot(self, request, meta, slot_policy):
+    def _set_download_slot(self, request, meta, slot_policy, instance=None):
         if slot_policy == SlotPolicy.PER_DOMAIN:
             # Use the same download slot to (sort of) respect download
             # delays and concurrency options.
@@ -494,6 +1206,16 @@ class SplashMiddleware(object):
             # Use standard Scrapy concurrency setup
             pass
 
+        elif slot_policy == SlotPolicy.PER_SPLASH_INSTANCE:
+            # Use a separate slot for each Splash instance; its concurrency
+            # is adjusted when SPLASH_ADAPTIVE_CONCURRENCY is enabled.
+            url = instance.url if instance is not None else self.splash_base_url
+            meta['download_slot'] = self._instance_slot_key(url)
+
+    @staticmethod
+    def _instance_slot_key(splash_url):
+        return '__splash__%s' % splash_url
+
     def _get_slot_key(self, request_or_response):
         return self.crawler.engine.downloader._get_slot_key(
             request_or_response, None
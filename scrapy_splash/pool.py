@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Book-keeping for a pool of Splash instances used by SplashMiddleware.
+"""
+from __future__ import absolute_import
+import weakref
+from collections import OrderedDict
+
+
+class SplashInstance(object):
+    """
+    State of a single Splash server: number of outstanding requests
+    and a moving average of render latency.
+
+    ``inflight`` counts requests sent to the instance; ``queued`` holds
+    requests routed to it which are still waiting in the scheduler. It is
+    a weak set, so requests which are dropped or stored in a disk queue
+    don't stay counted.
+
+    ``baseline_latency`` is the latency the instance normally has: it drops
+    immediately to a lower smoothed latency, but follows higher latency
+    only slowly (with ``baseline_smoothing``), so that short spikes stand
+    out, while lasting changes (e.g. slower pages later in the crawl)
+    become the new baseline.
+    """
+    latency_smoothing = 0.3
+    baseline_smoothing = 0.02
+
+    def __init__(self, url):
+        self.url = url
+        self.inflight = 0
+        self.queued = weakref.WeakSet()
+        self.latency = None
+        self.baseline_latency = None
+
+        # adaptive concurrency state, see AIMDController
+        self.concurrency = None
+        self.cooldown = 0
+
+        # incremented each time saved arguments are found to be expired,
+        # e.g. because Splash was restarted
+        self.epoch = 0
+
+    def observe_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            a = self.latency_smoothing
+            self.latency = a * latency + (1 - a) * self.latency
+        if (self.baseline_latency is None
+                or self.latency < self.baseline_latency):
+            self.baseline_latency = self.latency
+        else:
+            b = self.baseline_smoothing
+            self.baseline_latency = (b * self.latency
+                                     + (1 - b) * self.baseline_latency)
+
+    def __repr__(self):
+        return "<SplashInstance %s inflight=%d>" % (self.url, self.inflight)
+
+
+class SplashInstancePool(object):
+    """
+    A set of Splash instances requests are distributed between.
+
+    New requests are routed to the instance with the fewest outstanding
+    (sent or queued) requests; ties are broken by the lowest observed
+    latency.
+    Instances which are not a part of the pool (e.g. set explicitly
+    using ``meta['splash']['splash_url']``) are tracked as well,
+    but they are never picked automatically.
+    """
+    def __init__(self, urls):
+        if not urls:
+            raise ValueError("At least one Splash URL is required")
+        self._routable = OrderedDict((url, SplashInstance(url)) for url in urls)
+        self._instances = OrderedDict(self._routable)
+
+    @property
+    def urls(self):
+        return list(self._routable)
+
+    def __iter__(self):
+        return iter(self._instances.values())
+
+    def __len__(self):
+        return len(self._instances)
+
+    def get(self, url):
+        """ Return SplashInstance for the URL, creating it if needed """
+        if url not in self._instances:
+            self._instances[url] = SplashInstance(url)
+        return self._instances[url]
+
+    def pick(self):
+        """ Return the least loaded routable SplashInstance """
+        return min(
+            self._routable.values(),
+            key=lambda inst: (inst.inflight + len(inst.queued),
+                              inst.latency or 0.0)
+        )
+
+
+class AIMDController(object):
+    """
+    Additive-increase/multiplicative-decrease controller of the number
+    of concurrent requests allowed for each Splash instance.
+
+    Allowed concurrency grows by ``increase`` per window of responses
+    (i.e. by ``increase / concurrency`` per response) while the instance
+    is healthy, and it is multiplied by ``decrease_factor`` when Splash
+    is overloaded: it returns HTTP 503 (all render slots are busy) or
+    HTTP 504 (render timeout), a request fails, or smoothed latency
+    becomes ``latency_tolerance`` times higher than the baseline latency
+    of the instance (see SplashInstance). Responses to requests which were already
+    in flight when the limit was decreased don't decrease it again.
+    """
+    increase = 1.0
+    decrease_factor = 0.5
+    latency_tolerance = 2.0
+    overload_statuses = {503, 504}
+
+    def __init__(self, min_concurrency=1, max_concurrency=16,
+                 start_concurrency=None):
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            raise ValueError("Invalid concurrency bounds: %r, %r" % (
+                min_concurrency, max_concurrency))
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        if start_concurrency is None:
+            start_concurrency = min_concurrency
+        self.start_concurrency = self._clip(start_concurrency)
+
+    def limit(self, instance):
+        """ Return the number of concurrent requests allowed for instance """
+        if instance.concurrency is None:
+            instance.concurrency = float(self.start_concurrency)
+        return int(instance.concurrency)
+
+    def on_response(self, instance, status):
+        """ Adjust the limit after a response from the instance """
+        if status in self.overload_statuses or self._latency_increased(instance):
+            self._decrease(instance)
+        else:
+            self._increase(instance)
+
+    def on_failure(self, instance):
+        """ Adjust the limit after a request to the instance failed """
+        self._decrease(instance)
+
+    def _latency_increased(self, instance):
+        if instance.latency is None or not instance.baseline_latency:
+            return False
+        return (instance.latency
+                > instance.baseline_latency * self.latency_tolerance)
+
+    def _increase(self, instance):
+        concurrency = self.limit(instance)
+        if instance.cooldown:
+            instance.cooldown -= 1
+        instance.concurrency = self._clip(
+            instance.concurrency + self.increase / concurrency)
+
+    def _decrease(self, instance):
+        self.limit(instance)
+        if instance.cooldown:
+            instance.cooldown -= 1
+            return
+        instance.concurrency = self._clip(
+            instance.concurrency * self.decrease_factor)
+        instance.cooldown = instance.inflight
+
+    def _clip(self, concurrency):
+        return max(self.min_concurrency, min(self.max_concurrency, concurrency))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import copy
+from weakref import WeakKeyDictionary
+
 import scrapy
 from scrapy.http import FormRequest
 from scrapy.utils.url import canonicalize_url
@@ -45,6 +47,7 @@ class SplashRequest(scrapy.Request):
                  session_id='default',
                  http_status_from_error_code=True,
                  cache_args=None,
+                 batch=False,
                  meta=None,
                  **kwargs):
 
@@ -70,6 +73,8 @@ class SplashRequest(scrapy.Request):
             splash_meta['http_status_from_error_code'] = True
         if cache_args is not None:
             splash_meta['cache_args'] = cache_args
+        if batch:
+            splash_meta['batch'] = True
 
         if session_id is not None:
             if splash_meta['endpoint'].strip('/') == 'execute':
@@ -131,6 +136,15 @@ class SplashFormRequest(SplashRequest, FormRequest):
 
 
 class SplashRequestFingerprinter:
+    """
+    Request fingerprinter which takes 'splash' meta key into account.
+
+    Fingerprints are memoized per request, as the same request is usually
+    fingerprinted several times (by the dupefilter, HTTP cache, etc.).
+    'splash' meta can be changed after a request is created, so a memoized
+    fingerprint is only used while all values in 'splash' meta are the same
+    objects as when it was computed.
+    """
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
@@ -145,18 +159,142 @@ class SplashRequestFingerprinter:
                 ),
                 crawler,
             )
+        self._exclude = [
+            path.split('.') for path in
+            crawler.settings.getlist('SPLASH_FINGERPRINT_EXCLUDE')
+        ]
+        include = crawler.settings.getlist('SPLASH_FINGERPRINT_INCLUDE')
+        self._include = [path.split('.') for path in include] or None
+        self._cache = WeakKeyDictionary()
 
     def fingerprint(self, request):
         """ Request fingerprint which takes 'splash' meta key into account """
 
-        fp = self._base_request_fingerprinter.fingerprint(request)
         if 'splash' not in request.meta:
-            return fp
+            return self._base_request_fingerprinter.fingerprint(request)
 
-        splash_options = copy.deepcopy(request.meta['splash'])
-        args = splash_options.setdefault('args', {})
+        fp = self._base_fingerprint(request)
+        splash_options = request.meta['splash']
+        snapshot = _snapshot(splash_options)
+        cached = self._cache.get(request)
+        if (cached is not None and cached[0] == fp
+                and _same_snapshot(cached[1], snapshot)):
+            return cached[2]
 
+        # only values which are changed are copied
+        if self._include is None and not self._exclude:
+            splash_options = copy.copy(splash_options)
+        else:
+            splash_options = _normalize_options(splash_options)
+            if self._include is not None:
+                splash_options = _include_paths(splash_options,
+                                                self._include)
+            for path in self._exclude:
+                _exclude_path(splash_options, path)
+        args = splash_options['args'] = copy.copy(
+            splash_options.get('args', {}))
         if 'url' in args:
             args['url'] = canonicalize_url(args['url'], keep_fragments=True)
 
-        return dict_hash(splash_options, fp).encode()
+        result = dict_hash(splash_options, fp).encode()
+        self._cache[request] = (fp, snapshot, result)
+        return result
+
+    def _base_fingerprint(self, request):
+        if '_splash_fingerprint_body' in request.meta:
+            # the body was changed by SplashAwareRFC2616Policy
+            request = request.replace(
+                body=request.meta['_splash_fingerprint_body'])
+        if (request.meta.get('_splash_processed')
+                and (self._include is not None or self._exclude)):
+            # URL and body of a request to Splash contain all options,
+            # including the ignored ones; the URL of the page is used
+            # instead, as other options are taken into account anyway.
+            # Requests sent to Splash must still differ from the original
+            # requests, or the dupefilter would drop them when they are
+            # rescheduled.
+            args = request.meta['splash'].get('args', {})
+            request = scrapy.Request(args.get('url', request.url))
+            return (self._base_request_fingerprinter.fingerprint(request)
+                    + b'splash')
+        return self._base_request_fingerprinter.fingerprint(request)
+
+
+def _normalize_options(options):
+    """
+    Return a copy of ``options`` without private keys, in which
+    ``cache_args`` arguments are replaced with fingerprints of their values,
+    regardless of whether the values are sent to Splash (``save_args``),
+    loaded from Splash (``load_args``), or the request is not sent yet.
+    """
+    result = options.__class__(
+        (key, value) for key, value in options.items()
+        if not key.startswith('_'))
+    fingerprints = options.get('_local_arg_fingerprints')
+    if fingerprints:
+        args = result['args'] = copy.copy(result.get('args', {}))
+        args.pop('save_args', None)
+        args.pop('load_args', None)
+        args.update(fingerprints)
+    return result
+
+
+def _include_paths(options, paths):
+    """
+    Return a copy of ``options`` dict with only values at ``paths``
+    (lists of keys) in it.
+    """
+    result = options.__class__()
+    for path in paths:
+        src, dst = options, result
+        for key in path[:-1]:
+            src = src.get(key)
+            if not isinstance(src, dict):
+                break
+            dst = dst.setdefault(key, src.__class__())
+        else:
+            if path[-1] in src:
+                dst[path[-1]] = src[path[-1]]
+    return result
+
+
+def _exclude_path(options, path):
+    """
+    Remove a value at ``path`` (list of keys) from ``options`` dict,
+    copying the dicts which are changed.
+    """
+    parent = options
+    for key in path[:-1]:
+        value = parent.get(key)
+        if not isinstance(value, dict):
+            return
+        parent[key] = parent = copy.copy(value)
+    parent.pop(path[-1], None)
+
+
+def _snapshot(obj, out=None):
+    """
+    Return a list of all containers and values in ``obj``.
+    References are kept, so objects can be compared by identity.
+    """
+    if out is None:
+        out = []
+    out.append(obj)
+    if isinstance(obj, dict):
+        out.append(len(obj))
+        for key, value in obj.items():
+            out.append(key)
+            _snapshot(value, out)
+    elif isinstance(obj, list):
+        out.append(len(obj))
+        for value in obj:
+            _snapshot(value, out)
+    elif isinstance(obj, tuple):
+        for value in obj:
+            _snapshot(value, out)
+    return out
+
+
+def _same_snapshot(snapshot1, snapshot2):
+    return (len(snapshot1) == len(snapshot2)
+            and all(x is y for x, y in zip(snapshot1, snapshot2)))
@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-import json
 import base64
+import mmap
 import re
+import tempfile
 from warnings import warn
 
 from scrapy.http import Response, TextResponse
 from scrapy import Selector
 
 from scrapy_splash.utils import headers_to_scrapy
+from scrapy_splash.jsoncodec import default_codec, LazyJsonObject
 
 
 def get_splash_status(resp):
@@ -43,6 +45,9 @@ class _SplashResponseMixin(object):
                                                  None)
         self.splash_response_headers = kwargs.pop('splash_response_headers',
                                                   None)
+        self.json_codec = kwargs.pop('json_codec', None) or default_codec
+        self.lazy_json = kwargs.pop('lazy_json', False)
+        self.spill_threshold = kwargs.pop('spill_threshold', 0)
         super(_SplashResponseMixin, self).__init__(url, *args, **kwargs)
         if self.splash_response_status is None:
             self.splash_response_status = self.status
@@ -55,7 +60,8 @@ class _SplashResponseMixin(object):
         """
         for x in ['url', 'status', 'headers', 'body', 'request', 'flags',
                   'real_url', 'splash_response_status',
-                  'splash_response_headers']:
+                  'splash_response_headers', 'json_codec', 'lazy_json',
+                  'spill_threshold']:
             kwargs.setdefault(x, getattr(self, x))
         cls = kwargs.pop('cls', self.__class__)
         return cls(*args, **kwargs)
@@ -105,13 +111,26 @@ class SplashJsonResponse(SplashResponse):
     * response.status is set from the value of 'http_status' key; original
       status is available as ``response.splash_response_status``;
     * response.body is set to the value of 'html' key,
-      or to base64-decoded value of 'body' key;
+      or to base64-decoded value of 'body' key ('html' is encoded
+      only when response.body is accessed; response.text doesn't need it);
+
+    If ``lazy_json`` is enabled, ``response.data`` is a read-only mapping
+    which decodes values only when they are accessed, so that large fields
+    a callback doesn't use (e.g. 'png', 'jpeg' or 'har') are not parsed
+    and not kept in memory.
+
+    Use ``response.binary_data(key)`` to get base64-decoded binary fields,
+    e.g. 'png' or 'jpeg'.
     """
+    spill_chunk_size = 4 * 64 * 1024  # must be a multiple of 4
+
     def __init__(self, *args, **kwargs):
         self.cookiejar = None
+        self._har_headers = None
         self._cached_ubody = None
         self._cached_data = None
         self._cached_selector = None
+        self._cached_binary = {}
         kwargs.pop('encoding', None)  # encoding is always utf-8
         super(SplashJsonResponse, self).__init__(*args, **kwargs)
 
@@ -122,13 +141,83 @@ class SplashJsonResponse(SplashResponse):
     @property
     def data(self):
         if self._cached_data is None:
-            self._cached_data = json.loads(self._ubody)
+            if self.lazy_json:
+                try:
+                    self._cached_data = LazyJsonObject(self.body,
+                                                       self.json_codec)
+                except ValueError:
+                    # not a JSON object; it is decoded as usual
+                    pass
+            if self._cached_data is None:
+                self._cached_data = self.json_codec.loads(self.body)
         return self._cached_data
 
     @property
     def text(self):
         return self._ubody
 
+    @property
+    def body(self):
+        if self._body is None:
+            # 'html' is encoded only when the body is actually needed;
+            # .text and selectors use the decoded value directly.
+            self._body = self._cached_ubody.encode(self.encoding)
+        return self._body
+
+    @property
+    def headers(self):
+        if self._har_headers is not None:
+            self._headers = headers_to_scrapy(self._har_headers)
+            self._har_headers = None
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._har_headers = None
+        self._headers = value
+
+    def binary_data(self, key):
+        """
+        Return base64-decoded value of ``response.data[key]``.
+
+        If ``spill_threshold`` is set and the encoded value is larger,
+        it is decoded to a temporary file instead of memory, and a read-only
+        memoryview of the memory-mapped file is returned. The file is removed
+        when the response and the memoryview are garbage collected.
+        """
+        if key not in self._cached_binary:
+            encoded = self._base64_value(key)
+            if 0 < self.spill_threshold < len(encoded):
+                value = self._spill_base64(encoded)
+            else:
+                value = base64.b64decode(encoded)
+            self._cached_binary[key] = value
+        return self._cached_binary[key]
+
+    def _base64_value(self, key):
+        """
+        Return base64-encoded value of ``response.data[key]``, avoiding
+        decoding of JSON string when possible.
+        """
+        if isinstance(self.data, LazyJsonObject):
+            value = self.data.raw_string(key)
+            if value is not None:
+                return value
+        return self.data[key]
+
+    def _spill_base64(self, encoded):
+        size = self.spill_chunk_size
+        with tempfile.TemporaryFile() as f:
+            for start in range(0, len(encoded), size):
+                f.write(base64.b64decode(encoded[start:start + size]))
+            if not f.tell():
+                return b''
+            f.flush()
+            # mmap keeps its own file descriptor; the file is already
+            # unlinked, so it is removed when the mmap is garbage collected.
+            return memoryview(mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+
     def body_as_unicode(self):
         warn(
             (
@@ -184,13 +273,14 @@ class SplashJsonResponse(SplashResponse):
 
         # response.body
         if 'body' in self.data:
-            self._body = base64.b64decode(self.data['body'])
-            self._cached_ubody = self._body.decode(self.encoding)
+            self._body = base64.b64decode(self._base64_value('body'))
+            self._cached_ubody = None
         elif 'html' in self.data:
             self._cached_ubody = self.data['html']
-            self._body = self._cached_ubody.encode(self.encoding)
-            self.headers[b"Content-Type"] = b"text/html; charset=utf-8"
+            self._body = None
+            if 'headers' not in self.data:
+                self.headers[b"Content-Type"] = b"text/html; charset=utf-8"
 
-        # response.headers
+        # response.headers are converted when they are accessed
         if 'headers' in self.data:
-            self.headers = headers_to_scrapy(self.data['headers'])
+            self._har_headers = self.data['headers']
@@ -2,6 +2,10 @@
 from __future__ import absolute_import
 import json
 import hashlib
+import sys
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
 import six
 
 from scrapy.http import Headers
@@ -11,28 +15,40 @@ from scrapy.utils.python import to_unicode, to_bytes
 def dict_hash(obj, start=''):
     """ Return a hash for a dict, based on its contents """
     h = hashlib.sha1(to_bytes(start))
-    h.update(to_bytes(obj.__class__.__name__))
-    if isinstance(obj, dict):
-        for key, value in sorted(obj.items()):
+    _update_dict_hash(h, obj)
+    return h.hexdigest()
+
+
+def _update_dict_hash(h, obj):
+    # Each nested value is hashed separately and its hex digest is added
+    # to the parent hash; this format must be kept, as dict_hash values
+    # are used in request fingerprints (e.g. in HTTP cache and JOBDIR).
+    cls = obj.__class__
+    h.update(cls.__name__.encode('utf8'))
+    if cls is str:
+        h.update(obj.encode('utf8'))
+    elif isinstance(obj, dict):
+        for key in sorted(obj):
             h.update(to_bytes(key))
-            h.update(to_bytes(dict_hash(value)))
+            h.update(_nested_dict_hash(obj[key]))
     elif isinstance(obj, (list, tuple)):
         for el in obj:
-            h.update(to_bytes(dict_hash(el)))
-    else:
-        # basic types
-        if isinstance(obj, bool):
-            value = str(int(obj))
-        elif isinstance(obj, (six.integer_types, float)):
-            value = str(obj)
-        elif isinstance(obj, (six.text_type, bytes)):
-            value = obj
-        elif obj is None:
-            value = b''
-        else:
-            raise ValueError("Unsupported value type: %s" % obj.__class__)
-        h.update(to_bytes(value))
-    return h.hexdigest()
+            h.update(_nested_dict_hash(el))
+    # basic types
+    elif isinstance(obj, bool):
+        h.update(b'1' if obj else b'0')
+    elif isinstance(obj, (six.integer_types, float)):
+        h.update(str(obj).encode('ascii'))
+    elif isinstance(obj, (six.text_type, bytes)):
+        h.update(to_bytes(obj))
+    elif obj is not None:
+        raise ValueError("Unsupported value type: %s" % obj.__class__)
+
+
+def _nested_dict_hash(obj):
+    h = hashlib.sha1()
+    _update_dict_hash(h, obj)
+    return h.hexdigest().encode('ascii')
 
 
 def _process(value, sha=False):
@@ -57,7 +73,83 @@ def _fast_hash(value):
     return _json_based_hash(_process(value))
 
 
-_hash_cache = {}  # fast hash => hash
+class JsonHashCache(object):
+    """
+    Bounded LRU cache of json_based_hash results.
+
+    Strings (e.g. ``lua_source`` values) are looked up by their identity,
+    so a lookup of a string object which is reused across requests doesn't
+    need to hash or compare its contents; cached strings are kept alive
+    while they are in the cache, and their total size is limited by
+    ``max_bytes``. Other values are looked up by their ``_fast_hash``.
+    Hits and misses are counted in ``stats`` if it is passed.
+    """
+    def __init__(self, max_size=1000, stats=None, max_bytes=10 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.stats = stats
+        # (id of a string, its length) or fast hash => (string, size, hash)
+        self._hashes = OrderedDict()
+        self._bytes = 0
+
+    def get_hash(self, value):
+        if isinstance(value, six.text_type):
+            key = (id(value), len(value))
+        else:
+            key = _fast_hash(value)
+        entry = self._hashes.get(key)
+        if entry is not None and (entry[0] is None or entry[0] is value):
+            self._hashes.move_to_end(key)
+            self._inc_stats('hit')
+            return entry[2]
+        self._inc_stats('miss')
+        fp = _json_based_hash(_process(value, sha=True))
+        if isinstance(value, six.text_type):
+            entry = (value, sys.getsizeof(value), fp)
+        else:
+            entry = (None, 0, fp)
+        self._remove(key)
+        self._hashes[key] = entry
+        self._bytes += entry[1]
+        while (len(self._hashes) > self.max_size
+               or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._hashes)))
+        return fp
+
+    def _remove(self, key):
+        entry = self._hashes.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _inc_stats(self, name):
+        if self.stats is not None:
+            self.stats.inc_value('splash/hash_cache/%s' % name)
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+_hash_cache = JsonHashCache()
+_crawler_hash_caches = WeakKeyDictionary()
+
+
+def get_hash_cache(crawler):
+    """
+    Return JsonHashCache shared by scrapy-splash middlewares of the crawler.
+    Its size is set by SPLASH_HASH_CACHE_SIZE and SPLASH_HASH_CACHE_MAX_BYTES
+    options.
+    """
+    if crawler not in _crawler_hash_caches:
+        settings = crawler.settings
+        _crawler_hash_caches[crawler] = JsonHashCache(
+            max_size=settings.getint('SPLASH_HASH_CACHE_SIZE', 1000),
+            max_bytes=settings.getint('SPLASH_HASH_CACHE_MAX_BYTES',
+                                      10 * 1024 * 1024),
+            stats=crawler.stats,
+        )
+    return _crawler_hash_caches[crawler]
+
+
 def json_based_hash(value):
     """
     Return a hash for any JSON-serializable value.
@@ -65,10 +157,7 @@ def json_based_hash(value):
     >>> json_based_hash({"foo": "bar", "baz": [1, 2]})
     '0570066939bea46c610bfdc35b20f37ef09d05ed'
     """
-    fp = _fast_hash(value)
-    if fp not in _hash_cache:
-        _hash_cache[fp] = _json_based_hash(_process(value, sha=True))
-    return _hash_cache[fp]
+    return _hash_cache.get_hash(value)
 
 
 def _json_based_hash(value):
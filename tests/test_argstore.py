@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import pickle
+
+import pytest
+from scrapy import Spider
+from scrapy.settings import Settings
+
+from scrapy_splash.argstore import (
+    RemoteKeyStore,
+    MemoryArgumentStore,
+    SqliteArgumentStore,
+    get_argument_store,
+    ensure_argument_store,
+)
+
+
+def test_remote_key_store(tmp_path):
+    path = str(tmp_path / 'keys.jl')
+    store = RemoteKeyStore(path)
+    store.open()
+    assert store.get('http://splash1', 'LOCAL+1') is None
+    store.set('http://splash1', 'LOCAL+1', 'key1')
+    store.set('http://splash1', 'LOCAL+1', 'key1')
+    store.set('http://splash2', 'LOCAL+1', 'key2')
+    store.set('http://splash1', 'LOCAL+2', 'key3')
+    store.discard('http://splash1', 'LOCAL+2')
+    store.discard('http://splash1', 'LOCAL+3')
+    assert store.get('http://splash1', 'LOCAL+1') == 'key1'
+    assert store.get('http://splash2', 'LOCAL+1') == 'key2'
+    assert store.get('http://splash1', 'LOCAL+2') is None
+    store.close()
+
+    with open(path) as f:
+        assert len(f.readlines()) == 4
+
+    with open(path, 'a') as f:
+        f.write('{"splash_url": "http://spl')  # interrupted write
+
+    store = RemoteKeyStore(path)
+    store.open()
+    assert len(store) == 2
+    assert store.get('http://splash1', 'LOCAL+1') == 'key1'
+    assert store.get('http://splash2', 'LOCAL+1') == 'key2'
+    store.close()
+
+    # file is compacted when it is opened
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+
+    store = RemoteKeyStore(path)
+    store.open()
+    store.clear('http://splash1')
+    assert store.get('http://splash1', 'LOCAL+1') is None
+    assert store.get('http://splash2', 'LOCAL+1') == 'key2'
+    store.close()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def argument_store(request, tmp_path):
+    if request.param == 'memory':
+        store = MemoryArgumentStore(max_unreferenced=2)
+    else:
+        store = SqliteArgumentStore(str(tmp_path / 'args.sqlite'),
+                                    max_unreferenced=2)
+    yield store
+    store.close()
+
+
+def test_argument_store(argument_store):
+    store = argument_store
+    store.add('LOCAL+1', 'value1')
+    store.add('LOCAL+1', 'value1')
+    store.add('LOCAL+2', {'value': 2})
+    assert store.refcount('LOCAL+1') == 2
+    assert store['LOCAL+2'] == {'value': 2}
+    assert sorted(store) == ['LOCAL+1', 'LOCAL+2']
+
+    # referenced values are never dropped
+    for i in range(3, 10):
+        store['LOCAL+%s' % i] = 'value%s' % i
+    assert len(store) == 4
+    assert store['LOCAL+1'] == 'value1'
+    assert store['LOCAL+2'] == {'value': 2}
+
+    # unreferenced values are kept in LRU region
+    store.release('LOCAL+1')
+    assert store.refcount('LOCAL+1') == 1
+    store.release('LOCAL+1')
+    store.release('LOCAL+1')
+    assert store.refcount('LOCAL+1') == 0
+    assert store['LOCAL+1'] == 'value1'
+    assert 'LOCAL+8' not in store
+    store.release('LOCAL+2')
+    assert sorted(store) == ['LOCAL+1', 'LOCAL+2']
+
+    # values are revived when they are referenced again
+    store.add('LOCAL+1', 'value1')
+    store['LOCAL+10'] = 'value10'
+    store['LOCAL+11'] = 'value11'
+    assert sorted(store) == ['LOCAL+1', 'LOCAL+10', 'LOCAL+11']
+    del store['LOCAL+10']
+    assert 'LOCAL+10' not in store
+
+
+def test_sqlite_argument_store_pickle(tmp_path):
+    store = SqliteArgumentStore(str(tmp_path / 'args.sqlite'))
+    store.add('LOCAL+1', 'x' * 10000)
+    data = pickle.dumps(store)
+    assert len(data) < 1000
+    store.close()
+
+    store = pickle.loads(data)
+    assert store['LOCAL+1'] == 'x' * 10000
+    assert store.refcount('LOCAL+1') == 1
+    store.close()
+
+
+def test_get_argument_store(tmp_path):
+    store = get_argument_store(Settings())
+    assert isinstance(store, MemoryArgumentStore)
+
+    store = get_argument_store(Settings({'SPLASH_ARGS_STORE': 'sqlite',
+                                         'JOBDIR': str(tmp_path)}))
+    assert isinstance(store, SqliteArgumentStore)
+    assert store.path == str(tmp_path / 'splash_args.sqlite')
+    store.close()
+
+
+def test_ensure_argument_store():
+    spider = Spider('foo')
+    spider.state = {'values': {'LOCAL+1': 'value1'}}  # older version state
+    store = ensure_argument_store(spider, 'values')
+    assert isinstance(store, MemoryArgumentStore)
+    assert store.refcount('LOCAL+1') == 1
+    assert ensure_argument_store(spider, 'values') is store
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import os
+import time
+from email.utils import formatdate
+
+import scrapy
+from scrapy.http import TextResponse
+
+from scrapy_splash import (
+    SplashRequest,
+    SplashJsonResponse,
+    SplashDeduplicateArgsMiddleware,
+    SplashRenderCacheMiddleware,
+    SplashDedupFSCacheStorage,
+    SplashAwareRFC2616Policy,
+)
+from scrapy_splash.cache import SqliteRenderCacheStorage
+from scrapy_splash.jsoncodec import CompactJsonCodec
+from .test_middleware import _get_crawler, _get_mw
+
+
+def _get_cache_mw(tmpdir, **settings):
+    settings['SPLASH_RENDER_CACHE_PATH'] = str(tmpdir.join('cache.sqlite'))
+    crawler = _get_crawler(settings)
+    cache_mw = SplashRenderCacheMiddleware.from_crawler(crawler)
+    cache_mw.spider_opened(None)
+    return cache_mw
+
+
+def test_render_cache(tmpdir):
+    spider = scrapy.Spider(name='foo')
+    cache_mw = _get_cache_mw(tmpdir)
+    mw = _get_mw()
+
+    def get_request(url="http://example.com"):
+        req = SplashRequest(url, endpoint='render.json', args={'html': 1})
+        req = mw.process_request(req, spider)
+        mw.process_request(req, spider)
+        return req
+
+    # first call: the cache is empty
+    req = get_request()
+    assert cache_mw.process_request(req, spider) is None
+    resp = TextResponse(req.url, headers={b'Content-Type': b'application/json'},
+                        body=b'{"html": "<html>Hello</html>"}')
+    assert cache_mw.process_response(req, resp, spider) is resp
+
+    # errors are not cached
+    req2 = get_request("http://example.com/2")
+    assert cache_mw.process_request(req2, spider) is None
+    resp2 = resp.replace(status=503)
+    cache_mw.process_response(req2, resp2, spider)
+    assert cache_mw.process_request(get_request("http://example.com/2"),
+                                    spider) is None
+
+    # second call: response is returned from cache
+    req = get_request()
+    cached = cache_mw.process_request(req, spider)
+    assert 'cached' in cached.flags
+    assert cached.body == resp.body
+    assert cached.headers[b'Content-Type'] == b'application/json'
+    assert cache_mw.process_response(req, cached, spider) is cached
+    resp = mw.process_response(req, cached, spider)
+    assert isinstance(resp, SplashJsonResponse)
+    assert resp.text == '<html>Hello</html>'
+
+    stats = cache_mw.crawler.stats
+    assert stats.get_value('splash/render_cache/hit') == 1
+    assert stats.get_value('splash/render_cache/miss') == 3
+    assert stats.get_value('splash/render_cache/store') == 1
+    cache_mw.spider_closed(None)
+
+
+def test_render_cache_key(tmpdir):
+    spider = scrapy.Spider(name='foo')
+    cache_mw = _get_cache_mw(tmpdir)
+    mw = _get_mw({'SPLASH_URLS': ['http://splash1:8050',
+                                  'http://splash2:8050']})
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(splash_url, **kwargs):
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            splash_url=splash_url, **kwargs)
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        req = mw.process_request(req, spider)
+        mw.process_request(req, spider)
+        return req
+
+    kwargs = dict(args={'lua_source': 'function main(splash) end'},
+                  cache_args=['lua_source'])
+    req1 = get_request('http://splash1:8050', **kwargs)
+    assert req1.meta['splash']['args']['save_args'] == ['lua_source']
+    mw._remote_keys['http://splash2:8050'] = {
+        req1.meta['splash']['_local_arg_fingerprints']['lua_source']: 'key'}
+    req2 = get_request('http://splash2:8050', **kwargs)
+    assert 'load_args' in req2.meta['splash']['args']
+    assert cache_mw._cache_key(req1) == cache_mw._cache_key(req2)
+
+    req3 = get_request('http://splash1:8050', args={'lua_source': 'foo'})
+    assert cache_mw._cache_key(req1) != cache_mw._cache_key(req3)
+    cache_mw.spider_closed(None)
+
+
+def test_render_cache_saved_arguments(tmpdir):
+    spider = scrapy.Spider(name='foo')
+    cache_mw = _get_cache_mw(tmpdir)
+    mw = _get_mw({'SPLASH_URLS': ['http://splash1:8050',
+                                  'http://splash2:8050']})
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(splash_url):
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            splash_url=splash_url,
+                            args={'lua_source': 'function main(splash) end'},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        req = mw.process_request(req, spider)
+        mw.process_request(req, spider)
+        return req
+
+    # splash1 renders the page and saves lua_source
+    req1 = get_request('http://splash1:8050')
+    assert cache_mw.process_request(req1, spider) is None
+    resp = TextResponse(req1.url, body=b'{"html": "<html></html>"}', headers={
+        b'Content-Type': b'application/json',
+        b'X-Splash-Saved-Arguments': b'lua_source=KEY_ON_SPLASH1',
+    })
+    resp = cache_mw.process_response(req1, resp, spider)
+    mw.process_response(req1, resp, spider)
+    fp = req1.meta['splash']['_local_arg_fingerprints']['lua_source']
+    assert mw._remote_keys['http://splash1:8050'] == {fp: 'KEY_ON_SPLASH1'}
+
+    # the cached response for splash2 doesn't record splash1 keys
+    req2 = get_request('http://splash2:8050')
+    cached = cache_mw.process_request(req2, spider)
+    assert 'cached' in cached.flags
+    assert b'X-Splash-Saved-Arguments' not in cached.headers
+    mw.process_response(req2, cached, spider)
+    assert fp not in mw._remote_keys.get('http://splash2:8050', {})
+    req3 = get_request('http://splash2:8050')
+    assert 'load_args' not in req3.meta['splash']['args']
+    cache_mw.spider_closed(None)
+
+
+def test_render_cache_ttl(tmpdir):
+    cache_mw = _get_cache_mw(
+        tmpdir,
+        SPLASH_RENDER_CACHE_TTL=100,
+        SPLASH_RENDER_CACHE_TTL_PER_ENDPOINT={'render.png': 10},
+        SPLASH_RENDER_CACHE_TTL_PER_DOMAIN={'example.com': 1},
+    )
+
+    def get_ttl(url, endpoint):
+        return cache_mw._get_ttl(SplashRequest(url, endpoint=endpoint))
+
+    assert get_ttl('http://example.org', 'render.html') == 100
+    assert get_ttl('http://example.org', 'render.png') == 10
+    assert get_ttl('http://www.example.com', 'render.png') == 1
+    cache_mw.spider_closed(None)
+
+
+def test_sqlite_render_cache_storage(tmpdir, monkeypatch):
+    storage = SqliteRenderCacheStorage(str(tmpdir.join('cache.sqlite')),
+                                       max_size=35000)
+    storage.open()
+    headers = [['Content-Type', ['text/html']]]
+    bodies = [os.urandom(10000) for i in range(4)]
+    for i in range(3):
+        monkeypatch.setattr(time, 'time', lambda i=i: 1000.0 + i)
+        storage.store('key%d' % i, 200, 'http://example.com', headers,
+                      bodies[i])
+    assert storage.retrieve('key0') == (200, 'http://example.com', headers,
+                                        bodies[0])
+
+    # the least recently used response is removed
+    storage.store('key3', 200, 'http://example.com', headers, bodies[3])
+    assert storage.retrieve('key1') is None
+    assert storage.retrieve('key0') is not None
+    assert storage.retrieve('key2') is not None
+
+    # expired responses are not returned
+    monkeypatch.setattr(time, 'time', lambda: 1100.0)
+    assert storage.retrieve('key0', ttl=50) is None
+    assert storage.retrieve('key3', ttl=500) is not None
+    storage.close()
+
+    storage.open()
+    assert 30000 < storage._size < 35000
+    storage.close()
+
+
+def test_dedup_fs_cache_storage(tmpdir, monkeypatch):
+    crawler = _get_crawler({
+        'HTTPCACHE_DIR': str(tmpdir),
+        'HTTPCACHE_EXPIRATION_SECS': 100,
+    })
+    spider = scrapy.Spider(name='foo')
+    spider.crawler = crawler
+    storage = SplashDedupFSCacheStorage(crawler.settings)
+    storage.open_spider(spider)
+
+    def store(url, body):
+        req = scrapy.Request(url)
+        resp = TextResponse(url, body=body, headers={'X-Url': url})
+        storage.store_response(spider, req, resp)
+        return req
+
+    opened = []
+    _open = storage._open
+
+    def open_file(path, mode):
+        opened.append(os.path.basename(path))
+        return _open(path, mode)
+
+    monkeypatch.setattr(storage, '_open', open_file)
+    body = os.urandom(1000)
+    req1 = store("http://example.com/1", body)
+    req2 = store("http://example.com/2", body)
+    req3 = store("http://example.com/3", b"other")
+    # bodies are written only to shared files
+    assert 'response_body' not in opened
+    assert 'request_body' not in opened
+    assert opened.count('response_headers') == 3
+
+    resp1 = storage.retrieve_response(spider, req1)
+    resp2 = storage.retrieve_response(spider, req2)
+    assert resp1.body == resp2.body == body
+    assert resp1.headers[b'X-Url'] == b"http://example.com/1"
+    assert storage.retrieve_response(spider, req3).body == b"other"
+
+    def body_stat(req):
+        path = storage._get_request_path(spider, req)
+        return os.stat(os.path.join(path, 'response_body'))
+
+    assert body_stat(req1).st_ino == body_stat(req2).st_ino
+    assert body_stat(req1).st_ino != body_stat(req3).st_ino
+
+    # overwriting an entry doesn't change bodies of other entries
+    store("http://example.com/2", b"changed")
+    assert storage.retrieve_response(spider, req1).body == body
+    assert storage.retrieve_response(spider, req2).body == b"changed"
+
+    def blob_count():
+        blobs = tmpdir.join('foo', '_blobs')
+        return sum(len(d.listdir()) for d in blobs.listdir())
+
+    # the same body is stored once (request bodies are all empty)
+    assert blob_count() == 4
+
+    # the 3rd entry is expired; its body and the changed body are removed,
+    # the first body is still used
+    now = time.time()
+    path3 = storage._get_request_path(spider, req3)
+    os.utime(os.path.join(path3, 'pickled_meta'), (now - 200, now - 200))
+    storage.close_spider(spider)
+    assert not os.path.exists(path3)
+    assert blob_count() == 3
+    assert storage.retrieve_response(spider, req1).body == body
+    assert storage.retrieve_response(spider, req2).body == b"changed"
+    assert storage.retrieve_response(spider, req3) is None
+
+    # unused bodies are removed even without expiration
+    store("http://example.com/1", b"changed")
+    store("http://example.com/2", b"new")
+    storage.collect_garbage(spider)
+    assert blob_count() == 3  # b"changed", b"new" and b""
+
+
+def test_rfc2616_policy():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw()
+    policy = SplashAwareRFC2616Policy(mw.crawler.settings)
+
+    def get_request():
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            args={'lua_source': 'function main() end'},
+                            headers={'X-My-Header': 'value'})
+        req = mw.process_request(req, spider)
+        mw.process_request(req, spider)
+        return req
+
+    def get_response(req, http_status=200, **headers):
+        data = {'html': '<html></html>', 'http_status': http_status,
+                'headers': [{'name': name, 'value': value}
+                            for name, value in headers.items()]}
+        return TextResponse(req.url, body=json.dumps(data).encode('utf8'),
+                            headers={'Content-Type': 'application/json',
+                                     'Date': formatdate(usegmt=True)})
+
+    req = get_request()
+    resp = get_response(req)
+    assert not policy.should_cache_response(resp, req)
+    resp = get_response(req, ETag='"123"')
+    assert policy.should_cache_response(resp, req)
+    resp = get_response(req, **{'Cache-Control': 'no-store, max-age=60'})
+    assert not policy.should_cache_response(resp, req)
+
+    # rendered page is fresh
+    req = get_request()
+    cached = get_response(req, **{'Cache-Control': 'max-age=60'})
+    assert policy.should_cache_response(cached, req)
+    assert policy.is_cached_response_fresh(cached, req)
+
+    # rendered page is stale: validators are sent to the website
+    req = get_request()
+    body = req.body
+    cached = get_response(req, ETag='"123"', **{
+        'Cache-Control': 'max-age=0',
+        'Last-Modified': 'Mon, 12 Oct 2026 10:00:00 GMT',
+    })
+    assert not policy.is_cached_response_fresh(cached, req)
+    assert req.body != body
+    assert 'If-None-Match' not in req.headers
+    headers = json.loads(req.body)['headers']
+    assert headers == {
+        'X-My-Header': 'value',
+        'If-None-Match': '"123"',
+        'If-Modified-Since': 'Mon, 12 Oct 2026 10:00:00 GMT',
+    }
+    assert req.meta['splash']['args']['headers'] == {'X-My-Header': 'value'}
+
+    # the website replies with 304 Not Modified
+    assert policy.is_cached_response_valid(
+        cached, get_response(req, http_status=304), req)
+    assert not policy.is_cached_response_valid(
+        cached, get_response(req, http_status=200), req)
+
+    # responses without rendered page headers are handled as usual
+    req = get_request()
+    resp = TextResponse(req.url, body=b'<html></html>',
+                        headers={'ETag': '"123"'})
+    assert policy.should_cache_response(resp, req)
+
+
+def test_rfc2616_policy_json_codec():
+    spider = scrapy.Spider(name='foo')
+    settings = {'SPLASH_JSON_CODEC': 'compact',
+                'REQUEST_FINGERPRINTER_CLASS':
+                    'scrapy_splash.SplashRequestFingerprinter'}
+    mw = _get_mw(settings)
+    policy = SplashAwareRFC2616Policy(mw.crawler.settings)
+    fingerprinter = mw.crawler.request_fingerprinter
+    req = SplashRequest('http://example.com', endpoint='execute',
+                        args={'lua_source': 'function main() end'})
+    req = mw.process_request(req, spider)
+    mw.process_request(req, spider)
+
+    png = 'A' * 100000
+    data = {'http_status': 200, 'png': png, 'headers': [
+        {'name': 'ETag', 'value': '"123"'},
+        {'name': 'Cache-Control', 'value': 'max-age=0'},
+    ]}
+    cached = TextResponse(req.url, body=json.dumps(data).encode('utf8'),
+                          headers={'Content-Type': 'application/json',
+                                   'Date': formatdate(usegmt=True)})
+    decoded = []
+
+    class RecordingCodec(CompactJsonCodec):
+        def loads(self, data):
+            decoded.append(bytes(data))
+            return super(RecordingCodec, self).loads(data)
+
+    policy.json_codec = RecordingCodec()
+    fp = fingerprinter.fingerprint(req.replace())
+    assert not policy.is_cached_response_fresh(cached, req)
+    # only rendered page headers and status are decoded
+    assert decoded
+    assert not any(png.encode('ascii') in value for value in decoded)
+    # the body is encoded with SPLASH_JSON_CODEC
+    assert b'\n' not in req.body
+    assert json.loads(req.body)['headers'] == {'If-None-Match': '"123"'}
+    # the HTTP cache key doesn't depend on the validators
+    assert fingerprinter.fingerprint(req.replace()) == fp
@@ -1,4 +1,12 @@
-from scrapy_splash.cookies import har_to_cookie, cookie_to_har
+from six.moves.http_cookiejar import CookieJar
+
+from scrapy_splash.cookies import (
+    har_to_cookie,
+    cookie_to_har,
+    har_to_jar,
+    jar_to_har,
+    SplashCookieJar,
+)
 
 
 # See also doctests in scrapy_splash.cookies module
@@ -18,3 +26,76 @@ def test_cookie_to_har():
     assert cookie_to_har(har_to_cookie(har_cookie)) == har_cookie
     cookie = har_to_cookie(har_cookie)
     assert vars(cookie) == vars(har_to_cookie(cookie_to_har(cookie)))
+
+
+def test_splash_cookie_jar():
+    jar = SplashCookieJar()
+    har_cookies = [
+        {'name': 'a', 'value': '1', 'domain': 'example.com', 'path': '/',
+         'expires': '2030-01-01T00:00:00Z', 'secure': False},
+        {'name': 'b', 'value': '2', 'domain': 'example.org', 'path': '/',
+         'secure': True, 'httpOnly': True},
+    ]
+    har_to_jar(jar, har_cookies)
+    version = jar.version
+    har = jar_to_har(jar)
+    assert har == har_cookies
+    assert jar_to_har(jar) == har
+    assert jar_to_har(jar)[0] is har[0]  # not rebuilt
+    assert jar_to_har(jar, ['example.org']) == [har_cookies[1]]
+
+    # unchanged cookies don't change the version
+    har_to_jar(jar, har_cookies, har_cookies)
+    jar.set_cookie(har_to_cookie(har_cookies[0]))
+    assert jar.version == version
+    assert jar_to_har(jar)[0] is har[0]
+
+    # changed and removed cookies
+    changed = dict(har_cookies[0], value='3')
+    har_to_jar(jar, [changed], har_cookies)
+    assert jar.version > version
+    assert jar_to_har(jar) == [changed]
+    assert jar_to_har(jar, ['example.org']) == []
+    assert jar_to_har(jar) == jar_to_har(_plain_jar(jar))
+
+    jar.clear()
+    assert jar_to_har(jar) == []
+
+
+def test_splash_cookie_jar_clear(monkeypatch):
+    jar = SplashCookieJar(track_changes=True)
+    har_to_jar(jar, [
+        {'name': 'a', 'value': '1', 'domain': 'example.com', 'path': '/'},
+        {'name': 'b', 'value': '1', 'domain': 'example.com', 'path': '/x'},
+        {'name': 'c', 'value': '1', 'domain': 'example.org', 'path': '/'},
+        {'name': 'old', 'value': '1', 'domain': 'example.org', 'path': '/',
+         'expires': '2000-01-01T00:00:00Z'},
+    ])
+    jar.pop_changes()
+    jar_to_har(jar)
+
+    # expired cookies are removed without iterating over the whole jar
+    # for each of them
+    iterations = []
+    iter_cookies = SplashCookieJar.__iter__
+    monkeypatch.setattr(SplashCookieJar, '__iter__', lambda self: (
+        iterations.append(1) or iter_cookies(self)))
+    jar.clear_expired_cookies()
+    assert len(iterations) == 1
+    monkeypatch.undo()
+    assert jar.pop_changes() == {('example.org', '/', 'old')}
+    assert {c['name'] for c in jar_to_har(jar)} == {'a', 'b', 'c'}
+
+    jar.clear('example.com', '/x')
+    assert jar.pop_changes() == {('example.com', '/x', 'b')}
+    jar.clear('example.org')
+    assert jar.pop_changes() == {('example.org', '/', 'c')}
+    assert jar_to_har(jar) == [{'name': 'a', 'value': '1', 'secure': False,
+                                'domain': 'example.com', 'path': '/'}]
+
+
+def _plain_jar(jar):
+    plain_jar = CookieJar()
+    for cookie in jar:
+        plain_jar.set_cookie(cookie)
+    return plain_jar
@@ -5,7 +5,7 @@ from copy import deepcopy
 import pytest
 import scrapy
 
-from scrapy_splash import SplashRequest
+from scrapy_splash import SplashRequest, SplashDeduplicateArgsMiddleware
 from scrapy_splash.dupefilter import request_fingerprint, splash_request_fingerprint
 from scrapy_splash.utils import dict_hash
 
@@ -113,6 +113,133 @@ def test_splash_request_fingerprinter():
     assert_fingerprints_match_fingerprinter(fingerprinter, r2, r4)
 
 
+def test_splash_request_fingerprinter_stable():
+    # fingerprints are used as HTTP cache keys and are stored in JOBDIR,
+    # so they must not change between versions
+    crawler = make_crawler(TestSpider, {})
+    fingerprinter = SplashRequestFingerprinter(crawler)
+    r = SplashRequest("http://example.com/?b=1&a=2", endpoint='execute',
+                      args={'lua_source': 'function main() end',
+                            'wait': 0.5, 'images': False,
+                            'headers': {'X-Foo': 'bar'},
+                            'cookies': [{'name': 'a', 'value': 1}]})
+    assert fingerprinter.fingerprint(r) == (
+        b'5a1ede5f8feccb0bcec76abbed80ff0c89425f08')
+    assert dict_hash({"foo": ["bar", 1, 2.5, True, None, {"x": b"y"}]}) == (
+        'b7611c932a8adc2b152cfaacadc8c925ec70b0f0')
+
+
+def test_splash_request_fingerprinter_memo():
+    crawler = make_crawler(TestSpider, {})
+    fingerprinter = SplashRequestFingerprinter(crawler)
+    r = SplashRequest("http://example.com", args={'wait': 1,
+                                                  'headers': {'X-Foo': 'a'}})
+    fp1 = fingerprinter.fingerprint(r)
+    assert fingerprinter.fingerprint(r) is fp1
+
+    # 'splash' meta is not copied
+    r.meta['splash']['args']['headers']['X-Foo'] = 'b'
+    fp2 = fingerprinter.fingerprint(r)
+    assert fp2 != fp1
+    r.meta['splash']['args']['headers']['X-Foo'] = 'a'
+    assert fingerprinter.fingerprint(r) == fp1
+
+    # values of different types have different fingerprints
+    r.meta['splash']['args']['wait'] = 1.0
+    assert fingerprinter.fingerprint(r) != fp1
+    r.meta['splash']['args']['wait'] = True
+    assert fingerprinter.fingerprint(r) != fp1
+    r.meta['splash']['args']['wait'] = 1
+    assert fingerprinter.fingerprint(r) == fp1
+
+    r.meta['splash']['foo'] = 'bar'
+    assert fingerprinter.fingerprint(r) != fp1
+    del r.meta['splash']['foo']
+    assert fingerprinter.fingerprint(r) == fp1
+    assert r.meta['splash']['args']['url'] == "http://example.com"
+
+
+def test_splash_request_fingerprinter_exclude():
+    crawler = make_crawler(TestSpider, {
+        'SPLASH_FINGERPRINT_EXCLUDE': ['splash_url', 'args.cookies'],
+    })
+    fingerprinter = SplashRequestFingerprinter(crawler)
+    default_fingerprinter = SplashRequestFingerprinter(
+        make_crawler(TestSpider, {}))
+    r1 = SplashRequest("http://example.com", args={'cookies': [{'a': 1}]})
+    r2 = SplashRequest("http://example.com", splash_url='http://splash2')
+    r3 = SplashRequest("http://example.com", args={'wait': 1})
+    assert_fingerprints_match_fingerprinter(fingerprinter, r1, r2)
+    assert_fingerprints_dont_match_fingerprinter(fingerprinter, r1, r3)
+    assert_fingerprints_dont_match_fingerprinter(default_fingerprinter, r1, r2)
+    assert r1.meta['splash']['args']['cookies'] == [{'a': 1}]
+
+    # requests sent to Splash
+    mw = _get_mw()
+    fp1 = fingerprinter.fingerprint(r1)
+    p1 = mw.process_request(r1, None)
+    p2 = mw.process_request(r2, None)
+    assert p1.url != p2.url
+    assert_fingerprints_match_fingerprinter(fingerprinter, p1, p2)
+    assert_fingerprints_dont_match_fingerprinter(
+        fingerprinter, p1, mw.process_request(r3, None))
+    # rescheduled requests are not duplicates of the original ones
+    assert fingerprinter.fingerprint(p1) != fp1
+
+
+def test_splash_request_fingerprinter_exclude_cache_args():
+    crawler = make_crawler(TestSpider, {
+        'SPLASH_FINGERPRINT_EXCLUDE': ['splash_url', 'slot_policy',
+                                       'splash_headers', 'session_id'],
+    })
+    fingerprinter = SplashRequestFingerprinter(crawler)
+    mw = _get_mw({'SPLASH_URLS': ['http://splash1:8050',
+                                  'http://splash2:8050']})
+    spider = scrapy.Spider(name='foo')
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(splash_url, lua_source='function main(splash) end'):
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            splash_url=splash_url,
+                            args={'lua_source': lua_source},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        fp = fingerprinter.fingerprint(req)
+        return fp, mw.process_request(req, None)
+
+    fp1, p1 = get_request('http://splash1:8050')
+    arg_fp = p1.meta['splash']['_local_arg_fingerprints']['lua_source']
+    mw._remote_keys['http://splash2:8050'] = {arg_fp: 'key'}
+    fp2, p2 = get_request('http://splash2:8050')
+    assert 'save_args' in p1.meta['splash']['args']
+    assert 'load_args' in p2.meta['splash']['args']
+    assert fp1 == fp2
+    assert_fingerprints_match_fingerprinter(fingerprinter, p1, p2)
+    assert fingerprinter.fingerprint(p1) != fp1
+    fp3, p3 = get_request('http://splash1:8050', lua_source='foo')
+    assert fp3 != fp1
+    assert_fingerprints_dont_match_fingerprinter(fingerprinter, p1, p3)
+
+
+def test_splash_request_fingerprinter_include():
+    crawler = make_crawler(TestSpider, {
+        'SPLASH_FINGERPRINT_INCLUDE': ['endpoint', 'args.url', 'args.wait'],
+    })
+    fingerprinter = SplashRequestFingerprinter(crawler)
+    r1 = SplashRequest("http://example.com", args={'images': 0},
+                       splash_url='http://splash2', session_id='foo')
+    r2 = SplashRequest("http://example.com")
+    r3 = SplashRequest("http://example.com", args={'wait': 1})
+    r4 = SplashRequest("http://example.com", endpoint='render.json')
+    r5 = SplashRequest("http://example.org")
+    assert_fingerprints_match_fingerprinter(fingerprinter, r1, r2)
+    assert_fingerprints_dont_match_fingerprinter(fingerprinter, r1, r3)
+    assert_fingerprints_dont_match_fingerprinter(fingerprinter, r1, r4)
+    assert_fingerprints_dont_match_fingerprinter(fingerprinter, r1, r5)
+
+
 @pytest.fixture()
 def splash_middleware():
     return _get_mw()
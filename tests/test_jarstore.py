@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from scrapy.settings import Settings
+
+from scrapy_splash.cookies import SplashCookieJar, har_to_jar
+from scrapy_splash.jarstore import (
+    MemoryJarStore,
+    SqliteJarStore,
+    DbmJarStore,
+    get_jar_store,
+)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+def test_jar_store():
+    store = MemoryJarStore()
+    jar = store['foo']
+    assert isinstance(jar, SplashCookieJar)
+    assert store['foo'] is jar
+    assert 'foo' in store and 'bar' not in store
+    assert list(store) == ['foo']
+    del store['foo']
+    assert len(store) == 0
+    assert store['foo'] is not jar
+
+
+def test_jar_store_max_jars():
+    store = MemoryJarStore(max_jars=2)
+    jar1 = store['s1']
+    store['s2']
+    store['s1']  # s2 is the least recently used jar now
+    store['s3']
+    assert set(store) == {'s1', 's3'}
+    assert store['s1'] is jar1
+    assert store.evicted_count == 1
+
+
+def test_jar_store_sweep():
+    clock = FakeClock()
+    store = MemoryJarStore(idle_ttl=60, clock=clock)
+    har_to_jar(store['s1'], [
+        {'name': 'a', 'value': '1', 'domain': 'example.com'},
+        {'name': 'b', 'value': '1', 'domain': 'example.com',
+         'expires': '2001-01-01T00:00:00Z'},
+    ])
+    clock.time += 50
+    har_to_jar(store['s2'], [{'name': 'c', 'value': '1'}])
+    assert store.sweep() == 2  # the expired cookie is removed
+    assert [c.name for c in store['s1']] == ['a']
+
+    clock.time += 100
+    store['s2']
+    assert store.sweep() == 1
+    assert list(store) == ['s2']
+    assert store.evicted_count == 1
+
+
+def test_get_jar_store(tmpdir):
+    store = get_jar_store(Settings({
+        'SPLASH_COOKIES_MAX_SESSIONS': 10,
+        'SPLASH_COOKIES_SESSION_TTL': 3600,
+    }))
+    assert isinstance(store, MemoryJarStore)
+    assert store.max_jars == 10
+    assert store.idle_ttl == 3600
+
+    store = get_jar_store(Settings({'SPLASH_COOKIES_STORE': 'sqlite',
+                                    'JOBDIR': str(tmpdir)}))
+    assert isinstance(store, SqliteJarStore)
+    assert store.path == str(tmpdir.join('splash_cookies.sqlite'))
+    store.close()
+
+
+def _cookies(jar):
+    return {(c.domain, c.name): c.value for c in jar}
+
+
+def test_sqlite_jar_store_persistence(tmpdir):
+    path = str(tmpdir.join('cookies.sqlite'))
+    store = SqliteJarStore(path)
+    har_to_jar(store['s1'], [
+        {'name': 'a', 'value': '1', 'domain': 'example.com'},
+        {'name': 'b', 'value': '1', 'domain': 'example.com'},
+    ])
+    store.save('s1')
+    store['s2']
+    store.close()
+
+    store = SqliteJarStore(path)
+    jar = store['s1']
+    assert _cookies(jar) == {('example.com', 'a'): '1',
+                             ('example.com', 'b'): '1'}
+    assert _cookies(store['s2']) == {}
+
+    # only changed cookies are written
+    har_to_jar(jar, [{'name': 'a', 'value': '2', 'domain': 'example.com'}],
+               [{'name': 'a', 'value': '1', 'domain': 'example.com'},
+                {'name': 'b', 'value': '1', 'domain': 'example.com'}])
+    assert jar.pop_changes() == {('example.com', '/', 'a'),
+                                 ('example.com', '/', 'b')}
+    jar.set_cookie(jar.get_cookie(('example.com', '/', 'a')))
+    assert jar.pop_changes() == set()
+    store.close()
+
+
+def test_sqlite_jar_store_shared(tmpdir):
+    path = str(tmpdir.join('cookies.sqlite'))
+    store1 = SqliteJarStore(path)
+    store2 = SqliteJarStore(path)
+    jar1 = store1['s1']
+    jar2 = store2['s1']
+    har_to_jar(jar1, [{'name': 'a', 'value': '1', 'domain': 'example.com'}])
+    store1.save('s1')
+    assert store1['s1'] is jar1
+
+    # the jar is reloaded by another process
+    jar2 = store2['s1']
+    assert _cookies(jar2) == {('example.com', 'a'): '1'}
+    har_to_jar(jar2, [{'name': 'b', 'value': '1', 'domain': 'example.com'}])
+    store2.save('s1')
+    assert store2['s1'] is jar2
+    assert _cookies(store1['s1']) == {('example.com', 'a'): '1',
+                                      ('example.com', 'b'): '1'}
+
+    # deleted sessions
+    del store1['s1']
+    assert _cookies(store2['s1']) == {}
+    store1.close()
+    store2.close()
+
+
+def test_sqlite_jar_store_reload_lru(tmpdir):
+    clock = FakeClock()
+    path = str(tmpdir.join('cookies.sqlite'))
+    store1 = SqliteJarStore(path, idle_ttl=100, clock=clock)
+    store2 = SqliteJarStore(path)
+    for session_id in ['a', 'b']:
+        har_to_jar(store1[session_id], [{'name': session_id, 'value': '1'}])
+        store1.save(session_id)
+    har_to_jar(store2['a'], [{'name': 'a', 'value': '2'}])
+    store2.save('a')
+
+    # a reloaded jar is the most recently used one
+    clock.time += 150
+    assert _cookies(store1['a']) == {('', 'a'): '2'}
+    assert list(store1) == ['b', 'a']
+    store1.sweep()
+    assert list(store1) == ['a']
+    store1.close()
+    store2.close()
+
+
+def test_sqlite_jar_store_sweep(tmpdir):
+    clock = FakeClock()
+    path = str(tmpdir.join('cookies.sqlite'))
+    store = SqliteJarStore(path, max_jars=1, idle_ttl=60, clock=clock)
+    for session_id in ['s1', 's2']:
+        har_to_jar(store[session_id], [{'name': session_id, 'value': '1'}])
+        store.save(session_id)
+    assert list(store) == ['s2']
+    # jars dropped from memory are loaded again
+    assert _cookies(store['s1']) == {('', 's1'): '1'}
+
+    clock.time += 100
+    store['s1']
+    assert store.sweep() == 1
+    assert _cookies(store['s2']) == {}
+    store.close()
+    store = SqliteJarStore(path)
+    assert _cookies(store['s1']) == {('', 's1'): '1'}
+    store.close()
+
+
+def test_dbm_jar_store(tmpdir):
+    path = str(tmpdir.join('cookies'))
+    store = DbmJarStore(path)
+    har_to_jar(store['s1'], [{'name': 'a', 'value': '1',
+                              'domain': 'example.com'}])
+    store.save('s1')
+    store['s2']
+    store.close()
+
+    store = DbmJarStore(path)
+    assert _cookies(store['s1']) == {('example.com', 'a'): '1'}
+    assert _cookies(store['s2']) == {}
+    del store['s1']
+    store.close()
+    store = DbmJarStore(path)
+    assert _cookies(store['s1']) == {}
+    store.close()
+
+
+def test_dbm_jar_store_int_session_id(tmpdir):
+    path = str(tmpdir.join('cookies'))
+    store = DbmJarStore(path)
+    har_to_jar(store[123], [{'name': 'a', 'value': '1',
+                             'domain': 'example.com'}])
+    store.save(123)
+    store.close()
+
+    store = DbmJarStore(path)
+    assert _cookies(store[123]) == {('example.com', 'a'): '1'}
+    del store[123]
+    store.close()
+    store = DbmJarStore(path)
+    assert _cookies(store[123]) == {}
+    store.close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+import tracemalloc
+
+import pytest
+
+from scrapy_splash.jsoncodec import (
+    get_json_codec,
+    JsonCodec,
+    CompactJsonCodec,
+    OrjsonCodec,
+    LazyJsonObject,
+    orjson,
+)
+from scrapy_splash.utils import to_bytes
+
+
+_value = {'url': u'http://example.com/ü', 'wait': 0.5, 'args': [1, None, True]}
+
+
+@pytest.mark.parametrize('name', ['json', 'compact', 'fast'])
+def test_roundtrip(name):
+    codec = get_json_codec(name)
+    dumped = codec.dumps(_value)
+    assert codec.loads(dumped) == _value
+    assert codec.loads(to_bytes(dumped)) == _value
+
+
+@pytest.mark.parametrize('name', ['json', 'compact', 'fast'])
+def test_sorted_keys(name):
+    codec = get_json_codec(name)
+    assert to_bytes(codec.dumps({'b': 1, 'a': 2})) == \
+        to_bytes(codec.dumps({'a': 2, 'b': 1}))
+
+
+def test_compact():
+    assert CompactJsonCodec().dumps({'b': [1, 2], 'a': u'ü'}) == u'{"a":"ü","b":[1,2]}'
+    assert '\n' in JsonCodec().dumps({'b': [1, 2]})
+
+
+def test_fast_codec_choice():
+    codec = get_json_codec('fast')
+    if orjson is None:
+        assert isinstance(codec, CompactJsonCodec)
+        with pytest.raises(ImportError):
+            OrjsonCodec()
+    else:
+        assert isinstance(codec, OrjsonCodec)
+
+
+def test_codec_import_path():
+    codec = get_json_codec('scrapy_splash.jsoncodec.CompactJsonCodec')
+    assert isinstance(codec, CompactJsonCodec)
+
+
+def test_lazy_json_object():
+    data = {
+        'html': u'<p class="x">ü</p>',
+        'png': 'iVBORw0KGgo=',
+        'har': {'log': {'entries': [{'a': '}]"'}]}},
+        'url': 'http://example.com',
+        'http_status': 200,
+        'empty': {},
+        'items': [1.5, None, True, False],
+    }
+    for ensure_ascii in [True, False]:
+        body = json.dumps(data, ensure_ascii=ensure_ascii).encode('utf8')
+        obj = LazyJsonObject(body)
+        assert sorted(obj) == sorted(data)
+        assert len(obj) == len(data)
+        assert 'png' in obj and 'foo' not in obj
+        # values without escaped quotes are not decoded until accessed
+        assert 'png' not in obj._values
+        assert 'har' not in obj._values
+        assert obj == data
+        assert bytes(obj.raw('png')) == b'"iVBORw0KGgo="'
+        with pytest.raises(KeyError):
+            obj['foo']
+
+
+def test_lazy_json_object_memory():
+    # containers and strings with escaped quotes before a large value
+    # are skipped without decoding the rest of the document
+    data = {
+        'html': u'<p class="x">ü</p>' * 100,
+        'geometry': [0, 0, 1024, 768],
+        'headers': [{'name': 'X-Foo', 'value': '[\\"{'}],
+        'png': 'A' * 10 ** 7,
+    }
+    body = json.dumps(data).encode('utf8')
+    tracemalloc.start()
+    try:
+        obj = LazyJsonObject(body)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 10 ** 6
+    assert obj['headers'] == data['headers']
+    assert obj['html'] == data['html']
+    assert len(obj.raw('png')) == 10 ** 7 + 2
+
+
+@pytest.mark.parametrize('body', [b'[1, 2]', b'"foo"', b'{"a" 1}',
+                                  b'{"a": 1', b'{"a": "b}', b'{"a": }',
+                                  b'{"a": [1}', b'{"a": ["b]}',
+                                  b'{"a": "\\"}'])
+def test_lazy_json_object_invalid(body):
+    with pytest.raises(ValueError):
+        LazyJsonObject(body)
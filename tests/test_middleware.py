@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import copy
+import gc
 import json
 import base64
 
 import scrapy
+from twisted.internet import defer, task
 from scrapy.core.engine import ExecutionEngine
 from scrapy.utils.test import get_crawler
 from scrapy.http import Response, TextResponse, JsonResponse
@@ -346,6 +348,84 @@ def test_cookies():
     assert cookies == {'pom': 'pam'}
 
 
+def test_cookies_url_scoped():
+    mw = _get_mw()
+    cookie_mw = SplashCookiesMiddleware(
+        url_scoped=True,
+        related_domains={'example.com': ['login.example.org']},
+    )
+
+    def request_to(url, cookies=None):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': 'function main() end'},
+                            cookies=cookies or {})
+        req = cookie_mw.process_request(req, None) or req
+        return mw.process_request(req, None) or req
+
+    def response_with_cookies(req, cookies):
+        resp = TextResponse(
+            'http://mysplash.example.com/execute',
+            headers={b'Content-Type': b'application/json'},
+            body=json.dumps({'html': '', 'cookies': cookies}).encode('utf8'))
+        resp = mw.process_response(req, resp, None)
+        return cookie_mw.process_response(req, resp, None)
+
+    def sent_cookies(req):
+        return {(c.get('domain'), c['name'])
+                for c in req.meta['splash']['args']['cookies']}
+
+    req = request_to('http://example.com/foo', cookies={'local': '1'})
+    jar_cookies = [
+        {'name': 'local', 'value': '1'},
+        {'name': 'a', 'value': '1', 'domain': '.example.com'},
+        {'name': 'b', 'value': '1', 'domain': 'www.example.com'},
+        {'name': 'c', 'value': '1', 'domain': 'login.example.org'},
+        {'name': 'd', 'value': '1', 'domain': 'example.org'},
+        {'name': 'e', 'value': '1', 'domain': 'example.net'},
+    ]
+    response_with_cookies(req, jar_cookies)
+
+    req = request_to('http://www.example.com/')
+    assert sent_cookies(req) == {
+        (None, 'local'),
+        ('.example.com', 'a'),
+        ('www.example.com', 'b'),
+        ('login.example.org', 'c'),
+        ('example.org', 'd'),  # parent domain of login.example.org
+    }
+    req2 = request_to('http://example.net/')
+    assert sent_cookies(req2) == {(None, 'local'), ('example.net', 'e')}
+
+    # cookies which were not sent are not removed
+    resp = response_with_cookies(req, [
+        {'name': 'local', 'value': '1'},
+        {'name': 'a', 'value': '2', 'domain': '.example.com'},
+    ])
+    cookies = {(c.domain, c.name): c.value for c in resp.cookiejar}
+    assert cookies == {
+        ('', 'local'): '1',
+        ('.example.com', 'a'): '2',
+        ('example.net', 'e'): '1',
+    }
+
+
+def test_cookies_sweep():
+    crawler = _get_crawler({'SPLASH_COOKIES_MAX_SESSIONS': 2,
+                            'SPLASH_COOKIES_SWEEP_INTERVAL': 0})
+    cookie_mw = SplashCookiesMiddleware.from_crawler(crawler)
+    for session_id in ['s1', 's2', 's3']:
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            session_id=session_id, cookies={'a': '1'})
+        cookie_mw.process_request(req, None)
+    cookie_mw.spider_opened(None)
+    assert cookie_mw._sweep_task is None
+    cookie_mw.sweep()
+    assert crawler.stats.get_value('splash/cookies/jar_count') == 2
+    assert crawler.stats.get_value('splash/cookies/cookie_count') == 2
+    assert crawler.stats.get_value('splash/cookies/evicted_jar_count') == 1
+    cookie_mw.spider_closed(None)
+
+
 def test_magic_response2():
     # check 'body' handling and another 'headers' format
     mw = _get_mw()
@@ -370,6 +450,32 @@ def test_magic_response2():
     assert resp2.url == "http://example.com/"
 
 
+def test_magic_response_lazy_body():
+    mw = _get_mw()
+    req = SplashRequest('http://example.com/', endpoint='execute')
+    req = mw.process_request(req, None)
+    resp_data = {
+        'html': '<html><body>Привет</body></html>',
+        'headers': [{'name': 'Content-Type', 'value': 'text/html'}],
+    }
+    resp = TextResponse("http://mysplash.example.com/execute",
+                        headers={b'Content-Type': b'application/json'},
+                        body=json.dumps(resp_data).encode('utf8'))
+    resp2 = mw.process_response(req, resp, None)
+    assert resp2.splash_response_headers is resp.headers
+
+    # html is not encoded and headers are not converted until accessed
+    assert resp2._body is None
+    assert resp2._har_headers == resp_data['headers']
+    assert resp2.css('body::text').get() == 'Привет'
+    assert resp2._body is None
+    assert resp2.body == '<html><body>Привет</body></html>'.encode('utf8')
+    assert resp2.headers == {b'Content-Type': [b'text/html']}
+
+    resp2.headers = {b'X-Foo': [b'bar']}
+    assert resp2.headers == {b'X-Foo': [b'bar']}
+
+
 def test_unicode_url():
     mw = _get_mw()
     req = SplashRequest(
@@ -791,4 +897,1064 @@ def test_auth():
     assert_auth_header('', 'pwd', b'Basic OnB3ZA==')
 
     assert_no_auth_header('', '')
-    assert_no_auth_header(None, None)
\ No newline at end of file
+    assert_no_auth_header(None, None)
+
+
+def test_splash_urls_least_outstanding():
+    mw = _get_mw({'SPLASH_URLS': ['http://splash1:8050', 'http://splash2:8050']})
+
+    def _send(url, **kwargs):
+        req = SplashRequest(url, **kwargs)
+        req = mw.process_request(req, None)
+        # the request is downloaded
+        assert mw.process_request(req, None) is None
+        return req
+
+    req1 = _send("http://example.com/1")
+    req2 = _send("http://example.com/2")
+    assert req1.url == "http://splash1:8050/render.html"
+    assert req2.url == "http://splash2:8050/render.html"
+    assert [inst.inflight for inst in mw.pool] == [1, 1]
+
+    # the first instance finishes its request, so it gets the next one
+    resp = TextResponse(req1.url, headers={b'Content-Type': b'text/html'},
+                        body=b'<html></html>')
+    mw.process_response(req1, resp, None)
+    assert [inst.inflight for inst in mw.pool] == [0, 1]
+    req3 = _send("http://example.com/3")
+    assert req3.url == "http://splash1:8050/render.html"
+
+    # processing an already processed request doesn't change counters
+    assert mw.process_request(req3, None) is None
+    assert [inst.inflight for inst in mw.pool] == [1, 1]
+
+    # failed requests are not outstanding anymore
+    mw.process_exception(req2, Exception(), None)
+    assert [inst.inflight for inst in mw.pool] == [1, 0]
+    stats = mw.crawler.stats
+    assert stats.get_value('splash/instance/http://splash2:8050/inflight') == 0
+    assert stats.get_value('splash/instance/http://splash2:8050/max_inflight') == 1
+    assert stats.get_value('splash/instance/http://splash1:8050/request_count') == 2
+
+    # explicit splash_url is respected and tracked separately
+    req4 = _send("http://example.com/4", splash_url="http://splash3:8050")
+    assert req4.url == "http://splash3:8050/render.html"
+    assert mw.pool.urls == ['http://splash1:8050', 'http://splash2:8050']
+    assert mw.pool.get('http://splash3:8050').inflight == 1
+
+
+def test_splash_urls_queued():
+    mw = _get_mw({'SPLASH_URLS': ['http://splash1:8050', 'http://splash2:8050']})
+    splash1, splash2 = mw.pool
+
+    # rescheduled requests are counted when routing, but they are not
+    # in flight until they are downloaded
+    req1 = mw.process_request(SplashRequest("http://example.com/1"), None)
+    req2 = mw.process_request(SplashRequest("http://example.com/2"), None)
+    assert req1.url == "http://splash1:8050/render.html"
+    assert req2.url == "http://splash2:8050/render.html"
+    assert [inst.inflight for inst in mw.pool] == [0, 0]
+    assert len(splash1.queued) == len(splash2.queued) == 1
+    assert mw.process_request(req1, None) is None
+    assert [inst.inflight for inst in mw.pool] == [1, 0]
+    assert len(splash1.queued) == 0
+
+    # requests dropped by the dupefilter are not counted anymore
+    mw.request_dropped(req2, None)
+    assert len(splash2.queued) == 0
+    assert mw.pool.pick() is splash2
+
+    # requests which are gone (e.g. stored in a disk queue) are not counted
+    req3 = mw.process_request(SplashRequest("http://example.com/3"), None)
+    assert len(splash2.queued) == 1
+    assert '_splash_outstanding' not in req3.meta
+    del req3
+    gc.collect()
+    assert len(splash2.queued) == 0
+
+
+def test_splash_urls_default():
+    mw = _get_mw({'SPLASH_URL': 'http://mysplash:8050'})
+    assert mw.pool.urls == ['http://mysplash:8050']
+    req = mw.process_request(SplashRequest("http://example.com"), None)
+    assert req.url == "http://mysplash:8050/render.html"
+
+
+def test_adaptive_concurrency():
+    from scrapy.core.downloader import Slot
+    mw = _get_mw({
+        'SPLASH_URLS': ['http://splash1:8050'],
+        'SPLASH_ADAPTIVE_CONCURRENCY': True,
+        'SPLASH_ADAPTIVE_CONCURRENCY_MIN': 1,
+        'SPLASH_ADAPTIVE_CONCURRENCY_MAX': 8,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+    })
+    slots = mw.crawler.engine.downloader.slots
+    slots['__splash__http://splash1:8050'] = Slot(4, 0, False)
+    instance = mw.pool.get('http://splash1:8050')
+
+    def _send():
+        req = SplashRequest("http://example.com",
+                            slot_policy=SlotPolicy.PER_SPLASH_INSTANCE)
+        req = mw.process_request(req, None)
+        assert req.meta['download_slot'] == '__splash__http://splash1:8050'
+        assert mw.process_request(req, None) is None
+        return req
+
+    def _respond(req, status):
+        resp = TextResponse(req.url, status=status, body=b'',
+                            headers={b'Content-Type': b'text/html'})
+        mw.process_response(req, resp, None)
+
+    # healthy responses increase the limit additively
+    for _ in range(8):
+        _respond(_send(), 200)
+    assert slots['__splash__http://splash1:8050'].concurrency == 5
+
+    # 503 decreases it multiplicatively, but only once for requests
+    # which were already in flight
+    reqs = [_send() for _ in range(3)]
+    _respond(reqs[0], 503)
+    assert slots['__splash__http://splash1:8050'].concurrency == 2
+    _respond(reqs[1], 504)
+    mw.process_exception(reqs[2], Exception(), None)
+    assert slots['__splash__http://splash1:8050'].concurrency == 2
+    assert instance.inflight == 0
+    _respond(_send(), 503)
+    assert slots['__splash__http://splash1:8050'].concurrency == 1
+    assert mw.crawler.stats.get_value(
+        'splash/instance/http://splash1:8050/concurrency') == 1
+
+
+def test_adaptive_concurrency_latency_baseline():
+    from scrapy_splash.pool import AIMDController, SplashInstance
+    controller = AIMDController(min_concurrency=1, max_concurrency=8)
+    instance = SplashInstance('http://splash1:8050')
+
+    def _respond(latency, count):
+        for _ in range(count):
+            instance.observe_latency(latency)
+            controller.on_response(instance, 200)
+
+    _respond(0.1, 20)
+    assert controller.limit(instance) == 6
+    # a latency spike decreases the limit
+    _respond(1.0, 3)
+    assert controller.limit(instance) == 1
+
+    # pages became slower for good: the limit recovers
+    _respond(0.5, 2000)
+    assert controller.limit(instance) == 8
+    assert 0.45 < instance.baseline_latency <= 0.5
+
+
+def test_adaptive_concurrency_other_slot_policy():
+    from scrapy.core.downloader import Slot
+    mw = _get_mw({'SPLASH_ADAPTIVE_CONCURRENCY': True})
+    req = mw.process_request(SplashRequest("http://example.com"), None)
+    slot = mw.crawler.engine.downloader.slots[req.meta['download_slot']] = \
+        Slot(8, 0, False)
+    resp = TextResponse(req.url, status=503, body=b'',
+                        headers={b'Content-Type': b'text/html'})
+    mw.process_response(req, resp, None)
+    assert slot.concurrency == 8
+
+
+def test_json_codec():
+    mw = _get_mw({'SPLASH_JSON_CODEC': 'compact'})
+    req = SplashRequest("http://example.com", endpoint='render.json',
+                        args={'wait': 0.5, 'html': 1})
+    req = mw.process_request(req, None)
+    assert req.body == b'{"html":1,"url":"http://example.com","wait":0.5}'
+
+    resp_data = {'html': '<html><body>Hello</body></html>'}
+    resp = TextResponse(req.url, headers={b'Content-Type': b'application/json'},
+                        body=json.dumps(resp_data).encode('utf8'))
+    resp2 = mw.process_response(req, resp, None)
+    assert resp2.json_codec is mw.json_codec
+    assert resp2.data == resp_data
+
+
+def test_lazy_json():
+    mw = _get_mw({'SPLASH_LAZY_JSON': True})
+    req = SplashRequest('http://example.com/', endpoint='render.json',
+                        args={'html': 1, 'png': 1})
+    req = mw.process_request(req, None)
+    png = base64.b64encode(b"\x89PNG" * 100).decode('ascii')
+    resp_data = {
+        'url': 'http://example.com/#foo',
+        'html': '<html><body class="x">Hello</body></html>',
+        'png': png,
+    }
+    resp = TextResponse("http://mysplash.example.com/render.json",
+                        headers={b'Content-Type': b'application/json'},
+                        body=json.dumps(resp_data).encode('utf8'))
+    resp2 = mw.process_response(req, resp, None)
+    assert isinstance(resp2, scrapy_splash.SplashJsonResponse)
+    assert resp2.url == 'http://example.com/#foo'
+    assert resp2.text == '<html><body class="x">Hello</body></html>'
+    assert 'png' not in resp2.data._values
+    assert resp2.data['png'] == png
+    assert resp2.data == resp_data
+
+    # non-object JSON results are decoded as usual
+    resp = TextResponse("http://mysplash.example.com/execute",
+                        headers={b'Content-Type': b'application/json'},
+                        body=b'[1, 2]')
+    req = SplashRequest('http://example.com/', endpoint='execute',
+                        magic_response=False)
+    req = mw.process_request(req, None)
+    assert mw.process_response(req, resp, None).data == [1, 2]
+
+
+def test_binary_data_spill():
+    png = b"\x89PNG" + bytes(bytearray(range(256))) * 2000
+    resp_data = {
+        'html': '<html></html>',
+        'png': base64.b64encode(png).decode('ascii'),
+        'jpeg': base64.b64encode(b'small').decode('ascii'),
+        'empty': '',
+    }
+    for lazy_json in [True, False]:
+        mw = _get_mw({'SPLASH_LAZY_JSON': lazy_json,
+                      'SPLASH_SPILL_THRESHOLD': 1000})
+        req = SplashRequest('http://example.com/', endpoint='render.json',
+                            args={'html': 1, 'png': 1})
+        req = mw.process_request(req, None)
+        resp = TextResponse("http://mysplash.example.com/render.json",
+                            headers={b'Content-Type': b'application/json'},
+                            body=json.dumps(resp_data).encode('utf8'))
+        resp = mw.process_response(req, resp, None)
+
+        value = resp.binary_data('png')
+        assert isinstance(value, memoryview)
+        assert value.readonly
+        assert value.tobytes() == png
+        assert resp.binary_data('png') is value
+        assert resp.binary_data('jpeg') == b'small'
+        assert resp.binary_data('empty') == b''
+        if lazy_json:
+            assert 'png' not in resp.data._values
+
+
+def test_binary_data_magic_body():
+    mw = _get_mw({'SPLASH_LAZY_JSON': True})
+    req = SplashRequest('http://example.com/', endpoint='execute')
+    req = mw.process_request(req, None)
+    resp_data = {'body': base64.b64encode(b"binary data").decode('ascii')}
+    resp = TextResponse("http://mysplash.example.com/execute",
+                        headers={b'Content-Type': b'application/json'},
+                        body=json.dumps(resp_data).encode('utf8'))
+    resp = mw.process_response(req, resp, None)
+    assert resp.body == b'binary data'
+    assert 'body' not in resp.data._values
+    assert resp.binary_data('body') == b'binary data'
+
+
+def test_cache_args_remote_key_store(tmp_path):
+    lua_source = 'function main(splash) end'
+    key = 'ba001160ef96fe2a3f938fea9e6762e204a562b3'
+    settings = {'SPLASH_REMOTE_KEYS_PATH': str(tmp_path / 'keys.jl')}
+
+    def get_request(mw, dedupe_mw, spider):
+        req = SplashRequest('http://example.com/foo', endpoint='execute',
+                            args={'lua_source': lua_source},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return mw.process_request(req, spider)
+
+    # first crawl saves the argument
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw(settings)
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    req = get_request(mw, SplashDeduplicateArgsMiddleware(), spider)
+    assert req.meta['splash']['args']['save_args'] == ['lua_source']
+    resp = TextResponse("http://example.com",
+                        headers={
+                            b'Content-Type': b'application/json',
+                            b'X-Splash-Saved-Arguments': b'lua_source=' + key.encode('ascii'),
+                        },
+                        body=b'{}')
+    mw.process_response(req, resp, spider)
+    mw.spider_closed(spider)
+
+    # the next crawl uses load_args from the start
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw(settings)
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    assert mw.crawler.stats.get_value('splash/remote_keys/loaded') == 1
+    req = get_request(mw, SplashDeduplicateArgsMiddleware(), spider)
+    assert req.meta['splash']['args']['load_args'] == {'lua_source': key}
+    assert mw.crawler.stats.get_value('splash/remote_keys/reused') == 1
+
+    # key is forgotten when Splash reports it as expired
+    resp = TextResponse("http://example.com",
+                        headers={b'Content-Type': b'application/json'},
+                        status=498, body=b'{"error": 498}')
+    mw.process_response(req, resp, spider)
+    mw.spider_closed(spider)
+
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw(settings)
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    req = get_request(mw, SplashDeduplicateArgsMiddleware(), spider)
+    assert req.meta['splash']['args']['save_args'] == ['lua_source']
+    mw.spider_closed(spider)
+
+
+def test_cache_args_release():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw()
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+    lua_source = 'function main(splash) end'
+
+    def get_request(url):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': lua_source},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return req
+
+    req1 = get_request('http://example.com/1')
+    req2 = get_request('http://example.com/2')
+    fp = req1.meta['splash']['args']['lua_source']
+    assert mw._argument_values.refcount(fp) == 2
+
+    # request is filtered out by the scheduler
+    mw.request_dropped(req2, spider)
+    mw.request_dropped(req2, spider)
+    assert mw._argument_values.refcount(fp) == 1
+
+    req1 = mw.process_request(req1, spider)
+    resp = TextResponse("http://example.com",
+                        headers={b'Content-Type': b'application/json'},
+                        status=498, body=b'{"error": 498}')
+    req1 = mw.process_response(req1, resp, spider)
+    assert mw._argument_values.refcount(fp) == 1
+
+    resp = TextResponse("http://example.com",
+                        headers={b'Content-Type': b'application/json'},
+                        body=b'{}')
+    resp = mw.process_response(req1, resp, spider)
+    # the response may still be retried by RetryMiddleware
+    assert mw._argument_values.refcount(fp) == 1
+    mw.response_received(resp, req1, spider)
+    assert mw._argument_values.refcount(fp) == 0
+    # the value is still available for retries
+    assert mw._argument_values[fp] == lua_source
+    mw.process_exception(req1, ValueError(), spider)
+    assert mw._argument_values.refcount(fp) == 0
+
+    # requests dropped by other downloader middlewares
+    req3 = get_request('http://example.com/3')
+    assert mw._argument_values.refcount(fp) == 1
+    mw.process_exception(req3, scrapy.exceptions.IgnoreRequest(), spider)
+    assert mw._argument_values.refcount(fp) == 0
+
+
+def test_cache_args_release_retry():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw({'SPLASH_ARGS_STORE_MAX_UNREFERENCED': 1})
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+    store = mw._argument_values
+
+    def get_request(url, lua_source):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': lua_source},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return mw.process_request(req, spider)
+
+    def get_response(req, status=200, saved=b''):
+        return TextResponse(req.url, body=b'{}', status=status,
+                            headers={b'Content-Type': b'application/json',
+                                     b'X-Splash-Saved-Arguments': saved})
+
+    def complete(req, resp):
+        resp = mw.process_response(req, resp, spider)
+        mw.response_received(resp, req, spider)
+
+    req = get_request('http://example.com/1', 'foo')
+    complete(req, get_response(req, saved=b'lua_source=key1'))
+    req = get_request('http://example.com/2', 'foo')
+    assert 'load_args' in req.meta['splash']['args']
+    fp = req.meta['splash']['_local_arg_fingerprints']['lua_source']
+
+    # HTTP 503 is retried by RetryMiddleware
+    mw.process_response(req, get_response(req, 503), spider)
+    retry = req.copy()
+    # other values are released while the retry waits in the queue
+    for lua_source in ['bar', 'baz']:
+        r = get_request('http://example.com/3', lua_source)
+        complete(r, get_response(r))
+    assert store.refcount(fp) == 1
+    assert mw.process_request(retry, spider) is None
+    retry = mw.process_response(retry, get_response(retry, 498), spider)
+    assert json.loads(retry.body)['lua_source'] == 'foo'
+
+    # a download error: the reference is taken again by the retry
+    mw.process_exception(retry, ValueError(), spider)
+    assert store.refcount(fp) == 0
+    retry = retry.copy()
+    assert mw.process_request(retry, spider) is None
+    assert store.refcount(fp) == 1
+    complete(retry, get_response(retry, saved=b'lua_source=key2'))
+    assert store.refcount(fp) == 0
+
+    # the value is dropped before the retry is sent
+    req = get_request('http://example.com/5', 'foo')
+    assert 'load_args' in req.meta['splash']['args']
+    mw.process_exception(req, ValueError(), spider)
+    for lua_source in ['bar', 'baz']:
+        r = get_request('http://example.com/6', lua_source)
+        complete(r, get_response(r))
+    assert fp not in store
+    retry = req.copy()
+    assert mw.process_request(retry, spider) is None
+    resp = mw.process_response(retry, get_response(retry, 498), spider)
+    assert resp.status == 498
+    assert mw.crawler.stats.get_value('splash/args/missing_value_count') == 2
+
+
+def test_prewarm_args():
+    lua_source = 'function main(splash) end'
+    mw = _get_mw({
+        'SPLASH_URLS': ['http://splash1:8050', 'http://splash2:8050'],
+        'SPLASH_PREWARM_ARGS': [lua_source],
+        'SPLASH_PREWARM_SPIDER_ATTRIBUTES': ['lua_script', 'missing'],
+    })
+    spider = scrapy.Spider(name='foo')
+    spider.lua_script = 'function main(splash) return 1 end'
+    mw.crawler.spider = spider
+    downloaded = []
+
+    def download(request):
+        # emulate downloader middlewares; responses arrive later
+        req = mw.process_request(request, spider)
+        d = defer.Deferred()
+        d.addCallback(lambda resp: mw.process_response(req, resp, spider))
+        d.addCallback(lambda resp: mw.response_received(resp, req, spider)
+                      or resp)
+        downloaded.append((req, d))
+        return d
+
+    def respond(req, d):
+        args = json.loads(req.body.decode('utf8'))
+        saved = ';'.join('%s=key-%s' % (name, args[name])
+                         for name in args['save_args'])
+        d.callback(TextResponse(req.url, body=b'{}', headers={
+            b'Content-Type': b'application/json',
+            b'X-Splash-Saved-Arguments': saved.encode('ascii'),
+        }))
+
+    mw.crawler.engine.download = download
+    d = mw.spider_opened(spider)
+    assert isinstance(d, defer.Deferred)
+    for req, download_d in downloaded:
+        respond(req, download_d)
+    assert [req.url for req, _ in downloaded] == [
+        'http://splash1:8050/execute', 'http://splash2:8050/execute']
+    args = json.loads(downloaded[0][0].body.decode('utf8'))
+    assert args['prewarm_0'] == lua_source
+    assert args['prewarm_1'] == spider.lua_script
+    assert sorted(args['save_args']) == ['prewarm_0', 'prewarm_1']
+    assert mw.crawler.stats.get_value('splash/prewarm/response_count/200') == 2
+
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+    req = SplashRequest('http://example.com/foo', endpoint='execute',
+                        args={'lua_source': lua_source},
+                        cache_args=['lua_source'])
+    req, = list(dedupe_mw.process_start_requests([req], spider))
+    req = mw.process_request(req, spider)
+    assert 'save_args' not in req.meta['splash']['args']
+    assert 'load_args' in req.meta['splash']['args']
+
+    # prewarmed values are kept in the argument store
+    fp = req.meta['splash']['_local_arg_fingerprints']['lua_source']
+    assert mw._argument_values.refcount(fp) == 2
+
+
+def test_save_args_single_flight():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw({'SPLASH_SAVE_ARGS_WAIT_TIMEOUT': 10})
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+    lua_source = 'function main(splash) end'
+
+    def get_request(url):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': lua_source},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return req
+
+    req1 = mw.process_request(get_request('http://example.com/1'), spider)
+    assert req1.meta['splash']['args']['save_args'] == ['lua_source']
+
+    # the value is being saved; other requests wait for the key
+    d2 = mw.process_request(get_request('http://example.com/2'), spider)
+    d3 = mw.process_request(get_request('http://example.com/3'), spider)
+    assert isinstance(d2, defer.Deferred)
+    assert not d2.called
+    assert mw.crawler.stats.get_value('splash/save_args/wait_count') == 2
+    results = []
+    d2.addCallback(results.append)
+    d3.addCallback(results.append)
+
+    resp = TextResponse("http://example.com", body=b'{}', headers={
+        b'Content-Type': b'application/json',
+        b'X-Splash-Saved-Arguments': b'lua_source=ba001160ef96fe2a3f938fea9e6762e204a562b3',
+    })
+    mw.process_response(req1, resp, spider)
+    assert [r.url for r in results] == ['http://127.0.0.1:8050/execute'] * 2
+    for req in results:
+        assert 'save_args' not in req.meta['splash']['args']
+        assert req.meta['splash']['args']['load_args'] == {
+            'lua_source': 'ba001160ef96fe2a3f938fea9e6762e204a562b3'}
+    assert mw._uploads == {}
+
+
+def test_save_args_single_flight_failure():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw({'SPLASH_SAVE_ARGS_WAIT_TIMEOUT': 10})
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(url):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': 'function main(splash) end'},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return req
+
+    req1 = mw.process_request(get_request('http://example.com/1'), spider)
+    d2 = mw.process_request(get_request('http://example.com/2'), spider)
+    results = []
+    d2.addCallback(results.append)
+
+    # when the upload fails, a waiting request uploads the value itself
+    mw.process_exception(req1, ValueError(), spider)
+    req2, = results
+    assert req2.meta['splash']['args']['save_args'] == ['lua_source']
+    assert list(mw._uploads) == [
+        ('http://127.0.0.1:8050', req2.meta['splash']['_local_arg_fingerprints']['lua_source'])
+    ]
+
+
+
+def test_save_args_single_flight_timeout():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw({'SPLASH_SAVE_ARGS_WAIT_TIMEOUT': 10})
+    mw.clock = clock = task.Clock()
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(url):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': 'function main(splash) end'},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return req
+
+    req1 = mw.process_request(get_request('http://example.com/1'), spider)
+    d2 = mw.process_request(get_request('http://example.com/2'), spider)
+    results = []
+    d2.addCallback(results.append)
+
+    # the waiting request uploads the value itself when the timeout expires
+    clock.advance(10)
+    req2, = results
+    assert req2.meta['splash']['args']['save_args'] == ['lua_source']
+    assert mw.crawler.stats.get_value(
+        'splash/save_args/wait_timeout_count') == 1
+    key, = mw._uploads
+    assert len(mw._uploads[key]) == 1
+
+    mw.process_response(req1, TextResponse(
+        "http://example.com", body=b'{}',
+        headers={b'Content-Type': b'application/json'}), spider)
+    assert mw._uploads == {}
+
+
+def test_save_args_single_flight_dropped():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw({'SPLASH_SAVE_ARGS_WAIT_TIMEOUT': 10})
+    mw.clock = task.Clock()
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(url):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': 'function main(splash) end'},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return req
+
+    req1 = mw.process_request(get_request('http://example.com/1'), spider)
+    d2 = mw.process_request(get_request('http://example.com/2'), spider)
+    results = []
+    d2.addCallback(results.append)
+
+    # the uploading request is dropped by the scheduler
+    mw.request_dropped(req1, spider)
+    req2, = results
+    assert req2.meta['splash']['args']['save_args'] == ['lua_source']
+    assert list(mw._uploads.values()) == [[]]
+
+def test_498_expires_instance_arguments():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw()
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(url, **args):
+        req = SplashRequest(url, endpoint='execute', args=args,
+                            cache_args=list(args))
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return mw.process_request(req, spider)
+
+    def get_response(req, status=200, saved=b''):
+        return TextResponse(req.url, body=b'{"error": 498}', status=status,
+                            headers={b'Content-Type': b'application/json',
+                                     b'X-Splash-Saved-Arguments': saved})
+
+    # two values are saved on Splash
+    req = get_request('http://example.com/1', lua_source='foo', js='bar')
+    mw.process_response(req, get_response(
+        req, saved=b'lua_source=key1;js=key2'), spider)
+    assert len(mw._remote_keys['http://127.0.0.1:8050']) == 2
+
+    # Splash is restarted
+    req1 = get_request('http://example.com/2', lua_source='foo')
+    req2 = get_request('http://example.com/3', js='bar')
+    req3 = get_request('http://example.com/4', lua_source='foo')
+    assert 'load_args' in req1.meta['splash']['args']
+
+    retry1 = mw.process_response(req1, get_response(req1, 498), spider)
+    assert mw._remote_keys == {}
+    assert mw.crawler.stats.get_value(
+        'splash/instance/http://127.0.0.1:8050/args_expired_count') == 1
+    args = json.loads(retry1.body.decode('utf8'))
+    assert args['save_args'] == ['lua_source']
+    assert args['lua_source'] == 'foo'
+    assert req1.meta['splash']['args']['load_args'] == {'lua_source': 'key1'}
+
+    # not sent yet: rewritten without a round-trip to Splash
+    retry2 = mw.process_request(req2, spider)
+    args = json.loads(retry2.body.decode('utf8'))
+    assert args['save_args'] == ['js']
+    assert args['js'] == 'bar'
+    assert mw.process_request(retry2, spider) is None
+
+    # already sent: it gets HTTP 498 as well, but keys saved after the
+    # restart are kept
+    mw.process_response(retry1, get_response(
+        retry1, saved=b'lua_source=key3'), spider)
+    retry3 = mw.process_response(req3, get_response(req3, 498), spider)
+    assert isinstance(retry3, SplashRequest)
+    assert mw.crawler.stats.get_value(
+        'splash/instance/http://127.0.0.1:8050/args_expired_count') == 1
+    assert list(mw._remote_keys['http://127.0.0.1:8050'].values()) == ['key3']
+
+
+def test_cache_args_per_instance():
+    spider = scrapy.Spider(name='foo')
+    spider.state = {'_splash_remote_keys': {'LOCAL+legacy': 'key0'}}
+    mw = _get_mw({'SPLASH_URL': 'http://splash1:8050'})
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    assert mw._remote_keys == {'http://splash1:8050': {'LOCAL+legacy': 'key0'}}
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(splash_url):
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            splash_url=splash_url,
+                            args={'lua_source': 'function main(splash) end'},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        return mw.process_request(req, spider)
+
+    req = get_request('http://splash1:8050')
+    assert 'save_args' in req.meta['splash']['args']
+    resp = TextResponse(req.url, body=b'{}', headers={
+        b'Content-Type': b'application/json',
+        b'X-Splash-Saved-Arguments': b'lua_source=key1',
+    })
+    mw.process_response(req, resp, spider)
+
+    req = get_request('http://splash2:8050')
+    assert 'save_args' in req.meta['splash']['args']
+    req = get_request('http://splash1:8050')
+    assert req.meta['splash']['args']['load_args'] == {'lua_source': 'key1'}
+
+    stats = mw.crawler.stats
+    prefix = 'splash/instance/http://splash%d:8050/remote_keys/'
+    assert stats.get_value(prefix % 1 + 'hit') == 1
+    assert stats.get_value(prefix % 1 + 'miss') == 1
+    assert stats.get_value(prefix % 2 + 'hit') is None
+    assert stats.get_value(prefix % 2 + 'miss') == 1
+
+
+def test_batch():
+    mw = _get_mw({'SPLASH_BATCH_SIZE': 3, 'SPLASH_BATCH_WINDOW': 1.0})
+    clock = task.Clock()
+    mw.batcher.clock = clock
+    batches = []
+
+    def download(request):
+        d = defer.Deferred()
+        batches.append((request, d))
+        return d
+
+    mw.crawler.engine.download = download
+    lua_source = 'function main(splash, args) return {url=args.url} end'
+
+    def get_request(url, endpoint='execute', **args):
+        args['lua_source'] = lua_source
+        req = SplashRequest(url, endpoint=endpoint, batch=True, args=args)
+        req = mw.process_request(req, None)
+        return req, mw.process_request(req, None)
+
+    req1, d1 = get_request('http://example.com/1')
+    req2, d2 = get_request('http://example.com/2')
+    req3, d3 = get_request('http://example.com/3', endpoint='render.html')
+    assert d3 is None
+    req4, d4 = get_request('http://example.com/4', timeout=10)
+    assert isinstance(d1, defer.Deferred)
+    assert batches == []
+
+    clock.advance(1.0)
+    assert len(batches) == 2
+    batch_req, batch_d = batches[0]
+    assert batch_req.url == 'http://127.0.0.1:8050/execute'
+    args = json.loads(batch_req.body.decode('utf8'))
+    assert [a['url'] for a in args['batch']] == [
+        'http://example.com/1', 'http://example.com/2']
+    assert lua_source in args['lua_source']
+    assert 'lua_source' not in args['batch'][0]
+    assert json.loads(batches[1][0].body.decode('utf8'))['timeout'] == 10.0
+
+    results = []
+    d1.addCallback(results.append)
+    d2.addCallback(results.append)
+    batch_d.callback(TextResponse(batch_req.url, body=json.dumps({
+        'results': [
+            {'ok': True, 'result': {'url': 'http://example.com/1'}},
+            {'ok': False, 'error': '[string "..."]:1: boom'},
+        ]
+    }).encode('utf8'), headers={'Content-Type': 'application/json'}))
+    resp1, resp2 = [mw.process_response(req, resp, None)
+                    for req, resp in zip([req1, req2], results)]
+    assert isinstance(resp1, scrapy_splash.SplashJsonResponse)
+    assert resp1.data == {'url': 'http://example.com/1'}
+    assert resp1.url == 'http://example.com/1'
+    assert resp2.status == 400
+    assert 'boom' in resp2.data['info']['message']
+    assert mw.crawler.stats.get_value('splash/batch/batched_request_count') == 3
+
+    # batch is sent as soon as it is full
+    for i in range(3):
+        get_request('http://example.com/%d' % i)
+    assert len(batches) == 3
+    failures = []
+    for i in range(2):
+        req, d = get_request('http://example.com/%d' % i)
+        d.addErrback(failures.append)
+    clock.advance(1.0)
+    batches[3][1].errback(ValueError())
+    assert len(failures) == 2
+
+    # requests of different sessions or with different cookies
+    # are not batched together
+    get_request('http://example.com/1', cookies=[{'name': 'a', 'value': 'b'}])
+    get_request('http://example.com/2', cookies=[{'name': 'a', 'value': 'c'}])
+    for session_id in ['foo', 'bar']:
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            batch=True, session_id=session_id,
+                            args={'lua_source': lua_source})
+        mw.process_request(mw.process_request(req, None), None)
+    clock.advance(1.0)
+    assert len(batches) == 8
+
+    # a batch fits into Splash max timeout
+    for i in range(3):
+        get_request('http://example.com/%d' % i, timeout=40)
+    assert len(batches) == 9
+    assert json.loads(batches[8][0].body.decode('utf8'))['timeout'] == 80.0
+    clock.advance(1.0)
+    assert len(batches) == 10
+
+
+
+def test_batch_adaptive_concurrency():
+    mw = _get_mw({'SPLASH_ADAPTIVE_CONCURRENCY': True})
+    lua_source = 'function main(splash, args) return {url=args.url} end'
+
+    def get_request(url, **kwargs):
+        req = SplashRequest(url, endpoint='execute', batch=True,
+                            args={'lua_source': lua_source}, **kwargs)
+        req = mw.process_request(req, None)
+        return mw.process_request(req, None)
+
+    # the concurrency limit applies to requests which use instance slots
+    assert get_request('http://example.com/1',
+                       slot_policy=SlotPolicy.PER_SPLASH_INSTANCE) is None
+    mw.batcher.clock = task.Clock()
+    assert isinstance(get_request('http://example.com/2'), defer.Deferred)
+
+def test_coalesce_renders():
+    mw = _get_mw({'SPLASH_COALESCE_RENDERS': True})
+    mw.crawler.request_fingerprinter = scrapy_splash.SplashRequestFingerprinter(
+        mw.crawler)
+
+    def get_request(url='http://example.com', **kwargs):
+        req = SplashRequest(url, endpoint='render.json', dont_filter=True,
+                            **kwargs)
+        req = mw.process_request(req, None)
+        return req, mw.process_request(req, None)
+
+    req1, d1 = get_request(callback=lambda r: None)
+    req2, d2 = get_request(meta={'foo': 'bar'})
+    req3, d3 = get_request()
+    req4, d4 = get_request('http://example.com/other')
+    assert d1 is None
+    assert d4 is None
+    assert isinstance(d2, defer.Deferred)
+    assert mw.crawler.stats.get_value('splash/coalesced/request_count') == 2
+
+    results = []
+    d2.addCallback(results.append)
+    d3.addCallback(results.append)
+    resp = TextResponse(req1.url, headers={b'Content-Type': b'application/json'},
+                        body=b'{"html": "<html>hello</html>"}')
+    resp1 = mw.process_response(req1, resp, None)
+    resp2, resp3 = [mw.process_response(req, resp, None)
+                    for req, resp in zip([req2, req3], results)]
+    assert resp2 is not resp1
+    assert resp2.request is req2
+    assert resp2.text == resp1.text == '<html>hello</html>'
+    assert resp3.request is req3
+
+    # after an error, waiting requests are sent themselves
+    req1, d1 = get_request()
+    req2, d2 = get_request()
+    results = []
+    d2.addCallback(results.append)
+    mw.process_exception(req1, ValueError(), None)
+    assert results == [None]
+    req3, d3 = get_request()
+    assert isinstance(d3, defer.Deferred)
+
+
+
+def test_coalesce_renders_timeout():
+    mw = _get_mw({'SPLASH_COALESCE_RENDERS': True,
+                  'SPLASH_COALESCE_RENDERS_TIMEOUT': 30})
+    mw.clock = clock = task.Clock()
+    mw.crawler.request_fingerprinter = scrapy_splash.SplashRequestFingerprinter(
+        mw.crawler)
+    stats = mw.crawler.stats
+    inflight = 'splash/instance/http://127.0.0.1:8050/inflight'
+
+    def get_request():
+        req = SplashRequest('http://example.com', endpoint='render.json',
+                            dont_filter=True)
+        req = mw.process_request(req, None)
+        return req, mw.process_request(req, None)
+
+    # waiting requests are not sent to Splash
+    req1, d1 = get_request()
+    req2, d2 = get_request()
+    req3, d3 = get_request()
+    assert stats.get_value(inflight) == 1
+    results2, results3 = [], []
+    d2.addCallback(results2.append)
+    d3.addCallback(results3.append)
+
+    # the first request never gets a response: one of the waiting requests
+    # is sent itself, and the other one waits for it
+    clock.advance(30)
+    assert results2 == []
+    assert results3 == [None]
+    assert stats.get_value('splash/coalesced/wait_timeout_count') == 1
+    assert stats.get_value(inflight) == 2
+    resp = TextResponse(req3.url, headers={b'Content-Type': b'application/json'},
+                        body=b'{"html": "<html>hello</html>"}')
+    mw.process_response(req3, resp, None)
+    resp2 = mw.process_response(req2, results2[0], None)
+    assert resp2.text == '<html>hello</html>'
+    assert stats.get_value(inflight) == 1
+    assert mw._renders == {}
+
+
+def test_coalesce_renders_dropped():
+    mw = _get_mw({'SPLASH_COALESCE_RENDERS': True,
+                  'SPLASH_ADAPTIVE_CONCURRENCY': True,
+                  'SPLASH_SLOT_POLICY': SlotPolicy.PER_SPLASH_INSTANCE})
+    mw.clock = task.Clock()
+    mw.crawler.request_fingerprinter = scrapy_splash.SplashRequestFingerprinter(
+        mw.crawler)
+    instance = mw.pool.get('http://127.0.0.1:8050')
+
+    def get_request():
+        req = SplashRequest('http://example.com', endpoint='render.json',
+                            dont_filter=True)
+        req = mw.process_request(req, None)
+        return req, mw.process_request(req, None)
+
+    req1, d1 = get_request()
+    # the leading request is sent back to the scheduler
+    assert mw.process_request(req1, None) is None
+    req2, d2 = get_request()
+    results = []
+    d2.addCallback(results.append)
+    mw.request_dropped(req1, None)
+    assert results == [None]
+    assert instance.inflight == 1
+
+    # a shared response isn't counted for the Splash instance
+    req3, d3 = get_request()
+    results = []
+    d3.addCallback(results.append)
+    resp = TextResponse(req2.url, headers={b'Content-Type': b'application/json'},
+                        body=b'{"html": "<html></html>"}')
+    mw.process_response(req2, resp, None)
+    limit = mw.concurrency_controller.limit(instance)
+    mw.process_response(req3, results[0], None)
+    assert mw.concurrency_controller.limit(instance) == limit
+    assert instance.inflight == 0
+
+def test_coalesce_renders_saved_arguments():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw({
+        'SPLASH_COALESCE_RENDERS': True,
+        'SPLASH_URLS': ['http://splash1:8050', 'http://splash2:8050'],
+        'SPLASH_FINGERPRINT_EXCLUDE': ['splash_url'],
+    })
+    mw.crawler.request_fingerprinter = scrapy_splash.SplashRequestFingerprinter(
+        mw.crawler)
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    dedupe_mw = SplashDeduplicateArgsMiddleware()
+
+    def get_request(splash_url):
+        req = SplashRequest('http://example.com', endpoint='execute',
+                            splash_url=splash_url, dont_filter=True,
+                            args={'lua_source': 'function main() end'},
+                            cache_args=['lua_source'])
+        req, = list(dedupe_mw.process_start_requests([req], spider))
+        req = mw.process_request(req, spider)
+        return req, mw.process_request(req, spider)
+
+    req1, d1 = get_request('http://splash1:8050')
+    req2, d2 = get_request('http://splash2:8050')
+    assert d1 is None
+    assert isinstance(d2, defer.Deferred)
+    results = []
+    d2.addCallback(results.append)
+    resp = TextResponse(req1.url, body=b'{"html": "<html></html>"}', headers={
+        b'Content-Type': b'application/json',
+        b'X-Splash-Saved-Arguments': b'lua_source=KEY_ON_SPLASH1',
+    })
+    mw.process_response(req1, resp, spider)
+    resp2 = mw.process_response(req2, results[0], spider)
+    assert resp2.text == '<html></html>'
+    fp = req1.meta['splash']['_local_arg_fingerprints']['lua_source']
+    assert mw._remote_keys['http://splash1:8050'] == {fp: 'KEY_ON_SPLASH1'}
+    assert fp not in mw._remote_keys.get('http://splash2:8050', {})
+
+
+def test_cookies_cache_args():
+    spider = scrapy.Spider(name='foo')
+    mw = _get_mw()
+    mw.crawler.spider = spider
+    mw.spider_opened(spider)
+    cookie_mw = SplashCookiesMiddleware(cache_args=True)
+    store = mw._argument_values
+
+    def request_to(url):
+        req = SplashRequest(url, endpoint='execute',
+                            args={'lua_source': 'function main() end'})
+        req = cookie_mw.process_request(req, spider) or req
+        return mw.process_request(req, spider) or req
+
+    def response_with_cookies(req, cookies, saved_args=None):
+        headers = {b'Content-Type': b'application/json'}
+        if saved_args:
+            headers[b'X-Splash-Saved-Arguments'] = saved_args
+        resp = TextResponse(
+            'http://mysplash.example.com/execute', headers=headers,
+            body=json.dumps({'html': '', 'cookies': cookies}).encode('utf8'))
+        resp = mw.process_response(req, resp, spider)
+        resp = cookie_mw.process_response(req, resp, spider)
+        mw.response_received(resp, req, spider)
+        return resp
+
+    # no cookies yet: nothing is cached
+    req = request_to('http://example.com/1')
+    assert req.meta['splash']['args']['cookies'] == []
+    response_with_cookies(req, [{'name': 'a', 'value': '1'},
+                                {'name': 'b', 'value': '1'}])
+
+    # cookies are uploaded with save_args
+    req = request_to('http://example.com/2')
+    args = json.loads(req.body)
+    assert args['save_args'] == ['cookies']
+    assert len(args['cookies']) == 2
+    fp = req.meta['splash']['_local_arg_fingerprints']['cookies']
+    assert store.refcount(fp) == 1
+    response_with_cookies(req, args['cookies'], b'cookies=key1')
+    assert store.refcount(fp) == 0
+
+    # unchanged cookies are not sent again
+    req = request_to('http://example.com/3')
+    args = json.loads(req.body)
+    assert args['load_args'] == {'cookies': 'key1'}
+    assert 'cookies' not in args
+    # a cookie removed by the page is removed from the jar
+    resp = response_with_cookies(req, [{'name': 'a', 'value': '1'}])
+    assert {c.name for c in resp.cookiejar} == {'a'}
+    assert store.refcount(fp) == 0
+
+    # failed requests release the cookies; retried requests still
+    # remove cookies removed by the page
+    req = request_to('http://example.com/4')
+    fp2 = req.meta['splash']['_local_arg_fingerprints']['cookies']
+    assert fp2 != fp
+    mw.process_exception(req, ValueError(), spider)
+    assert store.refcount(fp2) == 0
+    response_with_cookies(req, [{'name': 'a', 'value': '1'},
+                                {'name': 'b', 'value': '2'}])
+    req = request_to('http://example.com/5')
+    response_with_cookies(req, json.loads(req.body)['cookies'],
+                          b'cookies=key2')
+    req = request_to('http://example.com/6')
+    assert json.loads(req.body)['load_args'] == {'cookies': 'key2'}
+    fp3 = req.meta['splash']['_local_arg_fingerprints']['cookies']
+    mw.process_exception(req, ValueError(), spider)
+    assert store.refcount(fp3) == 0
+    retry_req = req.copy()
+    resp = response_with_cookies(retry_req, [{'name': 'b', 'value': '2'}])
+    assert {c.name for c in resp.cookiejar} == {'b'}
+
+
+def test_hash_cache_per_crawler():
+    crawler = _get_crawler({})
+    mw = SplashMiddleware.from_crawler(crawler)
+    cookie_mw = SplashCookiesMiddleware.from_crawler(crawler)
+    dedupe_mw = SplashDeduplicateArgsMiddleware.from_crawler(crawler)
+    assert cookie_mw.hash_cache is mw.hash_cache
+    assert dedupe_mw.hash_cache is mw.hash_cache
+    assert _get_mw().hash_cache is not mw.hash_cache
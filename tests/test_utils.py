@@ -5,11 +5,14 @@ import json
 from hypothesis import given, assume
 from hypothesis import strategies as st
 from scrapy.http import Headers
+from scrapy.utils.test import get_crawler
 from scrapy_splash.utils import (
     headers_to_scrapy,
     _fast_hash,
     json_based_hash,
-    dict_hash
+    dict_hash,
+    JsonHashCache,
+    get_hash_cache,
 )
 
 
@@ -73,3 +76,50 @@ def test_json_based_hash(val1, val2):
     assume(val1 != val2)
     assert json_based_hash(val1) == json_based_hash(val1)
     assert json_based_hash(val1) != json_based_hash(val2)
+
+
+def test_json_hash_cache():
+    stats = get_crawler().stats
+    cache = JsonHashCache(max_size=2, stats=stats)
+    lua_source = "function main(splash) return 'x' end" * 100
+    fp = cache.get_hash(lua_source)
+    assert fp == json_based_hash(lua_source)
+    assert cache.get_hash(lua_source) == fp
+    assert stats.get_value('splash/hash_cache/hit') == 1
+    assert stats.get_value('splash/hash_cache/miss') == 1
+    # strings are looked up by identity
+    assert cache.get_hash(''.join(list(lua_source))) == fp
+    assert stats.get_value('splash/hash_cache/miss') == 2
+
+    value = {"foo": ["bar", 1]}
+    assert cache.get_hash(value) == json_based_hash(value)
+    assert cache.get_hash({"foo": ["bar", 1]}) == json_based_hash(value)
+    assert cache.get_hash({"foo": ["bar", 2]}) != json_based_hash(value)
+    assert stats.get_value('splash/hash_cache/hit') == 2
+    assert stats.get_value('splash/hash_cache/miss') == 4
+
+    # the cache is bounded
+    assert len(cache) == 2
+    assert cache.get_hash(lua_source) == fp
+    assert stats.get_value('splash/hash_cache/miss') == 5
+
+
+def test_json_hash_cache_max_bytes():
+    cache = JsonHashCache(max_bytes=10000)
+    values = ['x' * 3000 + str(i) for i in range(10)]
+    for value in values:
+        cache.get_hash(value)
+    assert len(cache) == 3
+    assert cache._bytes <= 10000
+    # small values are not limited by the size of large ones
+    cache.get_hash({"foo": "x" * 20000})
+    assert len(cache) == 4
+
+
+def test_get_hash_cache():
+    crawler1 = get_crawler(settings_dict={'SPLASH_HASH_CACHE_SIZE': 5})
+    crawler2 = get_crawler()
+    cache = get_hash_cache(crawler1)
+    assert cache.max_size == 5
+    assert get_hash_cache(crawler1) is cache
+    assert get_hash_cache(crawler2) is not cache